@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark verifying WSGI environ dicts with and without WebOb wrapping.
+
+Run it from a checkout with macauthlib importable, like this::
+
+    PYTHONPATH=. python benchmarks/bench_environ.py
+
+"""
+
+import timeit
+
+import webob
+
+import macauthlib
+from macauthlib import utils
+
+
+KEY = "489dks293j39"
+
+ENVIRON = {
+    "wsgi.url_scheme": "http",
+    "REQUEST_METHOD": "POST",
+    "HTTP_HOST": "example.com",
+    "SCRIPT_NAME": "/app",
+    "PATH_INFO": "/resource/1",
+    "QUERY_STRING": "b=1&a=2",
+}
+
+
+def main(number=20000):
+    macauthlib.sign_request(ENVIRON, "h480djs93hd8", KEY)
+    params = utils.parse_authz_header(utils.EnvironRequest(ENVIRON))
+
+    def webob_normalize():
+        utils.get_normalized_request_string(webob.Request(ENVIRON), params)
+
+    def environ_normalize():
+        utils.get_normalized_request_string(utils.EnvironRequest(ENVIRON),
+                                            params)
+
+    def webob_verify():
+        macauthlib.check_signature(webob.Request(ENVIRON), KEY, nonces=False)
+
+    def environ_verify():
+        macauthlib.check_signature(ENVIRON, KEY, nonces=False)
+
+    results = {}
+    for name, func in (("webob normalize", webob_normalize),
+                       ("environ normalize", environ_normalize),
+                       ("webob verify", webob_verify),
+                       ("environ verify", environ_verify)):
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        results[name] = best / number * 1e6
+        print("%-20s %8.2f us/request" % (name, results[name]))
+    saving = results["webob verify"] - results["environ verify"]
+    print("%-20s %8.2f us/request" % ("saving", saving))
+
+
+if __name__ == "__main__":
+    main()
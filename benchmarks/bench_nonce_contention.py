@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark NonceCache lock contention at various thread counts.
+
+This compares a plain NonceCache, where every operation serialises on a
+single lock, with a ShardedNonceCache.  Run it from a checkout with
+macauthlib importable, like this::
+
+    PYTHONPATH=. python benchmarks/bench_nonce_contention.py
+
+"""
+
+import time
+import threading
+
+from macauthlib.noncecache import NonceCache, ShardedNonceCache
+
+
+def run(nonces, num_threads, checks_per_thread=20000, num_ids=1000):
+    """Time num_threads threads hammering the given cache with checks."""
+    start_barrier = threading.Barrier(num_threads + 1)
+    now = time.time()
+
+    def worker(thread_num):
+        check_nonce = nonces.check_nonce
+        start_barrier.wait()
+        for i in range(checks_per_thread):
+            id = "id%d" % ((i * 31 + thread_num) % num_ids,)
+            check_nonce(id, now, "%d-%d" % (thread_num, i))
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.time()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return num_threads * checks_per_thread / elapsed
+
+
+def main():
+    print("%-8s %18s %18s" % ("threads", "NonceCache", "ShardedNonceCache"))
+    for num_threads in (1, 8, 32):
+        plain = run(NonceCache(), num_threads)
+        sharded = run(ShardedNonceCache(), num_threads)
+        print("%-8d %14.0f op/s %14.0f op/s" % (num_threads, plain, sharded))
+
+
+if __name__ == "__main__":
+    main()
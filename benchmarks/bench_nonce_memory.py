@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark the memory used per id and per nonce by the nonce caches.
+
+This compares a plain NonceCache with a CompactNonceCache, measuring the
+memory allocated while filling each with many ids and nonces.  Run it from
+a checkout with macauthlib importable, like this::
+
+    PYTHONPATH=. python benchmarks/bench_nonce_memory.py
+
+"""
+
+import time
+import tracemalloc
+
+from macauthlib.noncecache import NonceCache, CompactNonceCache
+
+
+def measure(factory, num_ids, nonces_per_id):
+    """Get the bytes allocated to fill a cache with the given items."""
+    now = time.time()
+    # Build the nonce strings up front, so they aren't counted.
+    nonces = ["%032x" % (i,) for i in range(nonces_per_id)]
+    ids = ["id%d" % (i,) for i in range(num_ids)]
+    tracemalloc.start()
+    cache = factory()
+    for id in ids:
+        for nonce in nonces:
+            cache.check_nonce(id, now, nonce, now)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cache
+    return size
+
+
+def main():
+    num_ids = 10000
+    factories = [("NonceCache", NonceCache),
+                 ("CompactNonceCache", CompactNonceCache)]
+    print("%-18s %14s %14s" % ("cache", "bytes/id", "bytes/nonce"))
+    for (name, factory) in factories:
+        # Measure with one nonce per id, then with many, and attribute
+        # the difference to the extra nonces.
+        one = measure(factory, num_ids, 1)
+        many = measure(factory, num_ids, 11)
+        per_nonce = (many - one) / float(num_ids * 10)
+        per_id = one / float(num_ids) - per_nonce
+        print("%-18s %14.0f %14.0f" % (name, per_id, per_nonce))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark suite for the macauthlib hot paths.
+
+This runs a fixed set of offline workloads covering header parsing, request
+normalization for each supported request type, signing and verification,
+and nonce cache checks under varying thread counts and id cardinality.  It
+only uses the long-standing public API, so the same suite can be run
+against different checkouts and the results compared::
+
+    PYTHONPATH=/path/to/old python benchmarks/suite.py -o old.json
+    PYTHONPATH=/path/to/new python benchmarks/suite.py -o new.json
+    python benchmarks/suite.py --compare old.json new.json
+
+Results are written as JSON, giving the best time per operation over
+several repeats for each benchmark.  Use --filter to run a subset of the
+benchmarks and --quick for a fast, noisier run.
+
+"""
+
+import io
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import threading
+
+import webob
+
+import macauthlib
+from macauthlib import utils
+from macauthlib.noncecache import NonceCache
+
+try:
+    import requests
+except ImportError:   # pragma nocover
+    requests = None
+
+
+ID = "h480djs93hd8"
+KEY = "489dks293j39"
+
+ENVIRON = {
+    "wsgi.url_scheme": "http",
+    "REQUEST_METHOD": "POST",
+    "HTTP_HOST": "example.com",
+    "SERVER_NAME": "example.com",
+    "SERVER_PORT": "80",
+    "SCRIPT_NAME": "",
+    "PATH_INFO": "/resource/1",
+    "QUERY_STRING": "b=1&a=2",
+}
+
+TYPICAL_HEADER = ('MAC id="h480djs93hd8", ts="1336363200", '
+                  'nonce="dj83hs9s", mac="bhCQXTVyfj5cmA9uKkPFx1zeOXM="')
+
+ADVERSARIAL_HEADERS = {
+    # Lots of escaped characters inside a long quoted-string.
+    "escapes": 'MAC id="' + '\\"' * 1900 + '"',
+    # A long quoted-string that is never closed.
+    "unclosed": 'MAC id="' + "x" * 4000,
+    # The maximum number of short parameters.
+    "params": "MAC " + ", ".join('p%d="v"' % (i,) for i in range(32)),
+}
+
+# Registry of (name, setup function) pairs.  Each setup function returns
+# a callable that performs one operation of the benchmark.
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Decorator registering a benchmark setup function."""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def make_environ(**kwds):
+    environ = dict(ENVIRON)
+    environ.update(kwds)
+    return environ
+
+
+def make_raw_request():
+    return (b"POST /resource/1?b=1&a=2 HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"Content-Length: 0\r\n"
+            b"\r\n")
+
+
+def _parse_benchmark(header):
+    request = webob.Request(make_environ(HTTP_AUTHORIZATION=header))
+
+    def run():
+        try:
+            utils.parse_authz_header(request)
+        except ValueError:
+            pass
+    return run
+
+
+@benchmark("parse/typical")
+def bench_parse_typical():
+    return _parse_benchmark(TYPICAL_HEADER)
+
+
+for (_name, _header) in sorted(ADVERSARIAL_HEADERS.items()):
+    benchmark("parse/adversarial-" + _name)(
+        lambda header=_header: _parse_benchmark(header))
+
+
+def _normalize_benchmark(make_request):
+    params = utils.parse_authz_value(TYPICAL_HEADER) \
+        if hasattr(utils, "parse_authz_value") else {
+            "id": ID, "ts": "1336363200", "nonce": "dj83hs9s"}
+    normalize = utils.normalize_request_object(
+        utils.get_normalized_request_string)
+
+    def run():
+        normalize(make_request(), params)
+    return run
+
+
+@benchmark("normalize/webob")
+def bench_normalize_webob():
+    request = webob.Request(make_environ())
+    return _normalize_benchmark(lambda: request)
+
+
+@benchmark("normalize/environ")
+def bench_normalize_environ():
+    environ = make_environ()
+    return _normalize_benchmark(lambda: environ)
+
+
+@benchmark("normalize/bytes")
+def bench_normalize_bytes():
+    data = make_raw_request()
+    return _normalize_benchmark(lambda: data)
+
+
+@benchmark("normalize/file")
+def bench_normalize_file():
+    data = make_raw_request()
+    return _normalize_benchmark(lambda: io.BytesIO(data))
+
+
+@benchmark("normalize/prepared-request")
+def bench_normalize_prepared_request():
+    if requests is None:   # pragma nocover
+        return None
+    request = requests.Request("POST", "http://example.com/resource/1",
+                               params=[("b", "1"), ("a", "2")]).prepare()
+    return _normalize_benchmark(lambda: request)
+
+
+@benchmark("sign/webob")
+def bench_sign_webob():
+    request = webob.Request(make_environ())
+
+    def run():
+        macauthlib.sign_request(request, ID, KEY)
+    return run
+
+
+@benchmark("sign/environ")
+def bench_sign_environ():
+    environ = make_environ()
+
+    def run():
+        macauthlib.sign_request(environ, ID, KEY)
+    return run
+
+
+@benchmark("verify/webob")
+def bench_verify_webob():
+    request = webob.Request(make_environ())
+    macauthlib.sign_request(request, ID, KEY)
+
+    def run():
+        macauthlib.check_signature(request, KEY, nonces=False)
+    return run
+
+
+@benchmark("verify/environ")
+def bench_verify_environ():
+    environ = make_environ()
+    macauthlib.sign_request(environ, ID, KEY)
+
+    def run():
+        macauthlib.check_signature(environ, KEY, nonces=False)
+    return run
+
+
+@benchmark("verify/environ-with-nonces")
+def bench_verify_environ_with_nonces():
+    # Each request needs a fresh nonce, so pre-sign a pool of them.
+    nonces = NonceCache()
+    environs = []
+    for i in range(50000):
+        environ = make_environ()
+        macauthlib.sign_request(environ, ID, KEY,
+                                params={"nonce": "n%d" % (i,)})
+        environs.append(environ)
+    pool = iter(environs)
+
+    def run():
+        macauthlib.check_signature(next(pool), KEY, nonces=nonces)
+    run.max_calls = len(environs)
+    return run
+
+
+def _nonce_benchmark(num_threads, num_ids):
+    """Set up a benchmark of concurrent NonceCache checks.
+
+    Each operation of this benchmark is a batch of 1000 checks per thread,
+    spread over the given number of ids.
+    """
+    nonces = NonceCache()
+    ids = ["id%d" % (i,) for i in range(num_ids)]
+    counter = [0]
+
+    def worker(thread_num, base):
+        check_nonce = nonces.check_nonce
+        now = time.time()
+        for i in range(1000):
+            check_nonce(ids[(base + i) % num_ids], now,
+                        "%d-%d-%d" % (thread_num, base, i))
+
+    def run():
+        base = counter[0]
+        counter[0] += 1000
+        if num_threads == 1:
+            worker(0, base)
+            return
+        threads = [threading.Thread(target=worker, args=(n, base))
+                   for n in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+
+for _threads in (1, 4):
+    for _ids in (1, 1000, 100000):
+        benchmark("nonce/threads=%d/ids=%d" % (_threads, _ids))(
+            lambda t=_threads, n=_ids: _nonce_benchmark(t, n))
+
+
+def time_benchmark(func, target, repeat):
+    """Get the best time per call of func over several repeats.
+
+    One call is made first to calibrate the number of calls per repeat, so
+    that each repeat takes roughly "target" seconds.  If func has a
+    "max_calls" attribute, no more than that many calls are made in total.
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = max(time.perf_counter() - start, 1e-7)
+    number = max(1, min(100000, int(target / elapsed)))
+    max_calls = getattr(func, "max_calls", None)
+    if max_calls is not None:
+        number = min(number, (max_calls - 1) // repeat)
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return (best / number, number)
+
+
+def run_suite(pattern=None, quick=False):
+    """Run the benchmarks, printing and returning the results."""
+    results = {}
+    for (name, setup) in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        func = setup()
+        if func is None:   # pragma nocover
+            continue
+        target = 0.05 if quick else 0.2
+        repeat = 3 if quick else 5
+        (seconds, number) = time_benchmark(func, target, repeat)
+        results[name] = {
+            "seconds_per_op": seconds,
+            "ops_per_second": 1.0 / seconds,
+            "number": number,
+            "repeat": repeat,
+        }
+        print("%-36s %12.2f us/op %14.0f op/s"
+              % (name, seconds * 1e6, 1.0 / seconds))
+        sys.stdout.flush()
+    return {
+        "meta": {
+            "macauthlib": getattr(macauthlib, "__version__", "unknown"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=0.1):
+    """Print a comparison of two sets of results.
+
+    Returns the number of benchmarks that got slower by more than the
+    given fraction.
+    """
+    regressions = 0
+    print("%-36s %12s %12s %8s" % ("benchmark", "old us/op", "new us/op",
+                                   "change"))
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        old_result = old["results"].get(name)
+        new_result = new["results"].get(name)
+        if old_result is None or new_result is None:
+            print("%-36s %s" % (name, "(missing from one run)"))
+            continue
+        old_time = old_result["seconds_per_op"]
+        new_time = new_result["seconds_per_op"]
+        change = new_time / old_time - 1
+        flag = ""
+        if change > threshold:
+            flag = " SLOWER"
+            regressions += 1
+        elif change < -threshold:
+            flag = " faster"
+        print("%-36s %12.2f %12.2f %+7.1f%%%s"
+              % (name, old_time * 1e6, new_time * 1e6, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    description = __doc__.strip().split("\n")[0]
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-o", "--output",
+                        help="write JSON results to this file")
+    parser.add_argument("-f", "--filter",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true",
+                        help="do fewer, shorter runs")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two JSON result files and exit")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fractional slowdown reported as a regression")
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        return 1 if compare(old, new, args.threshold) else 0
+    results = run_suite(args.filter, args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
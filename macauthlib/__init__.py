@@ -12,6 +12,12 @@ this::
 
     macauthlib.sign_request(request, id, key)
 
+Clients signing many requests with the same credentials can instead create
+a Signer object once, and use it to sign each outgoing request::
+
+    signer = macauthlib.Signer(id, key)
+    signer.sign(request)
+
 Typical use for a server program would be to verify a signed request like
 this::
 
@@ -22,6 +28,15 @@ this::
             return True
     return False
 
+Servers verifying many requests can instead create a Verifier object once,
+and use it to check each incoming request::
+
+    verifier = macauthlib.Verifier(somehow_lookup_the_mac_key)
+    result = verifier.verify(request)
+    if result.ok:
+        return result.id
+    return None
+
 """
 
 __ver_major__ = 0
@@ -35,10 +50,15 @@ __version__ = "%d.%d.%d%s" % __ver_tuple__
 import os
 import time
 import hmac
+import base64
 from hashlib import sha1
 
-from macauthlib import utils
+from macauthlib import utils, instrument
 from macauthlib.noncecache import NonceCache
+from macauthlib.keycache import HMACKeyCache  # NOQA
+from macauthlib.utils import RequestView  # NOQA
+from macauthlib.signer import Signer, MACAuth  # NOQA
+from macauthlib.verifier import Verifier, VerifyResult  # NOQA
 
 
 # Global NonceCache instance used when a specific cache is not specified.
@@ -46,31 +66,43 @@ DEFAULT_NONCE_CACHE = None
 
 
 @utils.normalize_request_object
-def sign_request(request, id, key, hashmod=None, params=None):
+def sign_request(request, id, key, hashmod=None, params=None, clock=None):
     """Sign the given request using MAC access authentication.
 
     This function implements the client-side request signing algorithm as
     expected by the server, i.e. MAC access authentication as defined by
-    RFC-TODO.  It takes a WebOb Request object and inserts the appropriate
+    RFC-TODO.  It takes a request object and inserts the appropriate
     signature into its Authorization header.
+
+    The optional "clock" argument gives the time source used for the "ts"
+    parameter, as described in macauthlib.clock.  It defaults to time.time.
     """
+    timer = instrument.current()
     # Use explicitly-given parameters, or those from the request.
     if params is None:
-        params = utils.parse_authz_header(request, {})
+        params = dict(utils.parse_authz_header(request, {}))
         if params and params.pop("scheme") != "MAC":
             params.clear()
+        if timer is not None:
+            timer.stage(instrument.STAGE_PARSE)
     # Give sensible values to any parameters that weren't specified.
     params["id"] = id
     if "ts" not in params:
-        params["ts"] = str(int(time.time()))
+        if clock is None:
+            clock = time.time
+        params["ts"] = str(int(clock()))
     if "nonce" not in params:
         params["nonce"] = utils.b64encode(os.urandom(5))
     # Calculate the signature and add it to the parameters.
     params["mac"] = get_signature(request, key, hashmod, params)
+    if timer is not None:
+        timer.stage(instrument.STAGE_SIGNATURE)
     # Serialize the parameters back into the authz header, and return it.
-    # WebOb has logic to do this that's not perfect, but good enough for us.
-    request.authorization = ("MAC", params)
-    return request.headers["Authorization"]
+    authz = utils.format_authz_header("MAC", params)
+    request.store_authorization(authz)
+    if timer is not None:
+        timer.stage(instrument.STAGE_HEADER)
+    return authz
 
 
 @utils.normalize_request_object
@@ -89,7 +121,7 @@ def get_id(request, params=None):
 
 
 @utils.normalize_request_object
-def get_signature(request, key, hashmod=None, params=None):
+def get_signature(request, key, hashmod=None, params=None, keycache=None):
     """Get the MAC signature for the given request.
 
     This function calculates the MAC signature for the given request and
@@ -99,21 +131,60 @@ def get_signature(request, key, hashmod=None, params=None):
     dict of MAC parameters as one might find in the Authorization header.  If
     it is missing or None then the Authorization header from the request will
     be parsed to determine the necessary parameters.
+
+    If the "keycache" parameter is not None, it must be an HMACKeyCache
+    object from which to obtain pre-initialised HMAC state for the id given
+    in the parameters.
     """
+    timer = instrument.current()
     if params is None:
         params = utils.parse_authz_header(request, {})
+        if timer is not None:
+            timer.stage(instrument.STAGE_PARSE)
     if hashmod is None:
         hashmod = sha1
     sigstr = utils.get_normalized_request_string(request, params)
     # The spec mandates that ids and keys must be ascii.
     # It's therefore safe to encode like this before doing the signature.
     sigstr = sigstr.encode("ascii")
-    key = key.encode("ascii")
-    return utils.b64encode(hmac.new(key, sigstr, hashmod).digest())
+    if timer is not None:
+        timer.stage(instrument.STAGE_STRING)
+    id = params.get("id")
+    if keycache is not None and id is not None:
+        hasher = keycache.get_hmac(id, key, hashmod)
+        hasher.update(sigstr)
+    else:
+        hasher = hmac.new(key.encode("ascii"), sigstr, hashmod)
+    sig = utils.b64encode(hasher.digest())
+    if timer is not None:
+        timer.stage(instrument.STAGE_HMAC)
+    return sig
+
+
+def get_signature_bytes(key, ts, nonce, method, path_qs, host,
+                        scheme=b"http", ext=b"", hashmod=None):
+    """Get the MAC signature for a request given as bytes components.
+
+    This function calculates the same signature as get_signature(), for
+    callers that already hold the relevant parts of the request as bytes,
+    such as the headers of an ASGI scope.  All of the arguments apart from
+    "hashmod" must be bytes, and the signature is returned as base64-encoded
+    bytes, so that no conversions to or from str are needed.  Compare it
+    against the request's mac using hmac.compare_digest().
+
+    See utils.update_normalized_request() for details of the arguments.
+    """
+    if hashmod is None:
+        hashmod = sha1
+    hasher = hmac.new(key, None, hashmod)
+    utils.update_normalized_request(hasher, ts, nonce, method, path_qs, host,
+                                    scheme, ext)
+    return base64.b64encode(hasher.digest())
 
 
 @utils.normalize_request_object
-def check_signature(request, key, hashmod=None, params=None, nonces=None):
+def check_signature(request, key, hashmod=None, params=None, nonces=None,
+                    keycache=None):
     """Check that the request is correctly signed with the given MAC key.
 
     This function checks the MAC signature in the given request against its
@@ -128,14 +199,20 @@ def check_signature(request, key, hashmod=None, params=None, nonces=None):
     used to check validity of the signature nonce.  If not specified then a
     default global cache will be used.  To disable nonce checking (e.g. during
     testing) pass nonces=False.
+
+    If the "keycache" parameter is not None, it must be an HMACKeyCache
+    object to be used when calculating the expected signature.
     """
     global DEFAULT_NONCE_CACHE
     if nonces is None:
         nonces = DEFAULT_NONCE_CACHE
         if nonces is None:
             nonces = DEFAULT_NONCE_CACHE = NonceCache()
+    timer = instrument.current()
     if params is None:
         params = utils.parse_authz_header(request, {})
+        if timer is not None:
+            timer.stage(instrument.STAGE_PARSE)
     if params.get("scheme") != "MAC":
         return False
     # Any KeyError here indicates a missing parameter.
@@ -145,15 +222,47 @@ def check_signature(request, key, hashmod=None, params=None, nonces=None):
         timestamp = int(params["ts"])
         nonce = params["nonce"]
         # Check validity of the signature.
-        expected_sig = get_signature(request, key, hashmod, params)
-        if utils.strings_differ(params["mac"], expected_sig):
+        expected_sig = get_signature(request, key, hashmod, params, keycache)
+        if timer is not None:
+            timer.stage(instrument.STAGE_SIGNATURE)
+        differ = utils.strings_differ(params["mac"], expected_sig)
+        if timer is not None:
+            timer.stage(instrument.STAGE_COMPARE)
+        if differ:
             return False
         # Check freshness of the nonce.
         # This caches it so future use of the nonce will fail.
         # We do this *after* successul sig check to avoid DOS attacks.
         if nonces is not False:
-            if not nonces.check_nonce(id, timestamp, nonce):
+            fresh = nonces.check_nonce(id, timestamp, nonce)
+            if timer is not None:
+                timer.stage(instrument.STAGE_NONCE)
+            if not fresh:
                 return False
     except (KeyError, ValueError):
         return False
     return True
+
+
+def check_signatures(requests, key_lookup, hashmod=None, nonces=None,
+                     executor=None, chunk_size=None):
+    """Check the signatures on a batch of requests.
+
+    This function verifies each of the given requests, yielding a
+    VerifyResult for each in turn.  Since the secret keys for a batch
+    of requests are likely to differ, the "key_lookup" argument must be a
+    callable mapping each MAC id to its secret key, or to None if the id
+    is unknown.
+
+    The "nonces" parameter has the same meaning as for check_signature().
+    If the "executor" parameter is given, it must be a concurrent.futures
+    Executor used to calculate the signatures for large batches.  See
+    Verifier.verify_many() for details.
+    """
+    global DEFAULT_NONCE_CACHE
+    if nonces is None:
+        nonces = DEFAULT_NONCE_CACHE
+        if nonces is None:
+            nonces = DEFAULT_NONCE_CACHE = NonceCache()
+    verifier = Verifier(key_lookup, hashmod, nonces)
+    return verifier.verify_many(requests, executor, chunk_size)
@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Asyncio-native request verification for macauthlib.
+
+This module provides coroutine versions of the server-side verification
+API, for use in asyncio-based servers.  Secret keys are obtained from an
+async key lookup function, and nonces are checked against an async nonce
+store, so verification never blocks the event loop.
+
+An async nonce store is any object with a coroutine method like this::
+
+    async def check_nonce(self, id, timestamp, nonce, now=None):
+        ...
+
+Ordinary NonceCache objects are adapted to this protocol automatically.
+
+This module requires Python 3.5 or later.
+
+"""
+
+import asyncio
+import inspect
+import weakref
+
+import macauthlib
+from macauthlib import utils
+from macauthlib.noncecache import (NonceCache,
+                                   DEFAULT_SWEEP_INTERVAL,
+                                   DEFAULT_SWEEP_BUDGET)
+from macauthlib.verifier import (Verifier,
+                                 VerifyResult,
+                                 STATUS_OK,
+                                 STATUS_REJECTED,
+                                 REASON_MALFORMED,
+                                 REASON_UNKNOWN_ID,
+                                 REASON_BAD_SIGNATURE,
+                                 REASON_NONCE)
+
+
+# Key lookups in progress from check_signature(), for each event loop.
+_PENDING_LOOKUPS = weakref.WeakKeyDictionary()
+
+
+class AsyncNonceCache(object):
+    """Adapter exposing a NonceCache through the async nonce-store protocol.
+
+    NonceCache operations are in-memory and only hold their lock briefly,
+    so it's safe to call them directly from the event loop.
+    """
+
+    def __init__(self, nonces=None):
+        if nonces is None:
+            nonces = NonceCache()
+        self.nonces = nonces
+        self.clock = getattr(nonces, "clock", None)
+
+    async def check_nonce(self, id, timestamp, nonce, now=None):
+        return self.nonces.check_nonce(id, timestamp, nonce, now)
+
+
+class CoalescingKeyLookup(object):
+    """Wrapper for an async key lookup that coalesces concurrent calls.
+
+    If several coroutines look up the key for the same id at the same time,
+    only a single call is made to the underlying lookup function and they
+    all await its result.  Results are not cached once the call completes.
+
+    The optional "pending" argument is a dict in which to record lookups in
+    progress.  Wrappers sharing the same dict also coalesce lookups made
+    through each other for the same function and id.
+    """
+
+    def __init__(self, key_lookup, pending=None):
+        if pending is None:
+            pending = {}
+        self.key_lookup = key_lookup
+        self._pending = pending
+
+    async def __call__(self, id):
+        key = (self.key_lookup, id)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(key))
+            self._pending[key] = future
+        # Shield the shared lookup, so that cancelling one waiter
+        # doesn't cancel it for all the others.
+        return await asyncio.shield(future)
+
+    async def _lookup(self, key):
+        try:
+            return await self.key_lookup(key[1])
+        finally:
+            del self._pending[key]
+
+
+def _as_nonce_store(nonces):
+    """Adapt the given object to the async nonce-store protocol."""
+    if nonces is False or inspect.iscoroutinefunction(nonces.check_nonce):
+        return nonces
+    return AsyncNonceCache(nonces)
+
+
+class AsyncVerifier(object):
+    """Object for verifying signed requests from a coroutine.
+
+    This class is the asyncio equivalent of macauthlib.Verifier.  The
+    "key_lookup" argument must be a coroutine function taking a MAC id and
+    returning the corresponding secret key, or None if the id is unknown;
+    concurrent lookups for the same id are coalesced into a single call.
+    The "nonces" argument may be an async nonce store, a NonceCache, or
+    False to disable nonce checking.  The other arguments are as for
+    Verifier.
+    """
+
+    def __init__(self, key_lookup, hashmod=None, nonces=None, clock=None,
+                 keycache=None, max_skew=None):
+        if nonces is None:
+            nonces = NonceCache()
+        if not isinstance(key_lookup, CoalescingKeyLookup):
+            key_lookup = CoalescingKeyLookup(key_lookup)
+        self.key_lookup = key_lookup
+        self.nonces = _as_nonce_store(nonces)
+        if clock is None:
+            clock = getattr(self.nonces, "clock", None)
+        # The synchronous stages of verification are shared with Verifier.
+        self._verifier = Verifier(None, hashmod, False, clock, keycache,
+                                  max_skew)
+        self.rejections = self._verifier.rejections
+
+    async def verify(self, request):
+        """Verify the signature on the given request.
+
+        This coroutine returns a VerifyResult giving the claimed id and
+        whether the request was correctly signed.
+        """
+        verifier = self._verifier
+        now = verifier.clock()
+        parsed = verifier._parse(request, now)
+        if parsed.__class__ is VerifyResult:
+            return parsed
+        (id, timestamp, nonce, mac, sigstr) = parsed
+        try:
+            key = await self.key_lookup(id)
+        except KeyError:
+            key = None
+        if key is None:
+            return VerifyResult(id, STATUS_REJECTED, REASON_UNKNOWN_ID)
+        sig = verifier._compute_signature(id, key, sigstr)
+        if sig is None:
+            return VerifyResult(id, STATUS_REJECTED, REASON_MALFORMED)
+        if utils.strings_differ(mac, sig):
+            return VerifyResult(id, STATUS_REJECTED, REASON_BAD_SIGNATURE)
+        # Check freshness of the nonce.
+        # We do this *after* successul sig check to avoid DOS attacks.
+        nonces = self.nonces
+        if nonces is not False:
+            if not await nonces.check_nonce(id, timestamp, nonce, now):
+                return VerifyResult(id, STATUS_REJECTED, REASON_NONCE)
+        return VerifyResult(id, STATUS_OK)
+
+
+async def check_signature(request, key_lookup, hashmod=None, nonces=None):
+    """Check that the request is correctly signed, without blocking.
+
+    This coroutine is the asyncio equivalent of macauthlib.check_signature().
+    Rather than taking the key directly, it takes a coroutine function
+    "key_lookup" which is awaited to find the key for the claimed id.
+    Concurrent calls with the same "key_lookup" on the same event loop share
+    a single lookup for each id.
+
+    If the "nonces" parameter is not None, it must be an async nonce store
+    or a NonceCache object.  If not specified then the default global cache
+    of macauthlib.check_signature() will be used, so that both functions
+    share a single replay window.  To disable nonce checking pass
+    nonces=False.
+    """
+    if nonces is None:
+        nonces = macauthlib.DEFAULT_NONCE_CACHE
+        if nonces is None:
+            nonces = macauthlib.DEFAULT_NONCE_CACHE = NonceCache()
+    if not isinstance(key_lookup, CoalescingKeyLookup):
+        loop = asyncio.get_event_loop()
+        pending = _PENDING_LOOKUPS.get(loop)
+        if pending is None:
+            pending = _PENDING_LOOKUPS[loop] = {}
+        key_lookup = CoalescingKeyLookup(key_lookup, pending)
+    verifier = AsyncVerifier(key_lookup, hashmod, nonces)
+    result = await verifier.verify(request)
+    return result.ok
+
+
+async def sweep_forever(target, interval=None, budget=None):
+    """Periodically reclaim expired items from a nonce cache.
+
+    This coroutine is the asyncio equivalent of macauthlib.noncecache.Sweeper.
+    It calls target.sweep() every "interval" seconds with the given budget,
+    so each sweep only blocks the event loop for a bounded time.  Run it as
+    a task and cancel the task to stop sweeping.
+    """
+    if interval is None:
+        interval = DEFAULT_SWEEP_INTERVAL
+    if budget is None:
+        budget = DEFAULT_SWEEP_BUDGET
+    while True:
+        await asyncio.sleep(interval)
+        target.sweep(budget=budget)
@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for managing used nonces in fixed memory with rotating Bloom filters.
+
+"""
+
+import os
+import math
+import struct
+import hashlib
+import threading
+
+from macauthlib.clock import DEFAULT_CLOCK
+from macauthlib.noncecache import (Cache,
+                                   KeyExistsError,
+                                   DEFAULT_NONCE_TTL,
+                                   DEFAULT_ID_TTL)
+
+
+DEFAULT_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.0001
+DEFAULT_MAX_IDS = 100000
+
+
+class BloomFilter(object):
+    """A simple Bloom filter over 16-byte digests.
+
+    The filter is sized to hold "capacity" items with the given false
+    positive rate.  Bit positions are derived from each digest by double
+    hashing, so callers must supply well-mixed digests.
+    """
+
+    def __init__(self, capacity, error_rate):
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = max(8, int(math.ceil(num_bits)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, digest):
+        (h1, h2) = struct.unpack("=QQ", digest)
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        for pos in self._positions(digest):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, digest):
+        bits = self.bits
+        for pos in self._positions(digest):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def clear(self):
+        self.bits[:] = bytearray(len(self.bits))
+
+    def copy(self):
+        """Get an independent copy of the filter."""
+        other = self.__class__.__new__(self.__class__)
+        other.num_bits = self.num_bits
+        other.num_hashes = self.num_hashes
+        other.bits = bytearray(self.bits)
+        return other
+
+    def fill_ratio(self):
+        """Get the fraction of bits in the filter that are set."""
+        set_bits = bin(int.from_bytes(self.bits, "big")).count("1")
+        return set_bits / float(self.num_bits)
+
+    def error_rate(self):
+        """Estimate the current false positive rate from the fill ratio."""
+        return self.fill_ratio() ** self.num_hashes
+
+
+class BloomNonceCache(object):
+    """Object for managing used nonces in fixed memory.
+
+    This class provides the same check_nonce() interface as NonceCache, but
+    records nonces in a pair of Bloom filters rather than storing them.  Its
+    memory use is fixed by the "capacity" and "error_rate" arguments no
+    matter how much traffic it sees, and unlike the max_size option of
+    NonceCache it never forgets a nonce while it is inside the window.
+
+    The price is a small chance of rejecting a fresh nonce as a replay.
+    The filters are sized so that this false-reject rate stays below
+    "error_rate" as long as no more than "capacity" nonces are seen in any
+    period of 2 * nonce_ttl.  The configured rate is available as the
+    "error_rate" attribute, and the estimated current rate from the
+    observed_error_rate() method.
+
+    Each filter covers nonces whose timestamps fall in one generation of
+    length 2 * nonce_ttl.  Since the window of acceptable timestamps is
+    2 * nonce_ttl wide it never spans more than two generations, and the
+    filter for an old generation is only cleared for reuse once all of its
+    timestamps have expired.  As a result nonces may be remembered for up to
+    3 * nonce_ttl, which is harmless since fresh nonces are random.
+
+    Per-id clock skews are kept in an ordinary Cache limited to "max_ids"
+    entries.  The optional clock argument is as for NonceCache.
+    """
+
+    def __init__(self, nonce_ttl=None, id_ttl=None, capacity=None,
+                 error_rate=None, max_ids=None, clock=None):
+        if nonce_ttl is None:
+            nonce_ttl = DEFAULT_NONCE_TTL
+        if id_ttl is None:
+            id_ttl = DEFAULT_ID_TTL
+        if capacity is None:
+            capacity = DEFAULT_CAPACITY
+        if error_rate is None:
+            error_rate = DEFAULT_ERROR_RATE
+        if max_ids is None:
+            max_ids = DEFAULT_MAX_IDS
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.nonce_ttl = nonce_ttl
+        self.id_ttl = id_ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clock = clock
+        self.generation_width = 2.0 * nonce_ttl
+        self._lock = threading.Lock()
+        self._ids = Cache(id_ttl, max_ids, self._lock, clock)
+        # A lookup may probe both filters, so each gets half the error rate.
+        # Each entry is a list giving [generation number, filter].
+        self._filters = [[None, BloomFilter(capacity, error_rate / 2.0)]
+                         for _ in range(2)]
+        self._hash_key = os.urandom(16)
+
+    def _digest(self, id, nonce):
+        data = id.encode("utf8") + b"\0" + nonce.encode("utf8")
+        return hashlib.blake2b(data, digest_size=16,
+                               key=self._hash_key).digest()
+
+    def observed_error_rate(self):
+        """Estimate the current chance of rejecting a fresh nonce.
+
+        This is calculated from the fill ratios of the filters that are
+        currently in use.  The filters are copied under the lock and
+        examined outside it, so this doesn't stall concurrent checks.
+        """
+        with self._lock:
+            live = [bloom.copy() for (generation, bloom)
+                    in self._filters if generation is not None]
+        accept_rate = 1.0
+        for bloom in live:
+            accept_rate *= 1.0 - bloom.error_rate()
+        return 1.0 - accept_rate
+
+    def check_nonce(self, id, timestamp, nonce, now=None):
+        """Check if the given timestamp+nonce is fresh for the given id.
+
+        See NonceCache.check_nonce() for details.
+        """
+        if now is None:
+            now = self.clock()
+        digest = self._digest(id, nonce)
+        ttl = self.nonce_ttl
+        width = self.generation_width
+        with self._lock:
+            # Get the clock skew to use for calculations.
+            # If no skew is cached, calculate it.
+            try:
+                skew = self._ids.get(id, now)
+            except KeyError:
+                skew = now - timestamp
+                try:
+                    self._ids.set_locked(id, skew, now)
+                except KeyExistsError as exc:   # pragma nocover
+                    skew = exc.value            # pragma nocover
+            # If the adjusted timestamp is too old or too new, then
+            # we can reject it without even looking at the nonce.
+            timestamp = timestamp + skew
+            if abs(timestamp - now) >= ttl:
+                return False
+            # Check the filters for any generation inside the window.
+            first = int((now - ttl) // width)
+            last = int((now + ttl) // width)
+            for generation in range(first, last + 1):
+                (filter_generation, bloom) = self._filters[generation % 2]
+                if filter_generation == generation and digest in bloom:
+                    return False
+            # The nonce is fresh, add it to its generation's filter,
+            # clearing out an expired generation if necessary.
+            generation = int(timestamp // width)
+            entry = self._filters[generation % 2]
+            if entry[0] != generation:
+                entry[1].clear()
+                entry[0] = generation
+            entry[1].add(digest)
+        return True
+
+    def check_nonces(self, items, now=None):
+        """Check a batch of (id, timestamp, nonce) tuples for freshness.
+
+        This is equivalent to calling check_nonce() on each item in turn.
+        """
+        if now is None:
+            now = self.clock()
+        check_nonce = self.check_nonce
+        return [check_nonce(id, timestamp, nonce, now)
+                for (id, timestamp, nonce) in items]
@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Clock sources for macauthlib.
+
+A clock is any callable taking no arguments and returning the current time
+as a float number of seconds since the epoch, like time.time().  Objects
+that need the time, such as NonceCache and Verifier, accept a "clock"
+argument so that the time source can be chosen by the application.
+
+"""
+
+import time
+import threading
+
+from macauthlib.utils import register_fork_hooks
+
+
+DEFAULT_RESOLUTION = 0.01
+
+
+class MonotonicClock(object):
+    """Wall clock that is immune to adjustments of the system time.
+
+    This clock reads the system time once when it is created, and from then
+    on advances it using time.monotonic().  If the system time is later
+    stepped backwards or forwards, times from this clock keep advancing
+    smoothly, so cached expiry times and clock skews remain valid.
+    """
+
+    def __init__(self):
+        self.anchor = time.time() - time.monotonic()
+
+    def __call__(self):
+        return self.anchor + time.monotonic()
+
+
+class CoarseClock(object):
+    """Clock that reads an underlying clock at most once per tick.
+
+    Calling this clock returns the time as of the most recent tick, which
+    is cheaper than reading the underlying clock and gives the same value
+    to everything that happens within a tick.  Ticks happen every
+    "resolution" seconds in a daemon thread, which is started the first
+    time the clock is called and restarted in the child after a fork.
+    Call stop() to end the thread.
+    """
+
+    def __init__(self, clock=None, resolution=None):
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        if resolution is None:
+            resolution = DEFAULT_RESOLUTION
+        self.clock = clock
+        self.resolution = resolution
+        self.now = clock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        register_fork_hooks(self, after_in_child="_after_fork_child")
+
+    def __call__(self):
+        if self._thread is None:
+            self.start()
+        return self.now
+
+    def tick(self):
+        """Read the underlying clock, updating the current time."""
+        self.now = self.clock()
+
+    def start(self):
+        """Start updating the time in a background daemon thread."""
+        with self._lock:
+            if self._thread is None:
+                self.tick()
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, waiting for it to exit."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stopped.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.wait(self.resolution):
+            self.tick()
+
+    def _after_fork_child(self):
+        # The ticking thread doesn't survive the fork, so make sure a new
+        # one is started on next use.
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.tick()
+
+
+class FakeClock(object):
+    """Clock that only changes when told to, for tests and benchmarks."""
+
+    def __init__(self, now=None):
+        if now is None:
+            now = time.time()
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """Move the clock forward by the given number of seconds."""
+        self.now += seconds
+
+    def set(self, now):
+        """Set the clock to the given time."""
+        self.now = now
+
+
+# The clock used by default for server-side checks.  Python versions
+# without time.monotonic() fall back to the system time.
+if hasattr(time, "monotonic"):
+    DEFAULT_CLOCK = MonotonicClock()
+else:  # pragma: nocover
+    DEFAULT_CLOCK = time.time
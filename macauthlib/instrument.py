@@ -0,0 +1,243 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Optional timing instrumentation for macauthlib.
+
+The signing and verification functions can report how long they spend in
+each stage of their work.  To receive these reports, register a hook with
+add_hook() or the instrumented() context manager.  A hook is any callable
+taking these arguments::
+
+    hook(operation, stage, duration, outcome)
+
+where "operation" is the name of the public function being timed (e.g.
+"check_signature"), "stage" is one of the STAGE_* constants, "duration" is
+the time spent in that stage in seconds, and "outcome" is None except for
+the final STAGE_TOTAL report.  That gives the function's result if it
+returns a bool (as check_signature() does), "error" if it raised an
+exception, and True otherwise.
+
+When no hooks are registered the only overhead is a single check per call.
+The StageStats class is a ready-made hook that aggregates the reports into
+histograms, and can render them in the Prometheus text exposition format.
+
+"""
+
+import time
+import bisect
+import threading
+import contextlib
+
+
+STAGE_NORMALIZE = "normalize"   # conversion of the request object
+STAGE_PARSE = "parse"           # parsing the Authorization header
+STAGE_STRING = "string"         # building the normalized request string
+STAGE_HMAC = "hmac"             # calculating the signature
+STAGE_SIGNATURE = "signature"   # calling get_signature() from another API
+STAGE_COMPARE = "compare"       # comparing against the expected signature
+STAGE_NONCE = "nonce"           # checking the nonce cache
+STAGE_HEADER = "header"         # serializing the Authorization header
+STAGE_TOTAL = "total"           # the whole operation
+
+# Upper bounds of the histogram buckets used by StageStats, in seconds.
+DEFAULT_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025,
+                   0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1)
+
+# Timer for measuring stage durations, where available.
+_timer = getattr(time, "perf_counter", time.time)
+
+# The currently-registered hooks.  Replaced rather than mutated, so that
+# readers never need to take a lock.
+_hooks = ()
+_hooks_lock = threading.Lock()
+
+# Per-thread stack of the StageTimers for operations in progress.
+_local = threading.local()
+
+
+def add_hook(hook):
+    """Register a hook to receive stage timing reports."""
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook):
+    """Unregister a previously-registered hook."""
+    global _hooks
+    with _hooks_lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = tuple(hooks)
+
+
+@contextlib.contextmanager
+def instrumented(hook):
+    """Context manager registering a hook for the duration of a block."""
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+class StageTimer(object):
+    """Object reporting the time taken by successive stages of an operation.
+
+    Each call to stage() reports the time since the previous call, or since
+    the timer was created, to all the registered hooks.  Timers are created
+    by start(), and must be finished by calling finish().
+    """
+
+    __slots__ = ("operation", "hooks", "start", "last")
+
+    def __init__(self, operation, hooks):
+        self.operation = operation
+        self.hooks = hooks
+        self.start = self.last = _timer()
+
+    def stage(self, stage):
+        """Report the end of the given stage."""
+        now = _timer()
+        for hook in self.hooks:
+            hook(self.operation, stage, now - self.last, None)
+        self.last = now
+
+    def finish(self, outcome=True):
+        """Report the end of the whole operation, with its outcome."""
+        now = _timer()
+        for hook in self.hooks:
+            hook(self.operation, STAGE_TOTAL, now - self.start, outcome)
+        self.last = now
+        _local.timers.remove(self)
+
+
+def start(operation):
+    """Get a StageTimer for the given operation, or None if not needed.
+
+    Instrumented code calls this at the start of each operation, and only
+    reports stages if it returns a timer.  The timer becomes the current
+    timer for this thread until it is finished.
+    """
+    hooks = _hooks
+    if not hooks:
+        return None
+    timer = StageTimer(operation, hooks)
+    try:
+        _local.timers.append(timer)
+    except AttributeError:
+        _local.timers = [timer]
+    return timer
+
+
+def current():
+    """Get the StageTimer for the innermost operation in progress, if any."""
+    if not _hooks:
+        return None
+    timers = getattr(_local, "timers", None)
+    if not timers:
+        return None
+    return timers[-1]
+
+
+class StageStats(object):
+    """Hook aggregating stage timings into histograms.
+
+    Register an instance with add_hook() to collect a histogram of the
+    durations of each (operation, stage) pair, along with a count of the
+    outcomes of each operation.  Use render_prometheus() to expose the
+    results to a Prometheus server, or summary() for approximate quantiles.
+    """
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = DEFAULT_BUCKETS
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Maps (operation, stage) to [bucket counts, total duration].
+        self._histograms = {}
+        # Maps (operation, outcome) to count.
+        self._outcomes = {}
+
+    def __call__(self, operation, stage, duration, outcome):
+        index = bisect.bisect_left(self.buckets, duration)
+        key = (operation, stage)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(self.buckets) + 1), 0.0]
+                self._histograms[key] = histogram
+            histogram[0][index] += 1
+            histogram[1] += duration
+            if stage == STAGE_TOTAL:
+                key = (operation, outcome)
+                self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def clear(self):
+        """Discard all collected statistics."""
+        with self._lock:
+            self._histograms.clear()
+            self._outcomes.clear()
+
+    def summary(self):
+        """Get a summary of the collected timings.
+
+        This returns a dict mapping (operation, stage) tuples to dicts giving
+        the "count" and "mean" of the durations, and upper bounds on their
+        "p50", "p90" and "p99" quantiles taken from the histogram buckets.
+        Quantiles beyond the largest bucket are given as infinity.
+        """
+        with self._lock:
+            histograms = [(key, list(counts), total) for
+                          (key, (counts, total)) in self._histograms.items()]
+        bounds = self.buckets + (float("inf"),)
+        summary = {}
+        for (key, counts, total) in histograms:
+            count = sum(counts)
+            info = {"count": count, "mean": total / count}
+            for (name, quantile) in (("p50", 0.5), ("p90", 0.9),
+                                     ("p99", 0.99)):
+                target = quantile * count
+                seen = 0
+                for (bound, bucket_count) in zip(bounds, counts):
+                    seen += bucket_count
+                    if seen >= target:
+                        info[name] = bound
+                        break
+            summary[key] = info
+        return summary
+
+    def render_prometheus(self, prefix="macauthlib"):
+        """Render the collected statistics in Prometheus text format."""
+        with self._lock:
+            histograms = sorted((key, list(counts), total) for
+                                (key, (counts, total))
+                                in self._histograms.items())
+            outcomes = sorted(self._outcomes.items(), key=repr)
+        lines = []
+        name = prefix + "_stage_duration_seconds"
+        lines.append("# HELP %s Time spent in each stage of an operation."
+                     % (name,))
+        lines.append("# TYPE %s histogram" % (name,))
+        for ((operation, stage), counts, total) in histograms:
+            labels = 'operation="%s",stage="%s"' % (operation, stage)
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%r"} %d'
+                             % (name, labels, bound, cumulative))
+            cumulative += counts[-1]
+            lines.append('%s_bucket{%s,le="+Inf"} %d'
+                         % (name, labels, cumulative))
+            lines.append("%s_sum{%s} %r" % (name, labels, total))
+            lines.append("%s_count{%s} %d" % (name, labels, cumulative))
+        name = prefix + "_outcomes_total"
+        lines.append("# HELP %s Outcomes of each operation." % (name,))
+        lines.append("# TYPE %s counter" % (name,))
+        for ((operation, outcome), count) in outcomes:
+            lines.append('%s{operation="%s",outcome="%s"} %d'
+                         % (name, operation, str(outcome).lower(), count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for caching pre-initialised HMAC objects for each MAC id.
+
+"""
+
+import time
+import hmac
+import threading
+import collections
+
+
+DEFAULT_KEY_TTL = 300   # five minutes
+
+
+KeyCacheItem = collections.namedtuple("KeyCacheItem",
+                                      "key hashmod hmac timestamp")
+
+
+class HMACKeyCache(object):
+    """A size-bounded cache of pre-initialised HMAC objects for each id.
+
+    Creating an HMAC object involves deriving the inner and outer padded key
+    blocks from the secret key.  This class does that work once per id, and
+    hands out copies of the resulting HMAC object that are ready to have the
+    message fed in.
+
+    Entries are evicted when they are older than the given ttl, or in
+    least-recently-used order when the cache grows beyond max_size.  Since
+    each entry remembers the key it was built from, a cached entry is never
+    used with a different key; but servers rotating keys should still call
+    invalidate() so that the old key material is dropped promptly.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        assert max_size > 0
+        if ttl is None:
+            ttl = DEFAULT_KEY_TTL
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_hmac(self, id, key, hashmod):
+        """Get a fresh HMAC object for the given id, key and hash module.
+
+        The returned object has had no message data fed into it, and may be
+        freely updated by the caller.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.pop(id, None)
+            if item is not None:
+                if item.key == key and item.hashmod is hashmod:
+                    if item.timestamp + self.ttl >= now:
+                        self._items[id] = item
+                        return item.hmac.copy()
+        # The spec mandates that ids and keys must be ascii.
+        mac = hmac.new(key.encode("ascii"), None, hashmod)
+        item = KeyCacheItem(key, hashmod, mac, now)
+        with self._lock:
+            self._items[id] = item
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return mac.copy()
+
+    def invalidate(self, id):
+        """Remove any cached HMAC state for the given id."""
+        with self._lock:
+            self._items.pop(id, None)
+
+    def clear(self):
+        """Remove all cached HMAC state."""
+        with self._lock:
+            self._items.clear()
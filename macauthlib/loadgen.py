@@ -0,0 +1,324 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Synthetic signed traffic for load testing and profiling.
+
+The TrafficGenerator class produces a stream of requests signed with
+sign_request(), mixing in replayed nonces, stale timestamps, malformed
+Authorization headers and large query strings in controllable proportions.
+Requests are spread over a population of ids whose popularity follows a
+Zipf-like distribution, and each id has its own clock offset.
+
+The output depends only on the generator's arguments, so a given seed and
+"now" always give the same requests.  To verify them, use a clock that
+returns the same "now", e.g. macauthlib.clock.FakeClock.
+
+This module can also be run as a script to write requests to a file, as
+JSON lines holding WSGI environs or as raw HTTP/1.1 requests::
+
+    python -m macauthlib.loadgen --count 1000000 --seed 42 -o traffic.http
+
+"""
+
+import sys
+import json
+import time
+import random
+import bisect
+import argparse
+import collections
+
+from macauthlib import sign_request, utils
+from macauthlib.noncecache import DEFAULT_NONCE_TTL
+
+
+# Values for the "kind" attribute of a GeneratedRequest.
+KIND_VALID = "valid"              # correctly signed with a fresh nonce
+KIND_LARGE_QUERY = "large-query"  # correctly signed, with a long query
+KIND_REPLAY = "replay"            # exact copy of an earlier valid request
+KIND_STALE = "stale"              # correctly signed, but ts is too old
+KIND_MALFORMED = "malformed"      # unparseable or incomplete header
+
+# Whether a request of each kind should pass verification.
+EXPECTED = {
+    KIND_VALID: True,
+    KIND_LARGE_QUERY: True,
+    KIND_REPLAY: False,
+    KIND_STALE: False,
+    KIND_MALFORMED: False,
+}
+
+DEFAULT_NUM_IDS = 1000
+DEFAULT_ID_SKEW = 1.0
+DEFAULT_MAX_CLOCK_OFFSET = 300
+DEFAULT_QUERY_SIZE = 4096
+
+# Number of recent valid requests kept as candidates for replay.
+REPLAY_POOL_SIZE = 1000
+
+# Maximum random jitter added to each timestamp, in seconds.
+MAX_JITTER = 2
+
+HOST = "example.com"
+
+# Templates for malformed Authorization headers.
+MALFORMED_HEADERS = (
+    'MAC id="%(id)s", ts="%(ts)s", nonce="%(nonce)s", mac="',
+    'MAC id="%(id)s", ts="%(ts)s", nonce="%(nonce)s"',
+    'MAC id="%(id)s" ts="%(ts)s" nonce="%(nonce)s" mac="AAAA"',
+    'MAC id=%(id)s, ts=%(ts)s, nonce=%(nonce)s, mac=AAAA',
+    'MAC id="%(id)s", ts="%(ts)s", ts="%(ts)s", nonce="%(nonce)s"',
+    'MAC id="%(id)s", ts="%(ts)s", nonce="%(nonce)s", mac="!!!!"',
+    'MAC id="%(id)s", ts="soon", nonce="%(nonce)s", mac="AAAA"',
+    'MAC',
+    'MAC ,,,,',
+    'MAC "%(id)s"',
+)
+
+
+GeneratedRequest = collections.namedtuple("GeneratedRequest",
+                                          ["kind", "id", "environ"])
+
+
+class TrafficGenerator(object):
+    """Deterministic generator of signed requests.
+
+    The "num_ids" argument gives the number of distinct ids, and "id_skew"
+    the exponent of their Zipf-like popularity; zero makes all ids equally
+    likely.  Each id's clock is offset from "now" by up to
+    "max_clock_offset" seconds in either direction.
+
+    The "replay_rate", "stale_rate", "malformed_rate" and "large_query_rate"
+    arguments give the fraction of requests of each kind, with the rest
+    being ordinary valid requests.  Large query strings are "query_size"
+    bytes long, and stale timestamps are older than "nonce_ttl".
+
+    Keys for each id are available from the key_lookup() method.
+    """
+
+    def __init__(self, seed=0, now=None, num_ids=None, id_skew=None,
+                 max_clock_offset=None, replay_rate=0.0, stale_rate=0.0,
+                 malformed_rate=0.0, large_query_rate=0.0, query_size=None,
+                 nonce_ttl=None, hashmod=None):
+        if now is None:
+            now = int(time.time())
+        if num_ids is None:
+            num_ids = DEFAULT_NUM_IDS
+        if id_skew is None:
+            id_skew = DEFAULT_ID_SKEW
+        if max_clock_offset is None:
+            max_clock_offset = DEFAULT_MAX_CLOCK_OFFSET
+        if query_size is None:
+            query_size = DEFAULT_QUERY_SIZE
+        if nonce_ttl is None:
+            nonce_ttl = DEFAULT_NONCE_TTL
+        if replay_rate + stale_rate + malformed_rate + large_query_rate > 1:
+            raise ValueError("request kind rates must not exceed one")
+        self.seed = seed
+        self.now = now
+        self.query_size = query_size
+        self.nonce_ttl = nonce_ttl
+        self.hashmod = hashmod
+        self._rng = random.Random(seed)
+        rng = self._rng
+        # Give each id a key and a clock offset.
+        self.ids = ["id%d" % (i,) for i in range(num_ids)]
+        self.keys = {}
+        self.offsets = {}
+        for id in self.ids:
+            self.keys[id] = self._random_token(20)
+            self.offsets[id] = rng.randint(-max_clock_offset,
+                                           max_clock_offset)
+        # Cumulative weights for picking ids by popularity.
+        self._id_weights = []
+        total = 0.0
+        for rank in range(1, num_ids + 1):
+            total += 1.0 / rank ** id_skew
+            self._id_weights.append(total)
+        # Cumulative rates for picking the kind of each request.
+        self._kinds = []
+        total = 0.0
+        for (kind, rate) in ((KIND_REPLAY, replay_rate),
+                             (KIND_STALE, stale_rate),
+                             (KIND_MALFORMED, malformed_rate),
+                             (KIND_LARGE_QUERY, large_query_rate)):
+            if rate > 0:
+                total += rate
+                self._kinds.append((total, kind))
+        self._replay_pool = []
+        self._seen_ids = set()
+        self._counter = 0
+
+    def key_lookup(self, id):
+        """Get the key for the given id, or None if it is unknown."""
+        return self.keys.get(id)
+
+    def _random_token(self, size):
+        rng = self._rng
+        return utils.b64encode(bytes(rng.getrandbits(8) for _ in range(size)))
+
+    def _pick_id(self):
+        weights = self._id_weights
+        target = self._rng.random() * weights[-1]
+        return self.ids[bisect.bisect_right(weights, target)]
+
+    def _pick_kind(self):
+        if self._kinds:
+            target = self._rng.random()
+            for (threshold, kind) in self._kinds:
+                if target < threshold:
+                    return kind
+        return KIND_VALID
+
+    def _make_environ(self, query):
+        rng = self._rng
+        self._counter += 1
+        return {
+            "wsgi.url_scheme": "http",
+            "REQUEST_METHOD": rng.choice(("GET", "GET", "POST", "PUT")),
+            "SCRIPT_NAME": "",
+            "PATH_INFO": "/resource/%d" % (rng.randint(0, 99999),),
+            "QUERY_STRING": query,
+            "SERVER_NAME": HOST,
+            "SERVER_PORT": "80",
+            "HTTP_HOST": HOST,
+        }
+
+    def _make_query(self, size):
+        rng = self._rng
+        items = []
+        length = -1
+        while length < size:
+            item = "p%d=%s" % (len(items), self._random_token(12))
+            item = item.replace("+", "-").replace("/", "_").rstrip("=")
+            items.append(item)
+            length += len(item) + 1
+        rng.shuffle(items)
+        return "&".join(items)
+
+    def _sign(self, environ, id, ts):
+        params = {"ts": str(ts), "nonce": self._random_token(6)}
+        sign_request(environ, id, self.keys[id], self.hashmod, params)
+
+    def generate(self, count):
+        """Generate the given number of GeneratedRequest tuples."""
+        for _ in range(count):
+            yield self.next_request()
+
+    def next_request(self):
+        """Generate a single GeneratedRequest tuple."""
+        rng = self._rng
+        kind = self._pick_kind()
+        id = self._pick_id()
+        # Replays and stale timestamps are only meaningful for ids that
+        # have already been seen, since the nonce cache learns each id's
+        # clock offset from its first request.
+        if kind == KIND_REPLAY:
+            if not self._replay_pool:
+                kind = KIND_VALID
+            else:
+                request = rng.choice(self._replay_pool)
+                return GeneratedRequest(kind, request.id,
+                                        dict(request.environ))
+        if kind == KIND_STALE and id not in self._seen_ids:
+            kind = KIND_VALID
+        ts = self.now + self.offsets[id] + rng.randint(-MAX_JITTER, MAX_JITTER)
+        if kind == KIND_LARGE_QUERY:
+            environ = self._make_environ(self._make_query(self.query_size))
+        else:
+            environ = self._make_environ("a=%d&b=%d" % (rng.randint(0, 9),
+                                                        self._counter))
+        if kind == KIND_MALFORMED:
+            template = rng.choice(MALFORMED_HEADERS)
+            environ["HTTP_AUTHORIZATION"] = template % {
+                "id": id, "ts": ts, "nonce": self._random_token(6)}
+            return GeneratedRequest(kind, id, environ)
+        if kind == KIND_STALE:
+            # Allow for the jitter in the id's first timestamp as well.
+            ts -= self.nonce_ttl + 2 * MAX_JITTER
+            ts -= rng.randint(1, 3 * self.nonce_ttl)
+        self._sign(environ, id, ts)
+        request = GeneratedRequest(kind, id, environ)
+        if kind != KIND_STALE:
+            self._seen_ids.add(id)
+            pool = self._replay_pool
+            if len(pool) < REPLAY_POOL_SIZE:
+                pool.append(request)
+            else:
+                pool[rng.randrange(REPLAY_POOL_SIZE)] = request
+        return request
+
+
+def environ_to_http(environ):
+    """Serialize a generated WSGI environ as raw HTTP/1.1 request bytes."""
+    target = environ["SCRIPT_NAME"] + environ["PATH_INFO"]
+    if environ.get("QUERY_STRING"):
+        target += "?" + environ["QUERY_STRING"]
+    lines = ["%s %s HTTP/1.1" % (environ["REQUEST_METHOD"], target),
+             "Host: %s" % (environ["HTTP_HOST"],)]
+    if "HTTP_AUTHORIZATION" in environ:
+        lines.append("Authorization: %s" % (environ["HTTP_AUTHORIZATION"],))
+    lines.append("Content-Length: 0")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin1")
+
+
+def main(argv=None):
+    """Command-line entry point, writing generated requests to a file."""
+    parser = argparse.ArgumentParser(
+        prog="python -m macauthlib.loadgen",
+        description="Generate synthetic signed requests.")
+    parser.add_argument("-n", "--count", type=int, default=1000,
+                        help="number of requests to generate")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="random seed")
+    parser.add_argument("--now", type=int, default=None,
+                        help="current time for timestamps (default: now)")
+    parser.add_argument("--format", choices=("environ", "http"),
+                        default="http",
+                        help="JSON lines of WSGI environs or raw HTTP")
+    parser.add_argument("--num-ids", type=int, default=DEFAULT_NUM_IDS)
+    parser.add_argument("--id-skew", type=float, default=DEFAULT_ID_SKEW)
+    parser.add_argument("--max-clock-offset", type=int,
+                        default=DEFAULT_MAX_CLOCK_OFFSET)
+    parser.add_argument("--replay-rate", type=float, default=0.0)
+    parser.add_argument("--stale-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--large-query-rate", type=float, default=0.0)
+    parser.add_argument("--query-size", type=int, default=DEFAULT_QUERY_SIZE)
+    parser.add_argument("--keys", metavar="FILE",
+                        help="write a JSON object mapping ids to keys")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+    generator = TrafficGenerator(
+        seed=args.seed, now=args.now, num_ids=args.num_ids,
+        id_skew=args.id_skew, max_clock_offset=args.max_clock_offset,
+        replay_rate=args.replay_rate, stale_rate=args.stale_rate,
+        malformed_rate=args.malformed_rate,
+        large_query_rate=args.large_query_rate, query_size=args.query_size)
+    if args.keys:
+        with open(args.keys, "w") as f:
+            json.dump(generator.keys, f, sort_keys=True)
+    if args.output:
+        output = open(args.output, "wb")
+    else:
+        output = getattr(sys.stdout, "buffer", sys.stdout)
+    try:
+        for request in generator.generate(args.count):
+            if args.format == "http":
+                output.write(environ_to_http(request.environ))
+            else:
+                line = json.dumps({"kind": request.kind, "id": request.id,
+                                   "environ": request.environ},
+                                  sort_keys=True)
+                output.write(line.encode("ascii") + b"\n")
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
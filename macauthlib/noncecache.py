@@ -9,14 +9,36 @@ Class for managing a cache of nonces.
 
 import time
 import heapq
+import array
+import bisect
 import threading
+import itertools
 import collections
 
-from macauthlib.utils import iteritems
+from macauthlib.clock import DEFAULT_CLOCK
+from macauthlib.utils import iteritems, register_fork_hooks
 
 
 DEFAULT_NONCE_TTL = 30  # thirty seconds
 DEFAULT_ID_TTL = 3600   # one hour
+DEFAULT_NUM_SHARDS = 16
+DEFAULT_RING_BUCKETS = 30
+DEFAULT_SWEEP_INTERVAL = 1.0
+DEFAULT_SWEEP_BUDGET = 100
+
+# Approximate memory used by each id and each nonce stored in a NonceCache,
+# as measured by benchmarks/bench_nonce_memory.py on 64-bit CPython.
+APPROX_ID_SIZE = 600
+APPROX_NONCE_SIZE = 180
+
+# Approximate memory used by each stale entry left in a purge queue.
+APPROX_QUEUE_ENTRY_SIZE = 88
+
+# Timer for measuring lock waits, where available.
+_timer = getattr(time, "perf_counter", time.time)
+
+# Minimum number of nonces stored for an id before expired ones are purged.
+_MIN_COMPACT_LIMIT = 8
 
 
 class KeyExistsError(KeyError):
@@ -43,23 +65,64 @@ class NonceCache(object):
     stored per id and the total number of ids.  If given then items may be
     removed from the cache even if they have not expired, possibly opening
     the server up to replay attacks.
+
+    It also supports an optional max_bytes argument to limit the approximate
+    memory used by all ids and nonces together.  When the cache goes over
+    this budget it evicts the ids that have been least recently active,
+    along with all their nonces, with the same replay risk as max_size.
+    The current approximate usage is reported by memory_usage().
+
+    The optional engine argument selects the class used to store the nonces
+    for each id.  It defaults to Cache, and may also be RingCache or any
+    other class with the same constructor signature (including the "clock"
+    keyword argument), add(), set_locked() and purge_locked() methods.
+
+    The optional clock argument gives the time source used when no explicit
+    time is passed in, as described in macauthlib.clock.  It defaults to a
+    monotonic-anchored clock, so that cached clock skews and expiry times
+    are unaffected if the system time is adjusted.
     """
 
-    def __init__(self, nonce_ttl=None, id_ttl=None, max_size=None):
+    def __init__(self, nonce_ttl=None, id_ttl=None, max_size=None,
+                 engine=None, max_bytes=None, clock=None):
         if nonce_ttl is None:
             nonce_ttl = DEFAULT_NONCE_TTL
         if id_ttl is None:
             id_ttl = DEFAULT_ID_TTL
+        if engine is None:
+            engine = Cache
+        if clock is None:
+            clock = DEFAULT_CLOCK
         self.nonce_ttl = nonce_ttl
         self.id_ttl = id_ttl
         self.max_size = max_size
+        self.engine = engine
+        assert not max_bytes or max_bytes > 0
+        self.max_bytes = max_bytes
+        self.clock = clock
         self._cache_lock = threading.Lock()
-        self._ids = Cache(id_ttl, max_size, self._cache_lock)
+        self._ids = Cache(id_ttl, max_size, self._cache_lock, clock)
+        self._ids.on_purge = self._forget_id
+        # Position in the id cache's purge queue at which to resume sweeping.
+        self._sweep_pos = 0
+        # When limiting memory, this maps ids to their approximate size in
+        # least-recently-active order, and tracks the total size.
+        self._id_sizes = collections.OrderedDict()
+        self._total_size = 0
+        # Running counters, all maintained under the cache lock.
+        self._id_stats = self._ids.stats = CacheStats()
+        self._nonce_stats = CacheStats()
+        self._inserts = 0
+        self._replays = 0
+        self._window_rejects = 0
+        self._lock_wait = 0.0
 
     def __len__(self):
-        return sum(len(self._ids.get(key)[1]) for key in self._ids)
+        """Get the number of nonces stored, including any not yet purged."""
+        stats = self._nonce_stats
+        return self._inserts - stats.expirations - stats.evictions
 
-    def check_nonce(self, id, timestamp, nonce):
+    def check_nonce(self, id, timestamp, nonce, now=None):
         """Check if the given timestamp+nonce is fresh for the given id.
 
         This method checks that the given timestamp+nonce has not previously
@@ -68,59 +131,572 @@ class NonceCache(object):
 
         Fresh nonces are added to the cache, so that subsequent checks of the
         same nonce will return False.
+
+        If the "now" parameter is given, it is used as the current server
+        time rather than reading the clock, and all expiry calculations are
+        done relative to it.  It should come from the same clock as the
+        cache uses, or at least one that doesn't run backwards.
+        """
+        if now is None:
+            now = self.clock()
+        self._acquire_lock()
+        try:
+            return self._check_nonce_locked(id, timestamp, nonce, now)
+        finally:
+            self._cache_lock.release()
+
+    def check_nonces(self, items, now=None):
+        """Check a batch of (id, timestamp, nonce) tuples for freshness.
+
+        This method is equivalent to calling check_nonce() on each item in
+        turn, returning a list of the results, but it takes the cache lock
+        only once for the whole batch.
+        """
+        if now is None:
+            now = self.clock()
+        check_nonce_locked = self._check_nonce_locked
+        self._acquire_lock()
+        try:
+            return [check_nonce_locked(id, timestamp, nonce, now)
+                    for (id, timestamp, nonce) in items]
+        finally:
+            self._cache_lock.release()
+
+    def stats(self):
+        """Get a snapshot of statistics about the cache, as a dict.
+
+        The snapshot gives the number of ids and nonces currently stored
+        (which may include some that have expired but not yet been purged)
+        along with running totals of the nonces inserted, replayed nonces
+        rejected, nonces rejected for being outside the timestamp window,
+        ids and nonces purged on expiry, ids and nonces evicted to stay
+        within max_size or max_bytes, and the seconds spent waiting for
+        the cache lock.  It is cheap to call, and won't stall other threads.
         """
+        with self._cache_lock:
+            return {
+                "ids": len(self._ids),
+                "nonces": len(self),
+                "inserts": self._inserts,
+                "replays": self._replays,
+                "window_rejects": self._window_rejects,
+                "expired_ids": self._id_stats.expirations,
+                "expired_nonces": self._nonce_stats.expirations,
+                "evicted_ids": self._id_stats.evictions,
+                "evicted_nonces": self._nonce_stats.evictions,
+                "lock_wait": self._lock_wait,
+            }
+
+    def _acquire_lock(self):
+        """Acquire the cache lock, counting any time spent waiting for it."""
+        lock = self._cache_lock
+        if not lock.acquire(False):
+            start = _timer()
+            lock.acquire()
+            self._lock_wait += _timer() - start
+
+    def _check_nonce_locked(self, id, timestamp, nonce, now):
+        """Check a nonce, assuming the cache lock is already held."""
         # Get the clock skew to use for calculations.
         # If no skew is cached, calculate it.
         try:
-            (skew, nonces) = self._ids.get(id)
+            (skew, nonces) = self._ids.get(id, now)
         except KeyError:
-            server_time = time.time()
-            skew = server_time - timestamp
-            nonces = Cache(self.nonce_ttl, self.max_size, self._cache_lock)
-            # Insertion could race if multiple requests come in for an id.
-            try:
-                self._ids.set(id, (skew, nonces))
-            except KeyExistsError as exc:     # pragma nocover
-                (skew, nonces) = exc.value  # pragma nocover
+            skew = now - timestamp
+            nonces = self.engine(self.nonce_ttl, self.max_size,
+                                 self._cache_lock, clock=self.clock)
+            nonces.stats = self._nonce_stats
+            self._ids.set_locked(id, (skew, nonces), now)
         # If the adjusted timestamp is too old or too new, then
         # we can reject it without even looking at the nonce.
-        # XXX TODO: we really need a monotonic clock here.
-        # If the system time gets adjusted then we could be in trouble.
         timestamp = timestamp + skew
-        if abs(timestamp - time.time()) >= self.nonce_ttl:
-            return False
-        # Otherwise, we need to look in the per-id nonce cache.
-        if nonce in nonces:
-            return False
-        # The nonce is fresh, add it into the cache.
-        nonces.set(nonce, True, timestamp)
+        if abs(timestamp - now) >= self.nonce_ttl:
+            self._window_rejects += 1
+            result = False
+        else:
+            # Otherwise, check the per-id nonce cache
+            # and add the nonce to it if it's fresh.
+            try:
+                nonces.set_locked(nonce, True, now, timestamp)
+            except KeyExistsError:
+                self._replays += 1
+                result = False
+            else:
+                self._inserts += 1
+                result = True
+        if self.max_bytes:
+            self._update_size(id, nonces)
+        return result
+
+    def memory_usage(self):
+        """Get the approximate number of bytes used by ids and nonces.
+
+        This is estimated from the number of ids and nonces stored, using
+        the sizes given by APPROX_ID_SIZE and APPROX_NONCE_SIZE, plus
+        APPROX_QUEUE_ENTRY_SIZE for each stale entry in the id purge queue.
+        """
+        with self._cache_lock:
+            if self.max_bytes:
+                return self._total_size + self._stale_size()
+            return self._stale_size() + sum(
+                self._approx_size(item.value[1])
+                for item in self._ids.items.values())
+
+    def _stale_size(self):
+        return APPROX_QUEUE_ENTRY_SIZE * self._ids.stale
+
+    def _approx_size(self, nonces):
+        return APPROX_ID_SIZE + APPROX_NONCE_SIZE * len(nonces)
+
+    def _update_size(self, id, nonces, touch=True):
+        """Update the size of an id, evicting idle ids if over budget.
+
+        If "touch" is true then the id is also marked as the most recently
+        active.  The cache lock must be held.
+        """
+        # The id may have been evicted by another thread in the meantime.
+        items = self._ids.items
+        item = items.get(id)
+        if item is None or item.value[1] is not nonces:
+            return
+        id_sizes = self._id_sizes
+        size = self._approx_size(nonces)
+        if touch:
+            old_size = id_sizes.pop(id, 0)
+        else:
+            old_size = id_sizes.get(id)
+            if old_size is None:
+                return
+        id_sizes[id] = size
+        self._total_size += size - old_size
+        # Never evict the id being updated.  Each eviction leaves a stale
+        # entry in the purge queue, which counts against the budget too.
+        while (self._total_size + self._stale_size() > self.max_bytes and
+               len(id_sizes) > 1):
+            (old_id, old_size) = id_sizes.popitem(last=False)
+            self._total_size -= old_size
+            old_item = self._ids.remove_locked(old_id)
+            if old_item is not None:
+                self._id_stats.evictions += 1
+                self._nonce_stats.evictions += len(old_item.value[1])
+
+    def _forget_id(self, id, value, evicted):
+        """Update the accounting for an id purged from the cache."""
+        if evicted:
+            self._nonce_stats.evictions += len(value[1])
+        else:
+            self._nonce_stats.expirations += len(value[1])
+        size = self._id_sizes.pop(id, None)
+        if size is not None:
+            self._total_size -= size
+
+    def sweep(self, now=None, budget=None):
+        """Reclaim a bounded number of expired ids and nonces.
+
+        Expired items are normally only purged a few at a time when new
+        items are added, so this method can be called periodically (e.g.
+        by a Sweeper) to reclaim them off the request path.  Each call
+        holds the cache lock for at most "budget" units of work, working
+        through the ids in turn across calls, and returns the number of
+        items reclaimed.  The "now" parameter defaults to the cache's clock.
+
+        The ids are visited by walking a cursor over the id cache's purge
+        queue, so the work done is independent of the total number of ids.
+        Entries that move within the queue during a pass may be skipped
+        until the next one.
+        """
+        if now is None:
+            now = self.clock()
+        if budget is None:
+            budget = DEFAULT_SWEEP_BUDGET
+        with self._cache_lock:
+            count = self._ids.purge_locked(now, budget)
+            budget -= count
+            queue = self._ids.purge_queue
+            items = self._ids.items
+            pos = self._sweep_pos
+            if pos >= len(queue):
+                pos = 0
+            while pos < len(queue) and budget > 0:
+                (timestamp, queue_id) = queue[pos]
+                pos += 1
+                item = items.get(queue_id)
+                # Skip queue entries for ids that have since been replaced.
+                if item is None or item.timestamp != timestamp:
+                    budget -= 1
+                    continue
+                nonces = item.value[1]
+                purged = nonces.purge_locked(now, budget)
+                count += purged
+                budget -= max(1, purged)
+                if purged and self.max_bytes:
+                    self._update_size(queue_id, nonces, touch=False)
+            self._sweep_pos = pos
+        return count
+
+
+class ShardedNonceCache(object):
+    """A NonceCache split into independently-locked shards.
+
+    This class provides the same interface as NonceCache, but hashes each
+    id to one of several underlying NonceCache objects.  Since each shard
+    has its own lock, threads checking nonces for different ids will rarely
+    contend with each other.
+
+    The max_size argument, if given, is applied separately to each shard.
+    The max_bytes argument, if given, is divided evenly between the shards.
+    """
+
+    def __init__(self, nonce_ttl=None, id_ttl=None, max_size=None,
+                 num_shards=None, engine=None, max_bytes=None, clock=None):
+        if num_shards is None:
+            num_shards = DEFAULT_NUM_SHARDS
+        assert num_shards > 0
+        shard_bytes = None
+        if max_bytes:
+            shard_bytes = max(1, max_bytes // num_shards)
+        self.shards = [NonceCache(nonce_ttl, id_ttl, max_size, engine,
+                                  shard_bytes, clock)
+                       for _ in range(num_shards)]
+        self.nonce_ttl = self.shards[0].nonce_ttl
+        self.id_ttl = self.shards[0].id_ttl
+        self.clock = self.shards[0].clock
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.num_shards = num_shards
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def memory_usage(self):
+        """Get the approximate number of bytes used by all shards."""
+        return sum(shard.memory_usage() for shard in self.shards)
+
+    def stats(self):
+        """Get a snapshot of statistics summed over all shards.
+
+        See NonceCache.stats() for details.
+        """
+        totals = collections.Counter()
+        for shard in self.shards:
+            totals.update(shard.stats())
+        return dict(totals)
+
+    def get_shard(self, id):
+        """Get the NonceCache shard responsible for the given id."""
+        return self.shards[hash(id) % self.num_shards]
+
+    def check_nonce(self, id, timestamp, nonce, now=None):
+        """Check if the given timestamp+nonce is fresh for the given id.
+
+        See NonceCache.check_nonce() for details.
+        """
+        shard = self.shards[hash(id) % self.num_shards]
+        return shard.check_nonce(id, timestamp, nonce, now)
+
+    def check_nonces(self, items, now=None):
+        """Check a batch of (id, timestamp, nonce) tuples for freshness.
+
+        This method groups the items by shard and checks each group in turn,
+        so that each shard's lock is taken at most once.
+        """
+        if now is None:
+            now = self.clock()
+        num_shards = self.num_shards
+        groups = collections.defaultdict(list)
+        for (index, item) in enumerate(items):
+            groups[hash(item[0]) % num_shards].append((index, item))
+        results = [False] * len(items)
+        for (shard_num, group) in iteritems(groups):
+            shard = self.shards[shard_num]
+            shard_results = shard.check_nonces([item for (_, item) in group],
+                                               now)
+            for ((index, _), result) in zip(group, shard_results):
+                results[index] = result
+        return results
+
+    def sweep(self, now=None, budget=None):
+        """Reclaim expired ids and nonces from each shard in turn.
+
+        See NonceCache.sweep() for details; the budget applies separately
+        to each shard.
+        """
+        return sum(shard.sweep(now, budget) for shard in self.shards)
+
+
+class Sweeper(object):
+    """Object for reclaiming expired nonces in a background thread.
+
+    A Sweeper periodically calls the sweep() method of its target, which
+    may be a NonceCache or ShardedNonceCache, so that expired items are
+    reclaimed in bounded slices rather than while handling requests.  Call
+    start() to begin sweeping in a daemon thread and stop() to end it.  For
+    asyncio servers, see macauthlib.aio.sweep_forever() instead.
+
+    A running Sweeper is safe across os.fork(): it never holds the cache
+    lock while the process forks, and its thread is restarted in the child.
+    """
+
+    def __init__(self, target, interval=None, budget=None):
+        if interval is None:
+            interval = DEFAULT_SWEEP_INTERVAL
+        if budget is None:
+            budget = DEFAULT_SWEEP_BUDGET
+        self.target = target
+        self.interval = interval
+        self.budget = budget
+        self._thread = None
+        self._stopped = threading.Event()
+        # Held while sweeping, and by the forking thread during fork.
+        self._sweep_lock = threading.Lock()
+        register_fork_hooks(self, before="_before_fork",
+                            after_in_parent="_after_fork_parent",
+                            after_in_child="_after_fork_child")
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start sweeping in a background daemon thread."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread, waiting for it to exit."""
+        thread = self._thread
+        if thread is not None:
+            self._thread = None
+            self._stopped.set()
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def sweep(self):
+        """Perform a single bounded sweep of the target."""
+        with self._sweep_lock:
+            return self.target.sweep(budget=self.budget)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sweep()
+
+    def _before_fork(self):
+        self._sweep_lock.acquire()
+
+    def _after_fork_parent(self):
+        self._sweep_lock.release()
+
+    def _after_fork_child(self):
+        # Only the forking thread survives in the child, so the lock is
+        # ours to release and the sweeping thread must be recreated.
+        self._sweep_lock.release()
+        if self._thread is not None:
+            self._thread = None
+            self._stopped = threading.Event()
+            self.start()
+
+
+class _IdState(object):
+    """Compact record of the nonce state for a single id.
+
+    Nonces are stored as their 64-bit hash values in one sorted array, with
+    their expiry times at the same index in a parallel array.  Expired
+    entries are compacted out whenever the arrays reach "limit" items.
+    """
+
+    __slots__ = ("skew", "expires", "limit", "nonces", "nonce_expiries")
+
+    def __init__(self, skew, expires, limit):
+        self.skew = skew
+        self.expires = expires
+        self.limit = limit
+        self.nonces = array.array("q")
+        self.nonce_expiries = array.array("d")
+
+    def compact(self, now, max_size=None):
+        """Remove all expired nonces from the arrays.
+
+        If max_size is given then the nonces closest to expiry are also
+        removed to make room for one more, and the arrays will never grow
+        beyond it.
+        """
+        expiries = self.nonce_expiries
+        live = [i for (i, expiry) in enumerate(expiries) if expiry >= now]
+        if max_size and len(live) >= max_size:
+            live.sort(key=expiries.__getitem__)
+            live = sorted(live[len(live) - max_size + 1:])
+        self.nonces = array.array("q", [self.nonces[i] for i in live])
+        self.nonce_expiries = array.array(
+            "d", [self.nonce_expiries[i] for i in live])
+        self.limit = max(_MIN_COMPACT_LIMIT, 2 * len(live))
+        if max_size:
+            self.limit = min(self.limit, max_size)
+
+
+class CompactNonceCache(object):
+    """Object for managing a cache of used nonces using compact storage.
+
+    This class provides the same interface and rules as NonceCache, but
+    stores the state for each id in a single slotted record, with the clock
+    skew stored inline and nonces packed into arrays of fixed-width hash
+    values.  This uses several times less memory per id and per nonce than
+    NonceCache, which matters when there are very many active ids.
+
+    Nonces are stored as 64-bit hashes, so there is a negligible chance of
+    a fresh nonce being rejected due to a collision with an earlier nonce
+    from the same id.  Each id's hashes are kept sorted, so checking a
+    nonce is a binary search however many nonces the id has sent.
+    Requires Python 3.7 or later, for ordered dicts.
+    """
+
+    def __init__(self, nonce_ttl=None, id_ttl=None, max_size=None,
+                 clock=None):
+        if nonce_ttl is None:
+            nonce_ttl = DEFAULT_NONCE_TTL
+        if id_ttl is None:
+            id_ttl = DEFAULT_ID_TTL
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        assert not max_size or max_size > 0
+        self.nonce_ttl = nonce_ttl
+        self.id_ttl = id_ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._min_limit = _MIN_COMPACT_LIMIT
+        if max_size:
+            self._min_limit = min(self._min_limit, max_size)
+        self._lock = threading.Lock()
+        # Maps ids to _IdState records, in order of creation.
+        self._ids = {}
+
+    def __len__(self):
+        now = self.clock()
+        with self._lock:
+            return sum(1 for state in self._ids.values()
+                       if state.expires >= now
+                       for expiry in state.nonce_expiries if expiry >= now)
+
+    def check_nonce(self, id, timestamp, nonce, now=None):
+        """Check if the given timestamp+nonce is fresh for the given id.
+
+        See NonceCache.check_nonce() for details.
+        """
+        if now is None:
+            now = self.clock()
+        ttl = self.nonce_ttl
+        key = hash(nonce)
+        with self._lock:
+            # Get the clock skew to use for calculations.
+            # If no skew is cached, calculate it.
+            ids = self._ids
+            state = ids.get(id)
+            if state is None or state.expires < now:
+                if state is not None:
+                    del ids[id]
+                self._purge_ids(now)
+                state = ids[id] = _IdState(now - timestamp, now + self.id_ttl,
+                                           self._min_limit)
+            # If the adjusted timestamp is too old or too new, then
+            # we can reject it without even looking at the nonce.
+            timestamp = timestamp + state.skew
+            if abs(timestamp - now) >= ttl:
+                return False
+            # Otherwise, look for the nonce in the per-id array.
+            # If it's there but has expired, we can reuse its slot.
+            nonces = state.nonces
+            index = bisect.bisect_left(nonces, key)
+            if index < len(nonces) and nonces[index] == key:
+                if state.nonce_expiries[index] >= now:
+                    return False
+                state.nonce_expiries[index] = timestamp + ttl
+                return True
+            # The nonce is fresh, insert it into the arrays in order.
+            if len(nonces) >= state.limit:
+                state.compact(now, self.max_size)
+                nonces = state.nonces
+                index = bisect.bisect_left(nonces, key)
+            nonces.insert(index, key)
+            state.nonce_expiries.insert(index, timestamp + ttl)
         return True
 
+    def check_nonces(self, items, now=None):
+        """Check a batch of (id, timestamp, nonce) tuples for freshness.
+
+        This is equivalent to calling check_nonce() on each item in turn.
+        """
+        if now is None:
+            now = self.clock()
+        check_nonce = self.check_nonce
+        return [check_nonce(id, timestamp, nonce, now)
+                for (id, timestamp, nonce) in items]
+
+    def _purge_ids(self, now):
+        """Purge a few expired ids, and ensure we stay below max_size."""
+        ids = self._ids
+        # Don't purge *all* of them, so we don't pause for too long.
+        for id in list(itertools.islice(ids, 5)):
+            if ids[id].expires >= now:
+                break
+            del ids[id]
+        if self.max_size:
+            while len(ids) >= self.max_size:
+                del ids[next(iter(ids))]
+
 
 CacheItem = collections.namedtuple("CacheItem", "value timestamp")
 
 
+class CacheStats(object):
+    """Running counts of the items removed from a Cache.
+
+    Items are counted as expirations if they were removed after their ttl
+    had passed, and as evictions if they were removed early to stay within
+    max_size.  A single CacheStats object may be shared by several caches.
+    """
+
+    __slots__ = ("expirations", "evictions")
+
+    def __init__(self):
+        self.expirations = 0
+        self.evictions = 0
+
+
 class Cache(object):
     """A simple in-memory cache with automatic timestamp-based purging.
 
     This class provides a very simple in-memory cache.  Along with a dict
     for fast lookup of cached values, it maintains a queue of values and their
-    timestamps so that they can be purged in order as they expire.
+    timestamps so that they can be purged in order as they expire.  The
+    optional clock argument gives the time source, as for NonceCache.
     """
 
-    def __init__(self, ttl, max_size=None, purge_lock=None):
+    def __init__(self, ttl, max_size=None, purge_lock=None, clock=None):
         assert not max_size or max_size > 0
+        if clock is None:
+            clock = DEFAULT_CLOCK
         self.items = {}
         self.ttl = ttl
         self.max_size = max_size
+        self.clock = clock
         self.purge_lock = purge_lock or threading.Lock()
         self.purge_queue = []
+        # Number of entries in purge_queue for items that have since been
+        # removed or replaced, and which are skipped when they reach the top.
+        self.stale = 0
+        # Optional CacheStats object for counting purged items.
+        self.stats = None
+        # Optional function called with (key, value, evicted) for each
+        # purged item, where "evicted" is True if it had not yet expired.
+        self.on_purge = None
 
     def __len__(self):
         return len(self.items)
 
     def __iter__(self):
-        now = time.time()
+        now = self.clock()
         for key, item in iteritems(self.items):
             if item.timestamp + self.ttl >= now:
                 yield key
@@ -130,53 +706,294 @@ class Cache(object):
             item = self.items[key]
         except KeyError:
             return False
-        if item.timestamp + self.ttl < time.time():
+        if item.timestamp + self.ttl < self.clock():
             return False
         return True
 
-    def get(self, key):
+    def get(self, key, now=None):
         item = self.items[key]
-        if item.timestamp + self.ttl < time.time():
+        if now is None:
+            now = self.clock()
+        if item.timestamp + self.ttl < now:
             raise KeyError(key)
         return item.value
 
     def set(self, key, value, timestamp=None):
-        now = time.time()
+        now = self.clock()
+        with self.purge_lock:
+            self.set_locked(key, value, now, timestamp)
+
+    def add(self, key, value, timestamp=None):
+        """Add an item to the cache if it's not already present.
+
+        This is an atomic check-and-insert operation, returning True if the
+        item was added and False if an unexpired item already existed.
+        """
+        now = self.clock()
+        with self.purge_lock:
+            try:
+                self.set_locked(key, value, now, timestamp)
+            except KeyExistsError:
+                return False
+        return True
+
+    def set_locked(self, key, value, now, timestamp=None):
+        """Add an item to the cache, assuming purge_lock is already held."""
         if timestamp is None:
             timestamp = now
         purge_deadline = now - self.ttl
-        item = CacheItem(value, timestamp)
-        with self.purge_lock:
-            # Refuse to set duplicate keys in the cache, unless it has expired.
-            old_item = self.items.get(key)
-            if old_item is not None and old_item.timestamp >= purge_deadline:
+        # Refuse to set duplicate keys in the cache, unless it has expired.
+        old_item = self.items.get(key)
+        if old_item is not None:
+            if old_item.timestamp >= purge_deadline:
                 raise KeyExistsError(key, old_item.value)
-            # This try-except catches the case where we purge
-            # all items from the queue, producing an IndexError.
-            try:
-                # Ensure we stay below max_size, if defined.
-                if self.max_size:
-                    while len(self.items) >= self.max_size:
-                        self._purge_item()
-                # Purge a few expired items to make room.
-                # Don't purge *all* of them, so we don't pause for too long.
-                for _ in range(5):
-                    (old_timestamp, old_key) = self.purge_queue[0]
-                    if old_timestamp >= purge_deadline:
-                        break
-                    self._purge_item()
-            except IndexError:
-                pass
-            # Add the new item into both queue and map.
-            self.items[key] = item
-            heapq.heappush(self.purge_queue, (timestamp, key))
+            # Remove it now, so that the purging below can't count it again.
+            del self.items[key]
+            self._removed(key, old_item, False)
+            self._mark_stale()
+        # This try-except catches the case where we purge
+        # all items from the queue, producing an IndexError.
+        try:
+            # Ensure we stay below max_size, if defined.
+            if self.max_size:
+                while len(self.items) >= self.max_size:
+                    self._purge_item(purge_deadline)
+            # Purge a few expired items to make room.
+            # Don't purge *all* of them, so we don't pause for too long.
+            for _ in range(5):
+                (old_timestamp, old_key) = self.purge_queue[0]
+                if old_timestamp >= purge_deadline:
+                    break
+                self._purge_item(purge_deadline)
+        except IndexError:
+            pass
+        # Add the new item into both queue and map.
+        self.items[key] = CacheItem(value, timestamp)
+        heapq.heappush(self.purge_queue, (timestamp, key))
+
+    def remove_locked(self, key):
+        """Remove an item from the cache, assuming purge_lock is already held.
+
+        Returns the removed item, or None if there was no such key.  The
+        item's entry is left in the purge queue, to be skipped later.
+        """
+        item = self.items.pop(key, None)
+        if item is not None:
+            self._mark_stale()
+        return item
 
-    def _purge_item(self):
-        """Purge the topmost item in the queue."""
+    def _mark_stale(self):
+        """Count a stale entry in the purge queue.
+
+        Once stale entries outnumber the live ones, the queue is rebuilt
+        without them.  This bounds the size of the queue, at an amortized
+        cost of O(1) per removal.
+        """
+        self.stale += 1
+        if self.stale > len(self.items):
+            self.purge_queue = [(item.timestamp, key)
+                                for (key, item) in iteritems(self.items)]
+            heapq.heapify(self.purge_queue)
+            self.stale = 0
+
+    def purge_locked(self, now, budget=None):
+        """Purge expired items, assuming purge_lock is already held.
+
+        At most "budget" items are purged, if given.  Returns the number
+        of items purged.
+        """
+        purge_deadline = now - self.ttl
+        purge_queue = self.purge_queue
+        size = len(self.items)
+        count = 0
+        while purge_queue and purge_queue[0][0] < purge_deadline:
+            if budget is not None and count >= budget:
+                break
+            self._purge_item(purge_deadline)
+            count += 1
+        return size - len(self.items)
+
+    def _purge_item(self, purge_deadline):
+        """Purge the topmost item in the queue.
+
+        Items with timestamps at or after purge_deadline have not expired,
+        and are counted as evictions.
+        """
         # We have to take a little care here, because the entry in self.items
         # might have overwritten the entry which appears at head of queue.
         # Check that timestamps match before purging.
         (timestamp, key) = heapq.heappop(self.purge_queue)
         item = self.items.pop(key, None)
-        if item is not None and item.timestamp != timestamp:
-            self.items[key] = item  # pragma nocover
+        if item is None:
+            self.stale -= 1
+        elif item.timestamp != timestamp:
+            self.items[key] = item
+            self.stale -= 1
+        else:
+            self._removed(key, item, timestamp >= purge_deadline)
+
+    def _removed(self, key, item, evicted):
+        """Record the removal of an item from the cache."""
+        if self.stats is not None:
+            if evicted:
+                self.stats.evictions += 1
+            else:
+                self.stats.expirations += 1
+        if self.on_purge is not None:
+            self.on_purge(key, item.value, evicted)
+
+
+class RingCache(object):
+    """A set of timestamped keys expired from a ring of time buckets.
+
+    This class is an alternative to Cache for storing nonces, selected by
+    passing engine=RingCache to NonceCache.  Keys are kept in a dict mapping
+    them to their timestamps, for O(1) lookups.  To expire them, the ttl is
+    divided into a fixed number of equal-width time buckets (one second
+    wide for the default nonce ttl) and each key is also listed in the
+    bucket for its timestamp.  The ring holds enough buckets to cover
+    timestamps up to one ttl either side of the current time.
+
+    A whole bucket is dropped at once when it falls out of the window, so
+    expiry needs no heap and costs O(1) per key, and nothing accumulates
+    under bursts of inserts.
+
+    Only keys and their timestamps are stored; values passed to add() are
+    ignored.  If max_size is given and reached, the oldest bucket is dropped
+    to make room, possibly opening the server up to replay attacks.
+    """
+
+    def __init__(self, ttl, max_size=None, purge_lock=None,
+                 num_buckets=None, clock=None):
+        assert not max_size or max_size > 0
+        if num_buckets is None:
+            num_buckets = DEFAULT_RING_BUCKETS
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.ttl = ttl
+        self.clock = clock
+        self.max_size = max_size
+        self.purge_lock = purge_lock or threading.Lock()
+        self.width = float(ttl) / num_buckets
+        # Maps each stored key to its timestamp.
+        self.keys = {}
+        # Each entry in the ring is either None or a tuple giving
+        # (bucket number, list of keys with timestamps in that bucket).
+        self.ring = [None] * (2 * num_buckets + 2)
+        # All buckets numbered below this have been dropped from the ring.
+        self.purged_upto = 0
+        # Optional CacheStats object for counting dropped keys.
+        self.stats = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self._find(key, self.clock()) is not None
+
+    def _find(self, key, now):
+        """Find the timestamp of the unexpired entry for key, or None."""
+        timestamp = self.keys.get(key)
+        if timestamp is not None and timestamp + self.ttl >= now:
+            return timestamp
+        return None
+
+    def add(self, key, value=True, timestamp=None):
+        """Add a key to the cache if it's not already present.
+
+        This is an atomic check-and-insert operation, returning True if the
+        key was added and False if an unexpired entry already existed.
+        """
+        now = self.clock()
+        with self.purge_lock:
+            try:
+                self.set_locked(key, value, now, timestamp)
+            except KeyExistsError:
+                return False
+        return True
+
+    def set_locked(self, key, value, now, timestamp=None):
+        """Add a key to the cache, assuming purge_lock is already held."""
+        if timestamp is None:
+            timestamp = now
+        ttl = self.ttl
+        keys = self.keys
+        old_timestamp = keys.get(key)
+        if old_timestamp is not None and old_timestamp + ttl >= now:
+            raise KeyExistsError(key, True)
+        # Items that have already expired need not be stored at all.
+        if timestamp + ttl < now:
+            if self.stats is not None:
+                self.stats.expirations += 1
+            return
+        if timestamp - ttl > now:
+            raise ValueError("Timestamp is too far in the future")
+        self.purge_locked(now)
+        # Ensure we stay below max_size, if defined.
+        if self.max_size:
+            bucket = int((now - ttl) // self.width)
+            evicted = 0
+            while len(keys) >= self.max_size:
+                evicted += self._drop_bucket(bucket)
+                bucket += 1
+            if self.stats is not None:
+                self.stats.evictions += evicted
+        # Find or create the bucket for this timestamp.  A stale bucket
+        # left in its slot, or a stale entry for the key, has expired.
+        ring = self.ring
+        bucket = int(timestamp // self.width)
+        slot = bucket % len(ring)
+        entry = ring[slot]
+        expired = 0
+        if entry is None or entry[0] != bucket:
+            if entry is not None:
+                expired = self._drop_bucket(entry[0])
+            entry = ring[slot] = (bucket, [])
+        if key in keys:
+            expired += 1
+        keys[key] = timestamp
+        entry[1].append(key)
+        if expired and self.stats is not None:
+            self.stats.expirations += expired
+
+    def purge_locked(self, now, budget=None):
+        """Drop expired buckets, assuming purge_lock is already held.
+
+        Drops any buckets that have fallen out of the window since the last
+        purge, visiting at most "budget" buckets if given.  Each bucket is
+        visited only once as time advances.  Returns the number of keys
+        dropped.
+        """
+        first = int((now - self.ttl) // self.width)
+        start = max(self.purged_upto, first - len(self.ring))
+        if budget is not None:
+            first = min(first, start + budget)
+        dropped = 0
+        for bucket in range(start, first):
+            dropped += self._drop_bucket(bucket)
+        self.purged_upto = max(self.purged_upto, first)
+        if self.stats is not None:
+            self.stats.expirations += dropped
+        return dropped
+
+    def _drop_bucket(self, bucket):
+        """Drop all keys in the given bucket, if it's present in the ring.
+
+        Keys that have since been re-added with a timestamp in another
+        bucket are left alone.  Returns the number of keys dropped.
+        """
+        slot = bucket % len(self.ring)
+        entry = self.ring[slot]
+        if entry is None or entry[0] > bucket:
+            return 0
+        self.ring[slot] = None
+        (bucket, bucket_keys) = entry
+        keys = self.keys
+        width = self.width
+        dropped = 0
+        for key in bucket_keys:
+            timestamp = keys.get(key)
+            if timestamp is not None and int(timestamp // width) == bucket:
+                del keys[key]
+                dropped += 1
+        return dropped
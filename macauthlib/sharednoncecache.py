@@ -0,0 +1,242 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for managing a cache of nonces shared between forked processes.
+
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+import multiprocessing
+
+from macauthlib.clock import DEFAULT_CLOCK
+from macauthlib.noncecache import DEFAULT_NONCE_TTL, DEFAULT_ID_TTL
+
+
+DEFAULT_NONCE_CAPACITY = 2 ** 16
+DEFAULT_ID_CAPACITY = 2 ** 12
+DEFAULT_BUCKET_SIZE = 8
+DEFAULT_NUM_LOCKS = 64
+DEFAULT_MAX_PROBES = 16
+
+# Minimum number of buckets per lock, as a multiple of max_probes.  This
+# evens out chance differences in load between the locks' buckets.
+_MIN_PROBE_SPANS_PER_LOCK = 8
+
+# Each nonce slot holds (key hash, expiry time).
+_NONCE_SLOT = struct.Struct("=Qd")
+# Each id slot holds (key hash, clock skew, expiry time).
+_ID_SLOT = struct.Struct("=Qdd")
+
+
+class _SharedTable(object):
+    """Fixed-size open-addressing hash table of expiring records.
+
+    The table lives in shared memory and is divided into buckets of a fixed
+    number of slots.  Each key probes a fixed sequence of up to "max_probes"
+    buckets, stepping by an amount derived from its hash to avoid clustering,
+    and is stored in the first free slot.  A slot whose expiry time
+    has passed is free for reuse, so entries never need to be explicitly
+    deleted.  A slot that has never been used ends the search for a key,
+    since any key probing past it would have been stored there.
+
+    Each bucket is protected by one of a fixed set of process-shared locks.
+    A key's probe sequence steps over the buckets with a stride of the
+    number of locks, so it only visits buckets protected by the same lock
+    and holding that one lock is enough for a whole check-and-insert.
+    """
+
+    def __init__(self, capacity, bucket_size, slot_struct, locks,
+                 max_probes):
+        num_buckets = max(1, capacity // bucket_size)
+        # Use few enough locks that each has room for several full probe
+        # sequences, and round down to a whole number of buckets per lock.
+        span = max_probes * _MIN_PROBE_SPANS_PER_LOCK
+        self.locks = locks[:max(1, num_buckets // span)]
+        self.stride = len(self.locks)
+        self.num_rows = num_buckets // self.stride
+        self.num_buckets = self.num_rows * self.stride
+        self.bucket_size = bucket_size
+        self.max_probes = min(max_probes, self.num_rows)
+        self.slot_struct = slot_struct
+        self.slot_size = slot_struct.size
+        self.bucket_bytes = bucket_size * self.slot_size
+        size = self.num_buckets * self.bucket_bytes
+        self.buffer = mmap.mmap(-1, size, flags=mmap.MAP_SHARED)
+        self._view = memoryview(self.buffer)
+
+    def iter_live(self, now):
+        """Iterate over all unexpired records in the table."""
+        for record in self.slot_struct.iter_unpack(self._view):
+            if record[0] and record[-1] >= now:
+                yield record
+
+    def get_lock(self, keyhash):
+        return self.locks[keyhash % self.num_buckets % self.stride]
+
+    def _probe(self, keyhash):
+        """Iterate over the byte offsets of the key's probe sequence."""
+        home = keyhash % self.num_buckets
+        (row, column) = divmod(home, self.stride)
+        num_rows = self.num_rows
+        stride = self.stride
+        bucket_bytes = self.bucket_bytes
+        # Use an odd step, so it is coprime with a power-of-two row count.
+        step = (keyhash >> 32) % num_rows | 1
+        for i in range(self.max_probes):
+            bucket = ((row + i * step) % num_rows) * stride + column
+            yield bucket * bucket_bytes
+
+    def find(self, keyhash, now):
+        """Find the unexpired record for the given key, or None.
+
+        The caller must hold the lock for the key.
+        """
+        iter_unpack = self.slot_struct.iter_unpack
+        view = self._view
+        bucket_bytes = self.bucket_bytes
+        for offset in self._probe(keyhash):
+            for record in iter_unpack(view[offset:offset + bucket_bytes]):
+                if record[0] == keyhash:
+                    if record[-1] >= now:
+                        return record
+                elif not record[0]:
+                    return None
+        return None
+
+    def insert(self, keyhash, now, *values):
+        """Insert a record for the given key into the first free slot.
+
+        Returns True if the record was stored, or False if every slot in
+        the key's probe sequence holds a live record.  Live records are
+        never replaced.  The caller must hold the lock for the key.
+        """
+        iter_unpack = self.slot_struct.iter_unpack
+        view = self._view
+        bucket_bytes = self.bucket_bytes
+        slot_size = self.slot_size
+        for offset in self._probe(keyhash):
+            records = iter_unpack(view[offset:offset + bucket_bytes])
+            for (i, record) in enumerate(records):
+                if record[-1] < now:
+                    self.slot_struct.pack_into(self.buffer,
+                                               offset + i * slot_size,
+                                               keyhash, *values)
+                    return True
+        return False
+
+
+class SharedNonceCache(object):
+    """Object for managing a cache of used nonces shared between processes.
+
+    This class provides the same check_nonce() interface as NonceCache,
+    but keeps its data in a fixed-size hash table in shared memory.  If it
+    is created before a server forks its worker processes, then all workers
+    will share a single replay window and memory use will not grow with the
+    number of workers.  For example, with gunicorn create it at module scope
+    in the application and run with the --preload option.
+
+    Memory use is fixed by the "capacity" and "id_capacity" arguments.
+    Each key may be stored in any of "max_probes" buckets, and live entries
+    are never replaced.  If all of them are full, the check fails closed
+    and the nonce is rejected as if it had been seen before.  Size the
+    table for the expected number of nonces seen per nonce_ttl.
+
+    Keys are stored as 64-bit keyed hashes, so there is a negligible chance
+    of a fresh nonce being rejected due to a hash collision.  This class
+    requires a platform with fork() and shared anonymous mmap support.
+
+    The optional clock argument is as for NonceCache.  Expiry times are
+    shared between processes, so they must all use the same clock; the
+    default clock is inherited by forked children, which is fine.
+    """
+
+    def __init__(self, nonce_ttl=None, id_ttl=None, capacity=None,
+                 id_capacity=None, bucket_size=None, num_locks=None,
+                 clock=None, max_probes=None):
+        if nonce_ttl is None:
+            nonce_ttl = DEFAULT_NONCE_TTL
+        if id_ttl is None:
+            id_ttl = DEFAULT_ID_TTL
+        if capacity is None:
+            capacity = DEFAULT_NONCE_CAPACITY
+        if id_capacity is None:
+            id_capacity = DEFAULT_ID_CAPACITY
+        if bucket_size is None:
+            bucket_size = DEFAULT_BUCKET_SIZE
+        if num_locks is None:
+            num_locks = DEFAULT_NUM_LOCKS
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        if max_probes is None:
+            max_probes = DEFAULT_MAX_PROBES
+        self.nonce_ttl = nonce_ttl
+        self.id_ttl = id_ttl
+        self.clock = clock
+        # The hash key is inherited by forked children along with the table,
+        # and stops clients from choosing nonces that collide on purpose.
+        self._hash_key = os.urandom(16)
+        locks = [multiprocessing.Lock() for _ in range(num_locks)]
+        self._ids = _SharedTable(id_capacity, bucket_size, _ID_SLOT, locks,
+                                 max_probes)
+        self._nonces = _SharedTable(capacity, bucket_size, _NONCE_SLOT, locks,
+                                    max_probes)
+
+    def __len__(self):
+        return sum(1 for _ in self._nonces.iter_live(self.clock()))
+
+    def _hash(self, *parts):
+        data = b"\0".join(part.encode("utf8") for part in parts)
+        digest = hashlib.blake2b(data, digest_size=8, key=self._hash_key)
+        # Zero marks an empty slot, so it's not a valid hash.
+        return struct.unpack("=Q", digest.digest())[0] or 1
+
+    def check_nonce(self, id, timestamp, nonce, now=None):
+        """Check if the given timestamp+nonce is fresh for the given id.
+
+        See NonceCache.check_nonce() for details.
+        """
+        if now is None:
+            now = self.clock()
+        # Get the clock skew to use for calculations.
+        # If no skew is cached, calculate it.
+        idhash = self._hash(id)
+        ids = self._ids
+        with ids.get_lock(idhash):
+            record = ids.find(idhash, now)
+            if record is not None:
+                skew = record[1]
+            else:
+                skew = now - timestamp
+                # Without a stored skew, old requests could be replayed
+                # with a fresh one, so fail closed if the table is full.
+                if not ids.insert(idhash, now, skew, now + self.id_ttl):
+                    return False
+        # If the adjusted timestamp is too old or too new, then
+        # we can reject it without even looking at the nonce.
+        timestamp = timestamp + skew
+        if abs(timestamp - now) >= self.nonce_ttl:
+            return False
+        # Otherwise, atomically check the nonce table
+        # and add the nonce to it if it's fresh.
+        noncehash = self._hash(id, nonce)
+        nonces = self._nonces
+        with nonces.get_lock(noncehash):
+            if nonces.find(noncehash, now) is not None:
+                return False
+            return nonces.insert(noncehash, now, timestamp + self.nonce_ttl)
+
+    def check_nonces(self, items, now=None):
+        """Check a batch of (id, timestamp, nonce) tuples for freshness.
+
+        This is equivalent to calling check_nonce() on each item in turn.
+        """
+        if now is None:
+            now = self.clock()
+        check_nonce = self.check_nonce
+        return [check_nonce(id, timestamp, nonce, now)
+                for (id, timestamp, nonce) in items]
@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Reusable object for signing outgoing requests.
+
+"""
+
+import os
+import time
+import hmac
+import threading
+from hashlib import sha1
+
+from macauthlib import utils
+
+try:
+    import requests
+except ImportError:  # pragma: nocover
+    requests = None
+
+if requests is not None:
+    from requests.auth import AuthBase as _AuthBase
+else:  # pragma: nocover
+    _AuthBase = object
+
+
+# Number of random bytes in each nonce, as used by sign_request().
+NONCE_SIZE = 5
+
+# Number of nonces generated each time the pool runs dry.
+DEFAULT_NONCE_POOL_SIZE = 1024
+
+
+class Signer(object):
+    """Object for signing requests with a fixed id and key.
+
+    This class produces the same signatures as macauthlib.sign_request(),
+    but does the per-key setup once rather than for every request:
+
+        * the HMAC object is initialised with the key once, and copied
+          for each request;
+        * nonces are drawn from a pool filled from os.urandom() in large
+          chunks, rather than with one system call per request;
+        * the Authorization header is formatted directly and stored into
+          the request, without going through WebOb's header handling.
+
+    Signer objects are safe to share between threads.  The nonce pool is
+    emptied in the child after os.fork(), so parent and child never use
+    the same nonces.
+    """
+
+    def __init__(self, id, key, hashmod=None, clock=None,
+                 nonce_pool_size=None):
+        if hashmod is None:
+            hashmod = sha1
+        if clock is None:
+            clock = time.time
+        if nonce_pool_size is None:
+            nonce_pool_size = DEFAULT_NONCE_POOL_SIZE
+        self.id = id
+        self.hashmod = hashmod
+        self.clock = clock
+        self.nonce_pool_size = nonce_pool_size
+        # The spec mandates that ids and keys must be ascii.
+        self._hmac = hmac.new(key.encode("ascii"), None, hashmod)
+        self._nonces = []
+        self._nonces_lock = threading.Lock()
+        utils.register_fork_hooks(self, after_in_child="_after_fork_child")
+
+    def _after_fork_child(self):
+        self._nonces = []
+        self._nonces_lock = threading.Lock()
+
+    def _refill_nonces(self):
+        with self._nonces_lock:
+            if not self._nonces:
+                size = self.nonce_pool_size
+                data = os.urandom(NONCE_SIZE * size)
+                b64encode = utils.b64encode
+                self._nonces = [b64encode(data[i:i + NONCE_SIZE])
+                                for i in range(0, len(data), NONCE_SIZE)]
+
+    def make_nonce(self):
+        """Get a fresh random nonce from the pool."""
+        while True:
+            try:
+                return self._nonces.pop()
+            except IndexError:
+                self._refill_nonces()
+
+    def sign(self, request, params=None):
+        """Sign the given request, returning the Authorization header.
+
+        The header is also stored into the request.  Any of the "ts",
+        "nonce" and "ext" parameters may be given in the "params" dict;
+        missing timestamps and nonces are generated automatically.
+        """
+        return self._sign(request, params, None)
+
+    def sign_many(self, requests, params=None):
+        """Sign a batch of requests, returning a list of their headers.
+
+        This is equivalent to calling sign() on each request in turn, except
+        that the clock is only read once for the whole batch.
+        """
+        ts = None
+        if params is None or "ts" not in params:
+            ts = str(int(self.clock()))
+        sign = self._sign
+        return [sign(request, params, ts) for request in requests]
+
+    def _sign(self, request, params, ts):
+        request = utils.normalize_request(request)
+        authz = self._make_header(request, params, ts)
+        request.store_authorization(authz)
+        return authz
+
+    def _make_header(self, request, params, ts):
+        if params is None:
+            params = {}
+        else:
+            params = params.copy()
+        params["id"] = self.id
+        if "ts" not in params:
+            if ts is None:
+                ts = str(int(self.clock()))
+            params["ts"] = ts
+        if "nonce" not in params:
+            params["nonce"] = self.make_nonce()
+        sigstr = utils.get_normalized_request_string(request, params)
+        hasher = self._hmac.copy()
+        hasher.update(sigstr.encode("ascii"))
+        mac = utils.b64encode(hasher.digest())
+        quote = utils.quote_auth_param
+        if "ext" in params:
+            authz = 'MAC id="%s", ts="%s", nonce="%s", ext="%s", mac="%s"' % (
+                quote(self.id), quote(params["ts"]), quote(params["nonce"]),
+                quote(params["ext"]), mac)
+        else:
+            authz = 'MAC id="%s", ts="%s", nonce="%s", mac="%s"' % (
+                quote(self.id), quote(params["ts"]), quote(params["nonce"]),
+                mac)
+        return authz
+
+
+class MACAuth(_AuthBase):
+    """Authentication plugin for the requests library.
+
+    Instances of this class can be used as the "auth" argument of any
+    requests function, or assigned to the "auth" attribute of a Session,
+    to sign each outgoing request with the given id and key::
+
+        session = requests.Session()
+        session.auth = macauthlib.MACAuth(id, key)
+        session.get("http://www.secret-data.com/get-my-data")
+
+    The signature is calculated directly from the prepared URL, and only
+    the Authorization header of the request is modified.  Signing is done
+    by a Signer, so a single MACAuth object can be shared by all the
+    threads using a session.
+    """
+
+    def __init__(self, id, key, hashmod=None, clock=None):
+        self.signer = Signer(id, key, hashmod, clock)
+
+    def __call__(self, request):
+        view = utils.PreparedRequestView(request)
+        view.store_authorization(self.signer._make_header(view, None, None))
+        return request
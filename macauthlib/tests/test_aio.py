@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import asyncio
+import unittest
+
+from webob import Request
+
+import macauthlib
+from macauthlib import sign_request
+from macauthlib.noncecache import NonceCache
+from macauthlib.verifier import (REASON_UNKNOWN_ID,
+                                 REASON_BAD_SIGNATURE,
+                                 REASON_NONCE)
+from macauthlib.aio import (AsyncVerifier,
+                            AsyncNonceCache,
+                            CoalescingKeyLookup,
+                            check_signature,
+                            sweep_forever)
+
+
+KEYS = {"myid": "mykey"}
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class SlowKeyLookup(object):
+    """Async key lookup that counts calls and takes a while to respond."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, id):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return KEYS.get(id)
+
+
+class TestAsyncVerification(unittest.TestCase):
+
+    def test_check_signature(self):
+        lookup = SlowKeyLookup()
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(run(check_signature(req, lookup)))
+        self.assertFalse(run(check_signature(req, lookup)))
+        self.assertTrue(run(check_signature(req, lookup, nonces=False)))
+        sign_request(req, "myid", "wrongkey")
+        self.assertFalse(run(check_signature(req, lookup, nonces=False)))
+
+    def test_verifier_reports_reject_reasons(self):
+        verifier = AsyncVerifier(SlowKeyLookup(), nonces=AsyncNonceCache())
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(run(verifier.verify(req)))
+        self.assertEquals(run(verifier.verify(req)).reason, REASON_NONCE)
+        sign_request(req, "otherid", "mykey")
+        self.assertEquals(run(verifier.verify(req)).reason, REASON_UNKNOWN_ID)
+        sign_request(req, "myid", "wrongkey")
+        self.assertEquals(run(verifier.verify(req)).reason,
+                          REASON_BAD_SIGNATURE)
+
+    def test_verifier_adapts_sync_nonce_caches(self):
+        nonces = NonceCache()
+        verifier = AsyncVerifier(SlowKeyLookup(), nonces=nonces)
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(run(verifier.verify(req)))
+        self.assertEquals(len(nonces), 1)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        lookup = SlowKeyLookup()
+        verifier = AsyncVerifier(lookup)
+        reqs = []
+        for i in range(5):
+            req = Request.blank("/%d" % (i,))
+            sign_request(req, "myid", "mykey")
+            reqs.append(req)
+
+        async def verify_all():
+            return await asyncio.gather(*[verifier.verify(r) for r in reqs])
+
+        self.assertTrue(all(run(verify_all())))
+        self.assertEquals(lookup.calls, 1)
+        # Once the lookup completes, new requests trigger a fresh lookup.
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(run(verifier.verify(req)))
+        self.assertEquals(lookup.calls, 2)
+
+    def test_concurrent_check_signature_calls_are_coalesced(self):
+        lookup = SlowKeyLookup()
+        reqs = []
+        for i in range(10):
+            req = Request.blank("/%d" % (i,))
+            sign_request(req, "myid", "mykey")
+            reqs.append(req)
+
+        async def check_all():
+            return await asyncio.gather(*[check_signature(r, lookup)
+                                          for r in reqs])
+
+        self.assertTrue(all(run(check_all())))
+        self.assertEquals(lookup.calls, 1)
+
+    def test_check_signature_shares_the_sync_nonce_cache(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(macauthlib.check_signature(req, "mykey"))
+        self.assertFalse(run(check_signature(req, SlowKeyLookup())))
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(run(check_signature(req, SlowKeyLookup())))
+        self.assertFalse(macauthlib.check_signature(req, "mykey"))
+
+    def test_coalesced_lookup_errors_are_shared(self):
+        async def failing_lookup(id):
+            await asyncio.sleep(0.01)
+            raise KeyError(id)
+
+        lookup = CoalescingKeyLookup(failing_lookup)
+
+        async def lookup_all():
+            return await asyncio.gather(lookup("a"), lookup("a"),
+                                        return_exceptions=True)
+
+        results = run(lookup_all())
+        self.assertTrue(all(isinstance(r, KeyError) for r in results))
+        self.assertEquals(lookup._pending, {})
+
+    def test_sweep_forever_reclaims_expired_nonces(self):
+        nonces = NonceCache(nonce_ttl=0.01, id_ttl=0.01)
+        nonces.check_nonce("id", time.time(), "abc")
+
+        async def sweep_for_a_while():
+            task = asyncio.ensure_future(sweep_forever(nonces, 0.01))
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+        run(sweep_for_a_while())
+        self.assertEquals(len(nonces._ids.items), 0)
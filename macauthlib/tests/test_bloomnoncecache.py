@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+
+from macauthlib.bloomnoncecache import BloomFilter, BloomNonceCache
+
+
+class TestBloomNonceCache(unittest.TestCase):
+
+    def test_operation(self, now=time.time):
+        timeout = 0.1
+        nc = BloomNonceCache(nonce_ttl=timeout, id_ttl=1, capacity=100)
+        self.assertTrue(nc.check_nonce("id", now(), "abc"))
+        self.assertFalse(nc.check_nonce("id", now(), "abc"))
+        self.assertTrue(nc.check_nonce("id", now(), "xyz"))
+        self.assertTrue(nc.check_nonce("otherid", now(), "abc"))
+        # Once its whole generation has left the window, the nonce is
+        # forgotten; this may be up to 3 * nonce_ttl after it was seen.
+        time.sleep(timeout * 3.5)
+        self.assertTrue(nc.check_nonce("id", now(), "abc"))
+        self.assertFalse(nc.check_nonce("id", now(), "abc"))
+        # If the timestamp is too old, even a fresh nonce will fail the check.
+        self.assertFalse(nc.check_nonce("id", now() - 2 * timeout, "ghi"))
+        self.assertFalse(nc.check_nonce("id", now() + 2 * timeout, "ghi"))
+        self.assertTrue(nc.check_nonce("id", now(), "ghi"))
+
+    def test_operation_with_forward_clock_skew(self):
+        def now():
+            return time.time() + 7
+        self.test_operation(now=now)
+
+    def test_nonces_are_never_forgotten_inside_the_window(self):
+        nc = BloomNonceCache(nonce_ttl=10, capacity=1000)
+        now = time.time()
+        self.assertTrue(nc.check_nonce("id", now, "start"))
+        # Spread timestamps across the whole window, at various fake
+        # server times, and replay each accepted nonce while it's live.
+        accepted = []
+        for i in range(2000):
+            ts = now + (i % 19) - 9
+            if nc.check_nonce("id", ts, str(i), now=now + (i % 7)):
+                accepted.append((ts, str(i)))
+        self.assertTrue(len(accepted) > 1000)
+        for (ts, nonce) in accepted:
+            self.assertFalse(nc.check_nonce("id", ts, nonce, now=now + 3))
+
+    def test_memory_is_fixed_and_error_rate_is_reported(self):
+        nc = BloomNonceCache(capacity=1000, error_rate=0.01)
+        sizes = [len(bloom.bits) for (_, bloom) in nc._filters]
+        self.assertEquals(nc.error_rate, 0.01)
+        self.assertEquals(nc.observed_error_rate(), 0)
+        now = time.time()
+        accepted = sum(1 for i in range(1000)
+                       if nc.check_nonce("id", now, "seen%d" % (i,)))
+        self.assertTrue(accepted > 990)
+        observed = nc.observed_error_rate()
+        self.assertTrue(0 < observed < 0.01)
+        # Measure the actual false positive rate without adding anything.
+        bloom = nc._filters[int(now // nc.generation_width) % 2][1]
+        false_rejects = sum(1 for i in range(10000)
+                            if nc._digest("id", "new%d" % (i,)) in bloom)
+        self.assertTrue(false_rejects < 10000 * 0.02)
+        self.assertEquals(sizes, [len(bloom.bits)
+                                  for (_, bloom) in nc._filters])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(100, 0.01)
+        digest = b"0123456789abcdef"
+        self.assertFalse(digest in bloom)
+        bloom.add(digest)
+        self.assertTrue(digest in bloom)
+        self.assertTrue(bloom.fill_ratio() > 0)
+        bloom.clear()
+        self.assertFalse(digest in bloom)
+        self.assertEquals(bloom.fill_ratio(), 0)
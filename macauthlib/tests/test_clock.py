@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import unittest
+
+from webob import Request
+
+from macauthlib import sign_request, get_id, utils
+from macauthlib.clock import MonotonicClock, CoarseClock, FakeClock
+from macauthlib.noncecache import NonceCache, Cache, RingCache
+from macauthlib.bloomnoncecache import BloomNonceCache
+from macauthlib.sharednoncecache import SharedNonceCache
+from macauthlib.verifier import Verifier
+
+
+class TestClocks(unittest.TestCase):
+
+    def test_monotonic_clock_ignores_system_time_changes(self):
+        clock = MonotonicClock()
+        self.assertTrue(abs(clock() - time.time()) < 1)
+        real_time = time.time
+        time.time = lambda: real_time() - 3600
+        try:
+            self.assertTrue(abs(clock() - real_time()) < 1)
+            self.assertTrue(abs(MonotonicClock()() - time.time()) < 1)
+        finally:
+            time.time = real_time
+
+    def test_coarse_clock_only_changes_on_ticks(self):
+        fake = FakeClock(1000)
+        clock = CoarseClock(fake, resolution=0.01)
+        try:
+            self.assertEquals(clock(), 1000)
+            fake.advance(5)
+            self.assertEquals(clock(), 1000)
+            time.sleep(0.1)
+            self.assertEquals(clock(), 1005)
+        finally:
+            clock.stop()
+        fake.advance(5)
+        clock.tick()
+        self.assertEquals(clock.now, 1010)
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "needs fork hooks")
+    def test_coarse_clock_keeps_ticking_in_forked_child(self):
+        fake = FakeClock(1000)
+        clock = CoarseClock(fake, resolution=0.001)
+        clock()
+        try:
+            pid = os.fork()
+            if pid == 0:  # pragma nocover
+                ok = False
+                try:
+                    fake.advance(5)
+                    time.sleep(0.1)
+                    ok = clock() == 1005
+                    clock.stop()
+                finally:
+                    os._exit(0 if ok else 1)
+            (_, status) = os.waitpid(pid, 0)
+            self.assertEquals(status, 0)
+        finally:
+            clock.stop()
+
+    def test_nonce_cache_with_fake_clock(self):
+        clock = FakeClock()
+        nc = NonceCache(nonce_ttl=10, clock=clock)
+        self.assertTrue(nc.check_nonce("id", clock(), "abc"))
+        self.assertFalse(nc.check_nonce("id", clock(), "abc"))
+        clock.advance(10.5)
+        self.assertTrue(nc.check_nonce("id", clock(), "abc"))
+        self.assertFalse(nc.check_nonce("id", clock() - 20, "xyz"))
+        cache = Cache(10, clock=clock)
+        cache.set("hello", "world")
+        clock.advance(11)
+        self.assertFalse("hello" in cache)
+        self.assertRaises(KeyError, cache.get, "hello")
+
+    def test_nonce_stores_share_the_cache_clock(self):
+        clock = FakeClock(1000)
+        for engine in (Cache, RingCache):
+            nc = NonceCache(nonce_ttl=10, engine=engine, clock=clock)
+            self.assertTrue(nc.check_nonce("id", clock(), "abc"))
+            nonces = nc._ids.get("id")[1]
+            self.assertTrue(nonces.clock is clock)
+            self.assertTrue("abc" in nonces)
+            clock.advance(11)
+            self.assertFalse("abc" in nonces)
+
+    def test_bloom_and_shared_caches_with_fake_clock(self):
+        clock = FakeClock(1000)
+        caches = [BloomNonceCache(nonce_ttl=10, capacity=100, clock=clock)]
+        if hasattr(os, "fork"):
+            caches.append(SharedNonceCache(nonce_ttl=10, capacity=100,
+                                           clock=clock))
+        for nc in caches:
+            self.assertTrue(nc.check_nonce("id", clock(), "abc"))
+            self.assertFalse(nc.check_nonce("id", clock(), "abc"))
+            clock.advance(35)
+            self.assertTrue(nc.check_nonce("id", clock(), "abc"))
+            self.assertFalse(nc.check_nonce("id", clock() - 20, "xyz"))
+
+    def test_verifier_uses_the_nonce_cache_clock(self):
+        clock = FakeClock()
+        nonces = NonceCache(clock=clock)
+        verifier = Verifier({"id": "key"}.get, nonces=nonces)
+        self.assertTrue(verifier.clock is clock)
+        verifier = Verifier({"id": "key"}.get, clock=clock)
+        self.assertTrue(verifier.nonces.clock is clock)
+
+    def test_sign_request_with_clock(self):
+        req = Request.blank("/")
+        sign_request(req, "id", "key", clock=FakeClock(1234.5))
+        self.assertEquals(get_id(req), "id")
+        self.assertEquals(utils.parse_authz_header(req)["ts"], "1234")
@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from webob import Request
+
+from macauthlib import sign_request, get_signature, check_signature
+from macauthlib import instrument
+from macauthlib.instrument import (StageStats,
+                                   instrumented,
+                                   STAGE_NORMALIZE,
+                                   STAGE_PARSE,
+                                   STAGE_STRING,
+                                   STAGE_HMAC,
+                                   STAGE_SIGNATURE,
+                                   STAGE_COMPARE,
+                                   STAGE_NONCE,
+                                   STAGE_HEADER,
+                                   STAGE_TOTAL)
+
+
+class RecordingHook(object):
+
+    def __init__(self):
+        self.reports = []
+
+    def __call__(self, operation, stage, duration, outcome):
+        assert duration >= 0
+        self.reports.append((operation, stage, outcome))
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_no_timers_are_created_without_hooks(self):
+        self.assertEquals(instrument.start("op"), None)
+        self.assertEquals(instrument.current(), None)
+
+    def test_stages_of_each_operation_are_reported(self):
+        req = Request.blank("/")
+        hook = RecordingHook()
+        with instrumented(hook):
+            sign_request(req, "myid", "mykey")
+            get_signature(req, "mykey")
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+            self.assertFalse(check_signature(req, "badkey", nonces=False))
+        sign_request(req, "myid", "mykey")
+        get_signature_reports = [
+            ("get_signature", STAGE_NORMALIZE, None),
+            ("get_signature", STAGE_STRING, None),
+            ("get_signature", STAGE_HMAC, None),
+            ("get_signature", STAGE_TOTAL, True),
+        ]
+        check_signature_reports = [
+            ("check_signature", STAGE_NORMALIZE, None),
+            ("check_signature", STAGE_PARSE, None),
+        ] + get_signature_reports + [
+            ("check_signature", STAGE_SIGNATURE, None),
+            ("check_signature", STAGE_COMPARE, None),
+        ]
+        self.assertEquals(hook.reports, [
+            ("sign_request", STAGE_NORMALIZE, None),
+            ("sign_request", STAGE_PARSE, None),
+        ] + get_signature_reports + [
+            ("sign_request", STAGE_SIGNATURE, None),
+            ("sign_request", STAGE_HEADER, None),
+            ("sign_request", STAGE_TOTAL, True),
+            ("get_signature", STAGE_NORMALIZE, None),
+            ("get_signature", STAGE_PARSE, None),
+        ] + get_signature_reports[1:] + check_signature_reports + [
+            ("check_signature", STAGE_TOTAL, True),
+        ] + check_signature_reports + [
+            ("check_signature", STAGE_TOTAL, False),
+        ])
+        self.assertEquals(instrument._hooks, ())
+        self.assertEquals(instrument._local.timers, [])
+
+    def test_nonce_stage_and_errors_are_reported(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        hook = RecordingHook()
+        with instrumented(hook):
+            self.assertTrue(check_signature(req, "mykey"))
+            self.assertRaises(UnicodeEncodeError,
+                              get_signature, req, u"\N{SNOWMAN}")
+        self.assertTrue(("check_signature", STAGE_NONCE, None)
+                        in hook.reports)
+        self.assertEquals(hook.reports[-1],
+                          ("get_signature", STAGE_TOTAL, "error"))
+        self.assertEquals(instrument._local.timers, [])
+
+    def test_stage_stats_aggregation(self):
+        stats = StageStats(buckets=(0.001, 0.01))
+        stats("check_signature", STAGE_HMAC, 0.0005, None)
+        stats("check_signature", STAGE_HMAC, 0.005, None)
+        stats("check_signature", STAGE_HMAC, 0.5, None)
+        stats("check_signature", STAGE_TOTAL, 0.5, True)
+        stats("check_signature", STAGE_TOTAL, 0.005, False)
+        summary = stats.summary()
+        hmac_summary = summary[("check_signature", STAGE_HMAC)]
+        self.assertEquals(hmac_summary["count"], 3)
+        self.assertAlmostEquals(hmac_summary["mean"], 0.5055 / 3)
+        self.assertEquals(hmac_summary["p50"], 0.01)
+        self.assertEquals(hmac_summary["p99"], float("inf"))
+        text = stats.render_prometheus()
+        lines = text.splitlines()
+        self.assertTrue("# TYPE macauthlib_stage_duration_seconds histogram"
+                        in lines)
+        self.assertTrue('macauthlib_stage_duration_seconds_bucket{'
+                        'operation="check_signature",stage="hmac",'
+                        'le="0.01"} 2' in lines)
+        self.assertTrue('macauthlib_stage_duration_seconds_count{'
+                        'operation="check_signature",stage="hmac"} 3'
+                        in lines)
+        self.assertTrue('macauthlib_outcomes_total{'
+                        'operation="check_signature",outcome="false"} 1'
+                        in lines)
+        stats.clear()
+        self.assertEquals(stats.summary(), {})
+
+    def test_stage_stats_as_a_hook(self):
+        req = Request.blank("/")
+        stats = StageStats()
+        with instrumented(stats):
+            for _ in range(5):
+                sign_request(req, "myid", "mykey")
+        summary = stats.summary()
+        self.assertEquals(summary[("sign_request", STAGE_TOTAL)]["count"], 5)
+        self.assertEquals(summary[("get_signature", STAGE_HMAC)]["count"], 5)
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import hmac
+import unittest
+from hashlib import sha1, sha256
+
+from webob import Request
+
+from macauthlib import sign_request, get_signature, check_signature
+from macauthlib.keycache import HMACKeyCache
+
+
+class TestHMACKeyCache(unittest.TestCase):
+
+    def test_cached_hmac_matches_fresh_hmac(self):
+        cache = HMACKeyCache()
+        for _ in range(3):
+            for hashmod in (sha1, sha256):
+                mac = cache.get_hmac("id", "key", hashmod)
+                mac.update(b"hello world")
+                expected = hmac.new(b"key", b"hello world", hashmod)
+                self.assertEquals(mac.digest(), expected.digest())
+        self.assertEquals(len(cache), 1)
+
+    def test_cached_state_is_not_shared_between_callers(self):
+        cache = HMACKeyCache()
+        mac1 = cache.get_hmac("id", "key", sha1)
+        mac1.update(b"one")
+        mac2 = cache.get_hmac("id", "key", sha1)
+        mac2.update(b"two")
+        expected = hmac.new(b"key", b"two", sha1)
+        self.assertEquals(mac2.digest(), expected.digest())
+
+    def test_changed_key_is_never_served_from_cache(self):
+        cache = HMACKeyCache()
+        cache.get_hmac("id", "oldkey", sha1)
+        mac = cache.get_hmac("id", "newkey", sha1)
+        expected = hmac.new(b"newkey", b"", sha1)
+        self.assertEquals(mac.digest(), expected.digest())
+
+    def test_cache_respects_max_size_and_ttl(self):
+        timeout = 0.1
+        cache = HMACKeyCache(max_size=2, ttl=timeout)
+        cache.get_hmac("one", "key", sha1)
+        cache.get_hmac("two", "key", sha1)
+        cache.get_hmac("one", "key", sha1)
+        cache.get_hmac("three", "key", sha1)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(sorted(cache._items), ["one", "three"])
+        old_item = cache._items["one"]
+        time.sleep(timeout)
+        cache.get_hmac("one", "key", sha1)
+        self.assertTrue(cache._items["one"] is not old_item)
+
+    def test_invalidate_and_clear(self):
+        cache = HMACKeyCache()
+        cache.get_hmac("one", "key", sha1)
+        cache.get_hmac("two", "key", sha1)
+        cache.invalidate("one")
+        cache.invalidate("unknown")
+        self.assertEquals(sorted(cache._items), ["two"])
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+
+    def test_signature_functions_accept_a_keycache(self):
+        cache = HMACKeyCache()
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertEquals(get_signature(req, "mykey", keycache=cache),
+                          get_signature(req, "mykey"))
+        self.assertTrue(check_signature(req, "mykey", keycache=cache))
+        self.assertFalse(check_signature(req, "wrongkey", keycache=cache,
+                                         nonces=False))
+        self.assertEquals(len(cache), 1)
@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from macauthlib import Verifier, check_signature
+from macauthlib.clock import FakeClock
+from macauthlib.noncecache import NonceCache
+from macauthlib.loadgen import (TrafficGenerator,
+                                EXPECTED,
+                                KIND_VALID,
+                                KIND_LARGE_QUERY,
+                                KIND_REPLAY,
+                                KIND_STALE,
+                                KIND_MALFORMED,
+                                environ_to_http,
+                                main)
+
+
+NOW = 1400000000
+
+
+def make_generator(**kwds):
+    kwds.setdefault("seed", 42)
+    kwds.setdefault("now", NOW)
+    kwds.setdefault("num_ids", 20)
+    kwds.setdefault("replay_rate", 0.1)
+    kwds.setdefault("stale_rate", 0.1)
+    kwds.setdefault("malformed_rate", 0.1)
+    kwds.setdefault("large_query_rate", 0.05)
+    kwds.setdefault("query_size", 1000)
+    return TrafficGenerator(**kwds)
+
+
+class TestLoadGen(unittest.TestCase):
+
+    def test_output_is_deterministic_from_the_seed(self):
+        requests1 = list(make_generator().generate(200))
+        requests2 = list(make_generator().generate(200))
+        requests3 = list(make_generator(seed=7).generate(200))
+        self.assertEquals(requests1, requests2)
+        self.assertNotEquals(requests1, requests3)
+
+    def test_requests_verify_as_expected(self):
+        generator = make_generator()
+        clock = FakeClock(NOW)
+        verifier = Verifier(generator.key_lookup,
+                            nonces=NonceCache(clock=clock))
+        kinds = set()
+        for request in generator.generate(2000):
+            kinds.add(request.kind)
+            result = verifier.verify(request.environ)
+            self.assertEquals(bool(result), EXPECTED[request.kind])
+        self.assertEquals(kinds, set(EXPECTED))
+
+    def test_default_mix_is_all_valid(self):
+        generator = TrafficGenerator(num_ids=5)
+        for request in generator.generate(50):
+            self.assertEquals(request.kind, KIND_VALID)
+            key = generator.key_lookup(request.id)
+            self.assertTrue(check_signature(request.environ, key))
+
+    def test_large_queries_have_the_requested_size(self):
+        generator = make_generator(large_query_rate=1, replay_rate=0,
+                                   stale_rate=0, malformed_rate=0)
+        for request in generator.generate(10):
+            self.assertEquals(request.kind, KIND_LARGE_QUERY)
+            query = request.environ["QUERY_STRING"]
+            self.assertTrue(1000 <= len(query) < 1100)
+
+    def test_id_skew_favours_popular_ids(self):
+        generator = make_generator(num_ids=100, id_skew=2.0)
+        ids = [request.id for request in generator.generate(500)
+               if request.kind != KIND_REPLAY]
+        self.assertTrue(ids.count("id0") > len(ids) / 2)
+
+    def test_rates_must_not_exceed_one(self):
+        self.assertRaises(ValueError, TrafficGenerator,
+                          replay_rate=0.6, stale_rate=0.6)
+
+    def test_http_output_can_be_verified(self):
+        generator = make_generator(replay_rate=0)
+        for request in generator.generate(50):
+            key = generator.key_lookup(request.id)
+            data = environ_to_http(request.environ)
+            self.assertTrue(data.endswith(b"\r\n\r\n"))
+            if request.kind in (KIND_VALID, KIND_LARGE_QUERY, KIND_STALE):
+                self.assertTrue(check_signature(data, key, nonces=False))
+            else:
+                self.assertEquals(request.kind, KIND_MALFORMED)
+                self.assertFalse(check_signature(data, key, nonces=False))
+
+    def test_command_line(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tempdir, "out")
+            keys = os.path.join(tempdir, "keys")
+            args = ["-n", "20", "--now", str(NOW), "--num-ids", "3",
+                    "--format", "environ", "--keys", keys, "-o", output]
+            self.assertEquals(main(args), 0)
+            with open(keys) as f:
+                keys = json.load(f)
+            self.assertEquals(sorted(keys), ["id0", "id1", "id2"])
+            with io.open(output, "rb") as f:
+                lines = f.read().decode("ascii").splitlines()
+            self.assertEquals(len(lines), 20)
+            for line in lines:
+                request = json.loads(line)
+                self.assertEquals(request["kind"], KIND_VALID)
+                self.assertTrue(check_signature(request["environ"],
+                                                keys[request["id"]],
+                                                nonces=False))
+            args = ["-n", "20", "--now", str(NOW), "-o", output]
+            self.assertEquals(main(args), 0)
+            with io.open(output, "rb") as f:
+                self.assertEquals(f.read().count(b"HTTP/1.1\r\n"), 20)
+        finally:
+            shutil.rmtree(tempdir)
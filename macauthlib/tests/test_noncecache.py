@@ -2,10 +2,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import time
+import random
+import threading
 import unittest
 
-from macauthlib.noncecache import NonceCache, Cache, KeyExistsError
+from macauthlib.noncecache import (APPROX_ID_SIZE,
+                                   APPROX_NONCE_SIZE,
+                                   NonceCache,
+                                   ShardedNonceCache,
+                                   CompactNonceCache,
+                                   Cache,
+                                   RingCache,
+                                   Sweeper,
+                                   KeyExistsError)
+from macauthlib.clock import FakeClock
 
 
 class TestNonceCache(unittest.TestCase):
@@ -15,9 +27,12 @@ class TestNonceCache(unittest.TestCase):
         self.assertEquals(nc.nonce_ttl,  30)
         self.assertEquals(nc.id_ttl,  60 * 60)
 
-    def test_operation(self, now=time.time):
+    def test_operation(self, now=time.time, engine=None, cls=None):
         timeout = 0.1
-        nc = NonceCache(nonce_ttl=timeout, id_ttl=1)
+        if cls is None:
+            nc = NonceCache(nonce_ttl=timeout, id_ttl=1, engine=engine)
+        else:
+            nc = cls(nonce_ttl=timeout, id_ttl=1)
         # Initially nothing is cached, so all nonces as fresh.
         self.assertEquals(nc.nonce_ttl, 0.1)
         self.assertEquals(len(nc), 0)
@@ -54,6 +69,416 @@ class TestNonceCache(unittest.TestCase):
             return time.time() + 7
         self.test_operation(now=now)
 
+    def test_check_nonces_checks_a_batch_at_once(self):
+        nc = NonceCache(nonce_ttl=1)
+        now = time.time()
+        self.assertTrue(nc.check_nonce("id1", now, "abc"))
+        results = nc.check_nonces([("id1", now, "abc"),
+                                   ("id1", now, "def"),
+                                   ("id2", now, "abc"),
+                                   ("id2", now, "abc"),
+                                   ("id1", now - 10, "ghi")])
+        self.assertEquals(results, [False, True, True, False, False])
+        self.assertEquals(len(nc), 3)
+
+    def test_concurrent_checks_of_a_nonce_succeed_only_once(self):
+        nc = NonceCache()
+        now = time.time()
+        results = []
+
+        def check():
+            results.append(nc.check_nonce("id", now, "abc"))
+
+        threads = [threading.Thread(target=check) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(results), [False] * 19 + [True])
+
+    def test_sharded_nonce_cache(self):
+        nc = ShardedNonceCache(nonce_ttl=1, num_shards=4)
+        self.assertEquals(len(nc.shards), 4)
+        self.assertEquals(nc.nonce_ttl, 1)
+        now = time.time()
+        for i in range(20):
+            self.assertTrue(nc.check_nonce("id%d" % (i,), now, "abc"))
+            self.assertFalse(nc.check_nonce("id%d" % (i,), now, "abc"))
+        self.assertFalse(nc.check_nonce("id0", now - 10, "def"))
+        self.assertEquals(len(nc), 20)
+        self.assertTrue(sum(1 for shard in nc.shards if len(shard)) > 1)
+        results = nc.check_nonces([("id0", now, "abc"),
+                                   ("id0", now, "def"),
+                                   ("id1", now, "def"),
+                                   ("id99", now, "def"),
+                                   ("id99", now, "def")])
+        self.assertEquals(results, [False, True, True, True, False])
+        self.assertEquals(len(nc), 23)
+
+    def test_cache_add_is_check_and_insert(self):
+        cache = Cache(0.1)
+        self.assertTrue(cache.add("hello", "world"))
+        self.assertFalse(cache.add("hello", "spamityspam"))
+        self.assertEquals(cache.get("hello"), "world")
+
+    def test_operation_with_ring_cache_engine(self):
+        self.test_operation(engine=RingCache)
+
+    def test_operation_with_ring_cache_engine_and_clock_skew(self):
+        def now():
+            return time.time() + 7
+        self.test_operation(now=now, engine=RingCache)
+
+    def test_ring_cache_drops_expired_buckets(self):
+        timeout = 0.1
+        cache = RingCache(timeout, num_buckets=5)
+        for i in range(10):
+            self.assertTrue(cache.add(i))
+        self.assertFalse(cache.add(3))
+        self.assertTrue(3 in cache)
+        self.assertEquals(len(cache), 10)
+        time.sleep(timeout * 1.5)
+        self.assertFalse(3 in cache)
+        self.assertTrue(cache.add("new"))
+        time.sleep(timeout * 2.5)
+        self.assertTrue(cache.add("newer"))
+        self.assertEquals(len(cache), 1)
+        # Timestamps too far in the future can't be stored.
+        self.assertRaises(ValueError, cache.add, "x", True,
+                          time.time() + 2 * timeout)
+
+    def test_ring_cache_keeps_keys_re_added_to_a_later_bucket(self):
+        clock = FakeClock(1000)
+        cache = RingCache(10, num_buckets=5, clock=clock)
+        self.assertTrue(cache.add("a", True, 994))
+        self.assertTrue(cache.add("b", True, 995))
+        clock.set(1004.5)
+        # The old entry for "a" has expired, so it can be added again.
+        self.assertTrue(cache.add("a", True, 1004))
+        self.assertEquals(len(cache), 2)
+        # Dropping the old bucket forgets "b" but not the new "a".
+        clock.set(1007)
+        self.assertTrue(cache.add("c"))
+        self.assertEquals(sorted(cache.keys), ["a", "c"])
+        self.assertTrue("a" in cache)
+        self.assertFalse(cache.add("a", True, 1004))
+
+    def test_memory_usage_is_reported(self):
+        nc = NonceCache()
+        self.assertEquals(nc.memory_usage(), 0)
+        nc.check_nonce("one", time.time(), "abc")
+        nc.check_nonce("one", time.time(), "def")
+        nc.check_nonce("two", time.time(), "abc")
+        expected = 2 * APPROX_ID_SIZE + 3 * APPROX_NONCE_SIZE
+        self.assertEquals(nc.memory_usage(), expected)
+        nc = NonceCache(max_bytes=10 * APPROX_ID_SIZE)
+        nc.check_nonce("one", time.time(), "abc")
+        nc.check_nonce("one", time.time(), "def")
+        nc.check_nonce("two", time.time(), "abc")
+        self.assertEquals(nc.memory_usage(), expected)
+
+    def test_max_bytes_evicts_least_recently_active_ids(self):
+        budget = 3 * (APPROX_ID_SIZE + APPROX_NONCE_SIZE)
+        nc = NonceCache(max_bytes=budget)
+        now = time.time()
+        self.assertTrue(nc.check_nonce("hot", now, "n0", now))
+        self.assertTrue(nc.check_nonce("idle1", now, "n0", now))
+        self.assertTrue(nc.check_nonce("idle2", now, "n0", now))
+        self.assertEquals(nc.memory_usage(), budget)
+        # Activity by "hot" keeps it, while the idle ids are evicted.
+        self.assertTrue(nc.check_nonce("hot", now, "n1", now))
+        self.assertFalse(nc.check_nonce("hot", now, "n0", now))
+        self.assertTrue(nc.check_nonce("new", now, "n0", now))
+        self.assertEquals(sorted(nc._ids.items), ["hot", "new"])
+        self.assertTrue(nc.memory_usage() <= budget)
+        self.assertFalse(nc.check_nonce("hot", now, "n1", now))
+        # Batch checks are subject to the same budget, which also counts
+        # the queue entries left behind by evicted ids.
+        nc.check_nonces([("a", now, "n"), ("b", now, "n"), ("c", now, "n")])
+        self.assertEquals(sorted(nc._ids.items), ["b", "c"])
+        self.assertTrue(nc.memory_usage() <= budget)
+
+    def test_max_bytes_bounds_the_purge_queue(self):
+        budget = 100 * APPROX_ID_SIZE
+        nc = NonceCache(max_bytes=budget)
+        now = time.time()
+        for i in range(5000):
+            self.assertTrue(nc.check_nonce("id%d" % (i,), now, "n", now))
+            live = len(nc._ids.items)
+            self.assertTrue(len(nc._ids.purge_queue) <= 2 * live + 1)
+            self.assertTrue(nc.memory_usage() <= budget)
+        self.assertTrue(len(nc._ids.purge_queue) < 200)
+        self.assertEquals(len(nc), len(nc._ids.items))
+        nc.sweep(now + 10 ** 4, budget=1000)
+        self.assertEquals(len(nc), 0)
+        self.assertEquals(nc._ids.purge_queue, [])
+        self.assertEquals(nc._ids.stale, 0)
+        self.assertEquals(nc.memory_usage(), 0)
+
+    def test_max_bytes_usage_tracks_expiry(self):
+        nc = NonceCache(nonce_ttl=1, id_ttl=10, max_bytes=10 ** 6)
+        now = time.time()
+        nc.check_nonce("one", now, "abc", now)
+        nc.check_nonce("two", now, "abc", now)
+        nc.sweep(now + 5)
+        self.assertEquals(nc.memory_usage(), 2 * APPROX_ID_SIZE)
+        nc.sweep(now + 20)
+        self.assertEquals(nc.memory_usage(), 0)
+        shards = ShardedNonceCache(max_bytes=10 ** 6, num_shards=4)
+        self.assertEquals(shards.shards[0].max_bytes, 250000)
+        shards.check_nonce("one", now, "abc", now)
+        self.assertEquals(shards.memory_usage(),
+                          APPROX_ID_SIZE + APPROX_NONCE_SIZE)
+
+    def test_stats_snapshot_counts_operations(self):
+        nc = NonceCache(nonce_ttl=1, id_ttl=10, max_size=2)
+        now = time.time()
+        self.assertTrue(nc.check_nonce("one", now, "a", now))
+        self.assertFalse(nc.check_nonce("one", now, "a", now))
+        self.assertFalse(nc.check_nonce("one", now + 5, "b", now))
+        for nonce in "bcd":
+            self.assertTrue(nc.check_nonce("two", now, nonce, now))
+        stats = nc.stats()
+        self.assertEquals(stats["ids"], 2)
+        self.assertEquals(stats["nonces"], 3)
+        self.assertEquals(stats["inserts"], 4)
+        self.assertEquals(stats["replays"], 1)
+        self.assertEquals(stats["window_rejects"], 1)
+        self.assertEquals(stats["evicted_nonces"], 1)
+        self.assertEquals(stats["expired_nonces"], 0)
+        nc.sweep(now + 5)
+        stats = nc.stats()
+        self.assertEquals(stats["nonces"], 0)
+        self.assertEquals(stats["expired_nonces"], 3)
+        nc.sweep(now + 20)
+        stats = nc.stats()
+        self.assertEquals(stats["ids"], 0)
+        self.assertEquals(stats["expired_ids"], 2)
+        self.assertEquals(len(nc), 0)
+
+    def test_len_is_maintained_incrementally(self, engine=None):
+        nc = NonceCache(nonce_ttl=2, id_ttl=3, max_size=5, engine=engine)
+        start = time.time()
+        for i in range(200):
+            now = start + i * 0.005
+            nc.check_nonce("id%d" % (i % 7,), now, "n%d" % (i % 13,), now)
+            nc.check_nonce("id%d" % (i % 7,), now, "n%d" % (i % 13,), now)
+            nc.sweep(now, budget=3)
+            expected = sum(len(item.value[1])
+                           for item in nc._ids.items.values())
+            self.assertEquals(len(nc), expected)
+
+    def test_len_is_maintained_incrementally_with_ring_cache(self):
+        self.test_len_is_maintained_incrementally(engine=RingCache)
+
+    def test_len_stays_accurate_as_ids_expire(self):
+        # Replacing an expired id must count its nonces only once.
+        clock = FakeClock(1000)
+        nc = NonceCache(nonce_ttl=30, id_ttl=60, clock=clock)
+        for i in range(5):
+            nc.check_nonce("a", clock(), "n%d" % (i,))
+        clock.advance(61)
+        nc.check_nonce("a", clock(), "fresh")
+        self.assertEquals(len(nc), 1)
+        self.assertEquals(nc.stats()["expired_nonces"], 5)
+        # Over a long random run, with ids expiring and being replaced.
+        for engine in (None, RingCache):
+            for max_bytes in (None, 20000):
+                rng = random.Random(1)
+                nc = NonceCache(nonce_ttl=5, id_ttl=12, engine=engine,
+                                max_bytes=max_bytes, clock=clock)
+                for i in range(5000):
+                    clock.advance(rng.random() * 0.2)
+                    ts = int(clock()) + rng.randint(-3, 3)
+                    nc.check_nonce("id%d" % (rng.randint(0, 40),), ts,
+                                   "n%d" % (rng.randint(0, 300),))
+                    if i % 500 == 0:
+                        nc.sweep(budget=50)
+                    expected = sum(len(item.value[1])
+                                   for item in nc._ids.items.values())
+                    self.assertEquals(len(nc), expected)
+
+    def test_stats_include_lock_wait_time(self):
+        nc = ShardedNonceCache(num_shards=1)
+        shard = nc.shards[0]
+        shard._cache_lock.acquire()
+        thread = threading.Thread(target=nc.check_nonce,
+                                  args=("id", time.time(), "abc"))
+        thread.start()
+        time.sleep(0.05)
+        shard._cache_lock.release()
+        thread.join()
+        stats = nc.stats()
+        self.assertTrue(stats["lock_wait"] >= 0.04)
+        self.assertEquals(stats["inserts"], 1)
+
+    def test_cache_purge_is_bounded_by_budget(self):
+        cache = Cache(1)
+        now = time.time()
+        for i in range(10):
+            cache.set(i, i, now)
+        self.assertEquals(cache.purge_locked(now + 0.5), 0)
+        self.assertEquals(cache.purge_locked(now + 2, budget=3), 3)
+        self.assertEquals(cache.purge_locked(now + 2), 7)
+        self.assertEquals(len(cache), 0)
+
+    def test_ring_cache_respects_max_size(self):
+        cache = RingCache(10, max_size=3, num_buckets=10)
+        now = time.time()
+        cache.add("a", True, now - 5)
+        cache.add("b", True, now - 5)
+        cache.add("c", True, now)
+        self.assertEquals(len(cache), 3)
+        # The oldest bucket is dropped to make room.
+        cache.add("d", True, now)
+        self.assertEquals(len(cache), 2)
+        self.assertFalse("a" in cache)
+        self.assertTrue("c" in cache)
+        self.assertTrue("d" in cache)
+
+    def test_operation_with_compact_nonce_cache(self):
+        self.test_operation(cls=CompactNonceCache)
+
+    def test_operation_with_compact_nonce_cache_and_clock_skew(self):
+        def now():
+            return time.time() - 13
+        self.test_operation(now=now, cls=CompactNonceCache)
+
+    def test_compact_nonce_cache_compacts_expired_nonces(self):
+        nc = CompactNonceCache(nonce_ttl=10)
+        now = time.time()
+        for i in range(20):
+            self.assertTrue(nc.check_nonce("id", now, "old%d" % (i,), now))
+        self.assertEquals(len(nc._ids["id"].nonces), 20)
+        # Once the old nonces expire they are compacted out on the next
+        # insert that reaches the limit, and their slots can be reused.
+        later = now + 20
+        for i in range(20):
+            self.assertTrue(nc.check_nonce("id", later, "new%d" % (i,), later))
+        state = nc._ids["id"]
+        self.assertEquals(len(state.nonces), 20)
+        self.assertEquals(len(state.nonces), len(state.nonce_expiries))
+        self.assertFalse(nc.check_nonce("id", later, "new0", later))
+        self.assertTrue(nc.check_nonce("id", later, "old0", later))
+        self.assertFalse(nc.check_nonce("id", later, "old0", later))
+
+    def test_compact_nonce_cache_keeps_nonces_sorted(self):
+        nc = CompactNonceCache(nonce_ttl=10)
+        now = time.time()
+        for i in range(3000):
+            ts = now + (i % 7) - 3
+            self.assertTrue(nc.check_nonce("id", ts, "n%d" % (i,), now))
+        state = nc._ids["id"]
+        self.assertEquals(list(state.nonces), sorted(state.nonces))
+        for i in range(0, 3000, 17):
+            self.assertFalse(nc.check_nonce("id", now, "n%d" % (i,), now))
+        # Compaction keeps the arrays sorted and in step with each other.
+        later = now + 15
+        for i in range(3000):
+            self.assertTrue(nc.check_nonce("id", later, "m%d" % (i,), later))
+        state = nc._ids["id"]
+        self.assertEquals(list(state.nonces), sorted(state.nonces))
+        self.assertEquals(len(state.nonces), len(state.nonce_expiries))
+        self.assertFalse(nc.check_nonce("id", later, "m0", later))
+
+    def test_compact_nonce_cache_respects_max_size(self):
+        nc = CompactNonceCache(max_size=10)
+        now = time.time()
+        for i in range(50):
+            self.assertTrue(nc.check_nonce("id", now, "n%d" % (i,), now))
+        self.assertTrue(len(nc._ids["id"].nonces) <= 10)
+        for i in range(50):
+            self.assertTrue(nc.check_nonce("id%d" % (i,), now, "n", now))
+        self.assertTrue(len(nc._ids) <= 10)
+        self.assertFalse("id" in nc._ids)
+        # The most recent nonces and ids are still remembered.
+        self.assertFalse(nc.check_nonce("id49", now, "n", now))
+        self.assertFalse(nc.check_nonce("id48", now, "n", now))
+        nc = CompactNonceCache(max_size=3)
+        for i in range(5):
+            self.assertTrue(nc.check_nonce("id", now, "n%d" % (i,), now))
+            self.assertTrue(len(nc._ids["id"].nonces) <= 3)
+
+    def test_sweep_reclaims_expired_ids_and_nonces(self):
+        nc = NonceCache(nonce_ttl=1, id_ttl=10)
+        now = time.time()
+        for i in range(20):
+            nc.check_nonce("id%d" % (i,), now, "old", now)
+        self.assertEquals(nc.sweep(now), 0)
+        # Nonces expire first, and are swept within the budget per call.
+        self.assertEquals(nc.sweep(now + 5, budget=5), 5)
+        self.assertEquals(nc.sweep(now + 5, budget=100), 15)
+        self.assertEquals(nc.sweep(now + 5), 0)
+        self.assertEquals(len(nc._ids.items), 20)
+        # Then whole ids expire along with their remaining nonces.
+        self.assertEquals(nc.sweep(now + 20, budget=15), 15)
+        self.assertEquals(nc.sweep(now + 20), 5)
+        self.assertEquals(len(nc._ids.items), 0)
+
+    def test_sweep_work_is_independent_of_the_number_of_ids(self):
+
+        class UnscannableDict(dict):
+            def __iter__(self):
+                raise AssertionError("sweep should not scan every id")
+
+            keys = values = items = __iter__
+
+        nc = NonceCache(nonce_ttl=1, id_ttl=100)
+        now = time.time()
+        for i in range(1000):
+            nc.check_nonce("id%d" % (i,), now, "old", now)
+        nc._ids.items = UnscannableDict(nc._ids.items)
+        # Each call does a bounded slice, and they cover all the ids.
+        for _ in range(100):
+            self.assertEquals(nc.sweep(now + 5, budget=10), 10)
+        self.assertEquals(nc.sweep(now + 5, budget=10), 0)
+        self.assertEquals(len(nc), 0)
+
+    def test_sweep_with_ring_cache_engine_and_shards(self):
+        nc = ShardedNonceCache(nonce_ttl=1, id_ttl=10, num_shards=4,
+                               engine=RingCache)
+        now = time.time()
+        for i in range(20):
+            nc.check_nonce("id%d" % (i,), now, "abc", now)
+        self.assertEquals(len(nc), 20)
+        self.assertEquals(nc.sweep(now + 5), 20)
+        self.assertEquals(len(nc), 0)
+
+    def test_sweeper_thread_sweeps_until_stopped(self):
+        nc = NonceCache(nonce_ttl=0.01, id_ttl=0.01)
+        sweeper = Sweeper(nc, interval=0.01)
+        sweeper.start()
+        self.assertTrue(sweeper.running)
+        nc.check_nonce("id", time.time(), "abc")
+        time.sleep(0.1)
+        self.assertEquals(len(nc._ids.items), 0)
+        sweeper.stop()
+        self.assertFalse(sweeper.running)
+        nc.check_nonce("id", time.time(), "abc")
+        time.sleep(0.05)
+        self.assertEquals(len(nc._ids.items), 1)
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "needs fork hooks")
+    def test_sweeper_is_restarted_in_forked_child(self):
+        nc = NonceCache(nonce_ttl=0.01, id_ttl=0.01)
+        sweeper = Sweeper(nc, interval=0.001)
+        sweeper.start()
+        try:
+            pid = os.fork()
+            if pid == 0:  # pragma nocover
+                ok = False
+                try:
+                    nc.check_nonce("id", time.time(), "abc")
+                    time.sleep(0.1)
+                    ok = sweeper.running and len(nc._ids.items) == 0
+                    sweeper.stop()
+                finally:
+                    os._exit(0 if ok else 1)
+            (_, status) = os.waitpid(pid, 0)
+            self.assertEquals(status, 0)
+        finally:
+            sweeper.stop()
+
     def test_that_cache_items_are_ungettable_once_expired(self):
         timeout = 0.1
         cache = Cache(timeout)
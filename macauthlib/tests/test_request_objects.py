@@ -14,7 +14,9 @@ import webob
 import requests
 import requests.auth
 
-from macauthlib import sign_request, check_signature
+from macauthlib import (sign_request, get_id, get_signature,
+                        check_signature, RequestView, Verifier)
+from macauthlib.utils import normalize_request
 
 # These parameters define a known-good signature for a specific request.
 # We test a bunch of different ways to input that request into the lib
@@ -119,3 +121,81 @@ class TestRequestObjects(unittest.TestCase):
                          auth=HTTPMacAuth())
         except RuntimeError as e:
             assert "aborting the request" in str(e)
+
+    def test_passing_request_view_as_request_object(self):
+        req = RequestView("POST", "/resource/1?b=1&a=2", "example.com")
+        assert not check_signature(req, TEST_KEY, nonces=False)
+        authz = sign_request(req, TEST_ID, TEST_KEY, params=TEST_PARAMS)
+        assert TEST_SIG in authz
+        # The view is immutable, so the header is only returned.
+        assert req.authorization is None
+        req = RequestView("POST", "/resource/1?b=1&a=2", "example.com", "80",
+                          "http", authz)
+        assert get_id(req) == TEST_ID
+        assert get_signature(req, TEST_KEY) == TEST_SIG
+        assert check_signature(req, TEST_KEY, nonces=False)
+        assert Verifier({TEST_ID: TEST_KEY}.get).verify(req).ok
+        self.assertRaises(AttributeError, setattr, req, "host", "other.com")
+
+    def test_all_request_types_give_the_same_view(self):
+        environ = {
+            "wsgi.url_scheme": "http",
+            "REQUEST_METHOD": "POST",
+            "HTTP_HOST": "example.com",
+            "PATH_INFO": "/resource/1",
+            "QUERY_STRING": "b=1&a=2",
+            "HTTP_AUTHORIZATION": "MAC id=\"one\"",
+        }
+        prepared = requests.Request(
+            url="http://example.com/resource/1?b=1&a=2",
+            method="POST", headers={"Authorization": "MAC id=\"one\""},
+        ).prepare()
+        reqs = [
+            webob.Request(dict(environ)),
+            environ,
+            prepared,
+            TEST_REQ.replace(b"\r\n\r\n",
+                             b"\r\nAuthorization: MAC id=\"one\"\r\n\r\n"),
+            RequestView("POST", "/resource/1?b=1&a=2", "example.com",
+                        authorization="MAC id=\"one\""),
+        ]
+        for req in reqs:
+            view = normalize_request(req)
+            assert isinstance(view, RequestView)
+            assert normalize_request(view) is view
+            self.assertEquals((view.method, view.path_qs, view.host,
+                               view.port, view.scheme, view.authorization),
+                              ("POST", "/resource/1?b=1&a=2", "example.com",
+                               "80", "http", "MAC id=\"one\""))
+
+    def test_request_views_are_read_lazily(self):
+        reads = []
+
+        class TracingRequest(object):
+            method = "GET"
+            path_qs = "/"
+            scheme = "http"
+            host = "example.com:88"
+            environ = {}
+
+            def __getattribute__(self, name):
+                reads.append(name)
+                return object.__getattribute__(self, name)
+
+        fields = set(["method", "path_qs", "scheme", "host", "environ"])
+        view = normalize_request(TracingRequest())
+        self.assertFalse(fields.intersection(reads))
+        del reads[:]
+        self.assertEquals(view.port, "88")
+        self.assertEquals(sorted(set(reads)), ["host", "scheme"])
+        self.assertEquals(view.authorization, None)
+        self.assertEquals(reads[-1], "environ")
+
+    def test_request_views_default_the_port_from_the_scheme(self):
+        self.assertEquals(RequestView("GET", "/", "a.com").port, "80")
+        self.assertEquals(RequestView("GET", "/", "a.com", None,
+                                      "https").port, "443")
+        self.assertEquals(RequestView("GET", "/", "a.com", "88",
+                                      "https").port, "88")
+        view = RequestView("GET", "/", "a.com", scheme="ftp")
+        self.assertRaises(ValueError, getattr, view, "port")
@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+import multiprocessing
+
+from macauthlib.sharednoncecache import SharedNonceCache
+
+
+class TestSharedNonceCache(unittest.TestCase):
+
+    def test_operation(self, now=time.time):
+        timeout = 0.1
+        nc = SharedNonceCache(nonce_ttl=timeout, id_ttl=1, capacity=64)
+        self.assertEquals(len(nc), 0)
+        self.assertTrue(nc.check_nonce("id", now(), "abc"))
+        self.assertEquals(len(nc), 1)
+        self.assertFalse(nc.check_nonce("id", now(), "abc"))
+        self.assertTrue(nc.check_nonce("id", now(), "xyz"))
+        self.assertTrue(nc.check_nonce("otherid", now(), "abc"))
+        # After the timeout passes, the nonce should be expired.
+        time.sleep(timeout)
+        self.assertTrue(nc.check_nonce("id", now(), "abc"))
+        self.assertFalse(nc.check_nonce("id", now(), "abc"))
+        # If the timestamp is too old, even a fresh nonce will fail the check.
+        self.assertFalse(nc.check_nonce("id", now() - 2 * timeout, "ghi"))
+        self.assertFalse(nc.check_nonce("id", now() + 2 * timeout, "ghi"))
+        self.assertTrue(nc.check_nonce("id", now(), "ghi"))
+
+    def test_operation_with_backward_clock_skew(self):
+        def now():
+            return time.time() - 13
+        self.test_operation(now=now)
+
+    def test_memory_use_is_fixed_by_capacity(self):
+        nc = SharedNonceCache(capacity=16, bucket_size=4)
+        now = time.time()
+        accepted = [i for i in range(100) if nc.check_nonce("id", now, str(i))]
+        self.assertEquals(len(nc), 16)
+        self.assertEquals(len(nc._nonces.buffer), 16 * 16)
+        # Once full the table fails closed, and never forgets live nonces.
+        self.assertEquals(len(accepted), 16)
+        for i in range(100):
+            self.assertFalse(nc.check_nonce("id", now, str(i)))
+
+    def test_replays_are_never_accepted_under_load(self):
+        for (capacity, load) in ((1024, 0.5), (1024, 0.9), (65536, 0.75)):
+            nc = SharedNonceCache(capacity=capacity)
+            now = time.time()
+            count = int(capacity * load)
+            accepted = [i for i in range(count)
+                        if nc.check_nonce("id%d" % (i % 50,), now, str(i))]
+            self.assertTrue(len(accepted) > count * 0.99)
+            for i in range(count):
+                self.assertFalse(nc.check_nonce("id%d" % (i % 50,), now,
+                                                str(i)))
+
+    def test_check_nonces(self):
+        nc = SharedNonceCache()
+        now = time.time()
+        results = nc.check_nonces([("id", now, "abc"), ("id", now, "abc")])
+        self.assertEquals(results, [True, False])
+
+    def test_nonces_are_shared_with_forked_processes(self):
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:  # pragma: nocover
+            return
+        nc = SharedNonceCache()
+        now = time.time()
+
+        def child():
+            ok = nc.check_nonce("id", now, "from-child")
+            ok = ok and not nc.check_nonce("id", now, "from-parent")
+            raise SystemExit(0 if ok else 1)
+
+        self.assertTrue(nc.check_nonce("id", now, "from-parent"))
+        proc = context.Process(target=child)
+        proc.start()
+        proc.join()
+        self.assertEquals(proc.exitcode, 0)
+        self.assertFalse(nc.check_nonce("id", now, "from-child"))
@@ -7,9 +7,13 @@ import time
 
 from webob import Request
 
+from hashlib import sha256
+
 from macauthlib import sign_request, get_id, get_signature, check_signature
+from macauthlib import get_signature_bytes
 from macauthlib.noncecache import NonceCache
-from macauthlib.utils import parse_authz_header
+from macauthlib import utils
+from macauthlib.utils import parse_authz_header, AuthzHeaderCache
 
 
 class TestSignatures(unittest.TestCase):
@@ -133,3 +137,44 @@ class TestSignatures(unittest.TestCase):
         authz = authz.replace(signature, "XXX" + signature)
         req.environ["HTTP_AUTHORIZATION"] = authz
         self.assertFalse(check_signature(req, "mykey"))
+
+    def test_header_cache_parses_only_once_per_request(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        cache = AuthzHeaderCache()
+        utils.AUTHZ_HEADER_CACHE = cache
+        try:
+            self.assertEquals(get_id(req), "myid")
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+            # Signing still works with the cache enabled.
+            sign_request(req, "myid", "mykey")
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+        finally:
+            utils.AUTHZ_HEADER_CACHE = None
+
+    def test_get_signature_bytes_matches_get_signature(self):
+        urls = ["/", "/resource/1?b=1&a=2", "/with%20space/~x;y@z?q=%2F"]
+        hosts = ["example.com", "Example.COM:8080"]
+        for hashmod in (None, sha256):
+            for scheme in ("http", "https"):
+                for url in urls:
+                    for host in hosts:
+                        for ext in ("", "extra"):
+                            req = Request.blank(url, method="post")
+                            req.scheme = scheme
+                            req.host = host
+                            params = {"ts": "1336363200", "nonce": "dj83hs",
+                                      "ext": ext}
+                            expected = get_signature(req, "mykey", hashmod,
+                                                     params)
+                            sig = get_signature_bytes(
+                                b"mykey", b"1336363200", b"dj83hs", b"post",
+                                req.path_qs.encode("ascii"),
+                                host.encode("ascii"), scheme.encode("ascii"),
+                                ext.encode("ascii"), hashmod)
+                            self.assertEquals(sig, expected.encode("ascii"))
+
+    def test_get_signature_bytes_errors_when_no_default_port(self):
+        self.assertRaises(ValueError, get_signature_bytes, b"mykey", b"1",
+                          b"2", b"GET", b"/", b"example.com", b"httptypo")
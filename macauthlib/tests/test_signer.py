@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+from hashlib import sha256
+
+from webob import Request
+
+try:
+    import requests
+except ImportError:  # pragma: nocover
+    requests = None
+
+from macauthlib import Signer, sign_request, check_signature, utils
+from macauthlib.clock import FakeClock
+
+
+class TestSigner(unittest.TestCase):
+
+    def test_signatures_match_sign_request(self):
+        for hashmod in (None, sha256):
+            signer = Signer("myid", "mykey", hashmod)
+            for ext in (None, "", "extra data"):
+                req1 = Request.blank("/resource?q=1", method="POST")
+                params = {"ts": "1336363200", "nonce": "dj83hs9s"}
+                if ext is not None:
+                    params["ext"] = ext
+                authz = signer.sign(req1, params)
+                self.assertEquals(req1.environ["HTTP_AUTHORIZATION"], authz)
+                req2 = Request.blank("/resource?q=1", method="POST")
+                sign_request(req2, "myid", "mykey", hashmod, dict(params))
+                expected = utils.parse_authz_header(req2)
+                self.assertEquals(utils.parse_authz_header(req1), expected)
+                self.assertTrue(check_signature(req1, "mykey", hashmod,
+                                                nonces=False))
+
+    def test_ext_values_are_escaped(self):
+        signer = Signer("myid", "mykey")
+        req = Request.blank("/")
+        ext = 'with "quotes" and \\ slashes'
+        signer.sign(req, {"ext": ext})
+        self.assertEquals(utils.parse_authz_header(req)["ext"], ext)
+        self.assertTrue(check_signature(req, "mykey"))
+
+    def test_all_param_values_are_escaped(self):
+        id = 'my"id\\'
+        signer = Signer(id, "mykey")
+        for params in ({}, {"ext": "x"}, {"nonce": 'a"b\\c'}):
+            req = Request.blank("/")
+            signer.sign(req, params)
+            parsed = utils.parse_authz_header(req)
+            self.assertEquals(parsed["id"], id)
+            for (key, value) in params.items():
+                self.assertEquals(parsed[key], value)
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+
+    def test_signing_environ_dicts(self):
+        signer = Signer("myid", "mykey")
+        environ = Request.blank("/").environ
+        authz = signer.sign(environ)
+        self.assertEquals(environ["HTTP_AUTHORIZATION"], authz)
+        self.assertTrue(check_signature(environ, "mykey"))
+
+    @unittest.skipIf(requests is None, "requests is not installed")
+    def test_signing_prepared_requests(self):
+        signer = Signer("myid", "mykey")
+        req = requests.Request("GET", "http://example.com/x?y=z").prepare()
+        authz = signer.sign(req)
+        self.assertEquals(req.headers["Authorization"], authz)
+        self.assertTrue(check_signature(req, "mykey"))
+
+    def test_nonces_are_pooled_and_unique(self):
+        signer = Signer("myid", "mykey", nonce_pool_size=10)
+        nonces = set(signer.make_nonce() for _ in range(95))
+        self.assertEquals(len(nonces), 95)
+        self.assertEquals(len(signer._nonces), 5)
+        for nonce in nonces:
+            self.assertEquals(len(nonce), 8)
+
+    def test_sign_many_reads_the_clock_once(self):
+        calls = []
+        clock = FakeClock(1234567890)
+
+        def counting_clock():
+            calls.append(1)
+            return clock()
+
+        signer = Signer("myid", "mykey", clock=counting_clock)
+        reqs = [Request.blank("/%d" % (i,)) for i in range(10)]
+        headers = signer.sign_many(reqs)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(len(set(headers)), 10)
+        for (req, authz) in zip(reqs, headers):
+            params = utils.parse_authz_header(req)
+            self.assertEquals(params["ts"], "1234567890")
+            self.assertEquals(req.authorization, Request.blank(
+                "/", headers={"Authorization": authz}).authorization)
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+
+    @unittest.skipIf(not hasattr(os, "fork"), "os.fork is not available")
+    def test_nonce_pool_is_not_shared_after_fork(self):
+        signer = Signer("myid", "mykey")
+        signer.make_nonce()
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: nocover
+            try:
+                os.close(read_fd)
+                os.write(write_fd, str(len(signer._nonces)).encode("ascii"))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        try:
+            self.assertEquals(os.read(read_fd, 100), b"0")
+        finally:
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+        self.assertTrue(len(signer._nonces) > 0)
@@ -2,13 +2,54 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import io
+import re
+import random
 import unittest
 
 from webob import Request
 
+from macauthlib import sign_request, check_signature, utils
 from macauthlib.utils import (strings_differ,
                               parse_authz_header,
-                              get_normalized_request_string)
+                              parse_authz_value,
+                              get_normalized_request_string,
+                              parse_request_head,
+                              normalize_request,
+                              EnvironRequest,
+                              WebObRequestView,
+                              AuthzHeaderCache)
+
+
+# The regex-stitching header parser used by earlier versions of macauthlib.
+# It's kept here as a reference implementation for differential testing.
+_LEGACY_AUTH_PARAM_RE = re.compile(
+    r'^\s*([a-zA-Z0-9_\-]+)=(([a-zA-Z0-9_\-]+)|("")|(".*[^\\]"))\s*$')
+_LEGACY_UNESC_QUOTE_RE = re.compile(r'(^")|([^\\]")')
+_LEGACY_ESCAPED_CHAR = re.compile(r"\\.")
+
+
+def legacy_parse_authz_value(authz):
+    scheme, kvpairs_str = authz.split(None, 1)
+    kvpairs = []
+    if kvpairs_str:
+        for kvpair in kvpairs_str.split(","):
+            if not kvpairs or _LEGACY_AUTH_PARAM_RE.match(kvpairs[-1]):
+                kvpairs.append(kvpair)
+            else:
+                kvpairs[-1] = kvpairs[-1] + "," + kvpair
+        if not _LEGACY_AUTH_PARAM_RE.match(kvpairs[-1]):
+            raise ValueError('Malformed auth parameters')
+    params = {"scheme": scheme}
+    for kvpair in kvpairs:
+        (key, value) = kvpair.strip().split("=", 1)
+        if value.startswith('"'):
+            value = value[1:-1]
+            if _LEGACY_UNESC_QUOTE_RE.search(value):
+                raise ValueError("Unescaped quote in quoted-string")
+            value = _LEGACY_ESCAPED_CHAR.sub(lambda m: m.group(0)[1], value)
+        params[key] = value
+    return params
 
 
 class TestUtils(unittest.TestCase):
@@ -135,3 +176,226 @@ class TestUtils(unittest.TestCase):
         req.authorization = ("MAC", {"ts": "1", "nonce": "2"})
         req.scheme = "httptypo"
         self.assertRaises(ValueError, get_normalized_request_string, req)
+
+    def test_environ_request_matches_webob_normalized_string(self):
+        params = {"ts": "1", "nonce": "2", "ext": "extra"}
+        base_environ = {
+            "wsgi.url_scheme": "http",
+            "REQUEST_METHOD": "get",
+            "SERVER_NAME": "Example.COM",
+            "SERVER_PORT": "8080",
+            "PATH_INFO": "/resource/1",
+        }
+        variants = [
+            {},
+            {"HTTP_HOST": "example.com"},
+            {"HTTP_HOST": "example.com:88"},
+            {"HTTP_HOST": "example.com", "wsgi.url_scheme": "https"},
+            {"QUERY_STRING": "b=1&a=2+q&c%40="},
+            {"SCRIPT_NAME": "/app", "PATH_INFO": "/with space/~x;y@z"},
+            {"SCRIPT_NAME": "", "PATH_INFO": ""},
+            {"PATH_INFO": "/caf\xc3\xa9"},
+            {"PATH_INFO": "/100%/\"quoted\"/[x]"},
+        ]
+        for variant in variants:
+            environ = dict(base_environ)
+            environ.update(variant)
+            # Read the webob.Request's own properties for the expected value.
+            webob_view = WebObRequestView(Request(dict(environ)))
+            expected = get_normalized_request_string(webob_view, params)
+            actual = get_normalized_request_string(EnvironRequest(environ),
+                                                   params)
+            self.assertEquals(expected, actual)
+
+    def test_environ_request_delegates_authorization_to_webob(self):
+        environ = {"wsgi.url_scheme": "http", "HTTP_HOST": "example.com"}
+        req = EnvironRequest(environ)
+        req.authorization = ("MAC", {"id": "user1"})
+        self.assertEquals(parse_authz_header(req)["id"], "user1")
+        self.assertEquals(req.headers["Authorization"], 'MAC id="user1"')
+
+    def test_webob_requests_are_read_through_their_environ(self):
+        req = Request.blank("/resource?a=b")
+        view = normalize_request(req)
+        self.assertTrue(isinstance(view, EnvironRequest))
+        self.assertTrue(view.environ is req.environ)
+        self.assertTrue(view.webob_request is req)
+        self.assertEquals(view.path_qs, req.path_qs)
+        self.assertEquals(view.url, req.url)
+
+    def test_nested_calls_do_not_normalize_the_request_again(self):
+        calls = []
+
+        def counting_normalize(request):
+            calls.append(request)
+            return normalize_request(request)
+
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        utils.normalize_request = counting_normalize
+        try:
+            self.assertTrue(check_signature(req, "mykey", nonces=False))
+        finally:
+            utils.normalize_request = normalize_request
+        self.assertEquals(calls, [req])
+
+    def test_environ_request_verifies_without_building_webob_request(self):
+        environ = {"wsgi.url_scheme": "http", "HTTP_HOST": "example.com",
+                   "REQUEST_METHOD": "GET", "PATH_INFO": "/"}
+        sign_request(environ, "myid", "mykey")
+        req = EnvironRequest(environ)
+        self.assertTrue(check_signature(req, "mykey", nonces=False))
+        self.assertEquals(req._webob_request, None)
+
+    def test_parse_authz_value_enforces_limits(self):
+        authz = 'MAC id="a", ts="1", nonce="2"'
+        self.assertEquals(parse_authz_value(authz)["id"], "a")
+        self.assertRaises(ValueError, parse_authz_value, authz, max_length=10)
+        self.assertRaises(ValueError, parse_authz_value, authz, max_params=2)
+        self.assertEquals(len(parse_authz_value(authz, max_params=3)), 4)
+        # The module-level defaults apply when no limits are given.
+        huge = "MAC " + ",".join("p%d=1" % (i,) for i in range(1000))
+        self.assertRaises(ValueError, parse_authz_value, huge)
+        self.assertEquals(len(parse_authz_value(huge, 0, 0)), 1001)
+
+    def test_parse_authz_value_handles_escaped_backslashes(self):
+        # The legacy parser got these wrong; check we get them right.
+        params = parse_authz_value('MAC a="x\\\\", b="y\\\\"')
+        self.assertEquals(params["a"], "x\\")
+        self.assertEquals(params["b"], "y\\")
+        self.assertRaises(ValueError, parse_authz_value, 'MAC a="x\\\\"y"')
+
+    def test_parse_authz_value_agrees_with_legacy_parser(self):
+        def parse(parser, authz):
+            try:
+                return parser(authz)
+            except ValueError:
+                return None
+
+        mismatches = []
+        rand = random.Random(42)
+        alphabet = ['a', 'B', '9', '-', '_', '=', '"', '\\', ',', ' ', '\t',
+                    '.', '/', '+', 'MAC ', 'id=', 'ts="1"', '\\"', ', x=']
+        for _ in range(20000):
+            authz = "".join(rand.choice(alphabet)
+                            for _ in range(rand.randint(0, 30)))
+            # The legacy parser mishandles escaped backslashes,
+            # so we exclude them from the comparison.
+            if "\\\\" in authz:
+                continue
+            expected = parse(legacy_parse_authz_value, authz)
+            if parse(parse_authz_value, authz) != expected:
+                mismatches.append(authz)
+        self.assertEquals(mismatches, [])
+
+        # Properly serialized headers must round-trip through both parsers.
+        chars = 'abc ,="\\=/+'
+        for _ in range(2000):
+            expected = {"scheme": "MAC"}
+            bits = []
+            for i in range(rand.randint(1, 6)):
+                value = "".join(rand.choice(chars)
+                                for _ in range(rand.randint(0, 8)))
+                expected["p%d" % (i,)] = value
+                value = value.replace("\\", "\\\\").replace('"', '\\"')
+                bits.append('p%d="%s"' % (i, value))
+            authz = "MAC " + ", ".join(bits)
+            if parse_authz_value(authz) != expected:
+                mismatches.append(authz)
+            if "\\\\" not in authz:
+                if legacy_parse_authz_value(authz) != expected:
+                    mismatches.append(authz)
+        self.assertEquals(mismatches, [])
+
+    def test_authz_header_cache_evicts_least_recently_used(self):
+        cache = AuthzHeaderCache(max_size=2)
+        cache.parse("MAC id=one")
+        cache.parse("MAC id=two")
+        self.assertEquals(cache.parse("MAC id=one")["id"], "one")
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+        # Adding a third item evicts "two", which was used least recently.
+        cache.parse("MAC id=three")
+        self.assertEquals(len(cache), 2)
+        cache.parse("MAC id=one")
+        self.assertEquals((cache.hits, cache.misses), (2, 3))
+        cache.parse("MAC id=two")
+        self.assertEquals((cache.hits, cache.misses), (2, 4))
+        # Malformed headers raise errors and are not cached.
+        self.assertRaises(ValueError, cache.parse, "MAC id=")
+        self.assertEquals(len(cache), 2)
+        cache.clear()
+        self.assertEquals((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+    def test_authz_header_cache_returns_immutable_params(self):
+        params = AuthzHeaderCache().parse("MAC id=one")
+        self.assertRaises(TypeError, params.__setitem__, "id", "two")
+        self.assertRaises(TypeError, params.pop, "id")
+        self.assertRaises(TypeError, params.update, {})
+        self.assertEquals(params, {"scheme": "MAC", "id": "one"})
+
+    def test_parse_request_head_matches_webob(self):
+        params = {"ts": "1", "nonce": "2"}
+        heads = [
+            b"GET / HTTP/1.1\r\nHost: example.com\r\n",
+            b"get /a%20b/~c;d@e?x=1&y=%2F HTTP/1.1\r\n"
+            b"Host: Example.COM:88\r\n",
+            b"POST /caf%C3%A9 HTTP/1.0\nHost: example.com\n",
+            b"GET / HTTP/1.1\r\n",
+            b"GET http://example.com/x?y HTTP/1.1\r\n",
+            b"GET https://example.com:8443/x HTTP/1.1\r\n",
+            b"GET https://example.com/x HTTP/1.1\r\nHost: other.com\r\n",
+            b"PUT /x HTTP/1.1\r\nHost: example.com\r\n"
+            b"Authorization: MAC id=\"one\", ts=\"1\"\r\n"
+            b"X-Dup: a\r\nX-Dup: b\r\nContent-Type: text/plain\r\n",
+        ]
+        for head in heads:
+            data = head + b"\r\nbody"
+            expected = Request.from_bytes(head + b"\r\n")
+            # WebOb fills in the length of the body that it read.
+            expected_headers = sorted((k, v) for (k, v)
+                                      in expected.headers.items()
+                                      if k != "Content-Length")
+            for request in (data, bytearray(data), memoryview(data),
+                            io.BytesIO(data)):
+                req = parse_request_head(request)
+                self.assertEquals(
+                    get_normalized_request_string(req, params),
+                    get_normalized_request_string(expected, params))
+                self.assertEquals(sorted(req.headers.items()),
+                                  expected_headers)
+                self.assertEquals(parse_authz_header(req, None),
+                                  parse_authz_header(expected, None))
+
+    def test_parse_request_head_never_reads_the_body(self):
+        head = b"POST /x HTTP/1.1\r\nHost: example.com\r\n\r\n"
+
+        class UnreadableBody(io.BytesIO):
+            def read(self, *args):
+                raise AssertionError("the body was read")
+
+        body = b"x" * (10 * 1024 * 1024)
+        fileobj = UnreadableBody(head + body)
+        req = parse_request_head(fileobj)
+        self.assertEquals(fileobj.tell(), len(head))
+        self.assertTrue(req.environ["wsgi.input"] is fileobj)
+        self.assertEquals(req.path_qs, "/x")
+        # Only a small window at the start of a buffer is copied out.
+        data = bytearray(head + body)
+        req = normalize_request(memoryview(data))
+        self.assertTrue(isinstance(req, EnvironRequest))
+        self.assertEquals(req.host, "example.com")
+
+    def test_parse_request_head_rejects_bad_input(self):
+        bad = [b"",
+               b"GET /\r\n\r\n",
+               b"GET / HTTP/1.1\r\nno colon here\r\n\r\n",
+               b"GET http://example.com/#frag HTTP/1.1\r\n\r\n",
+               b"GET ftp://example.com/ HTTP/1.1\r\n\r\n"]
+        for data in bad:
+            self.assertRaises(ValueError, parse_request_head, data)
+            self.assertRaises(ValueError, parse_request_head, io.BytesIO(data))
+        data = b"GET / HTTP/1.1\r\nX-Big: " + b"x" * 2000 + b"\r\n\r\n"
+        self.assertRaises(ValueError, parse_request_head, data, 1000)
+        self.assertRaises(ValueError, parse_request_head, io.BytesIO(data),
+                          1000)
+        self.assertEquals(parse_request_head(data, 3000).path_qs, "/")
@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+from hashlib import sha256
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: nocover
+    ThreadPoolExecutor = None
+
+from webob import Request
+
+from macauthlib import sign_request, check_signatures, Verifier
+from macauthlib.noncecache import NonceCache
+from macauthlib.verifier import (STATUS_OK,
+                                 STATUS_REJECTED,
+                                 REASON_MISSING,
+                                 REASON_MALFORMED,
+                                 REASON_SCHEME,
+                                 REASON_UNKNOWN_ID,
+                                 REASON_BAD_SIGNATURE,
+                                 REASON_NONCE,
+                                 STAGE_HEADER,
+                                 STAGE_SCHEME,
+                                 STAGE_PARAMS,
+                                 STAGE_TIMESTAMP,
+                                 STAGE_MAC)
+
+
+KEYS = {"myid": "mykey"}
+
+
+class TestVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = Verifier(KEYS.get)
+
+    def assertRejected(self, result, reason, id="myid"):
+        self.assertFalse(result)
+        self.assertEquals(result.status, STATUS_REJECTED)
+        self.assertEquals(result.reason, reason)
+        self.assertEquals(result.id, id)
+
+    def test_verify_accepts_valid_signature(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        result = self.verifier.verify(req)
+        self.assertTrue(result)
+        self.assertTrue(result.ok)
+        self.assertEquals(result.status, STATUS_OK)
+        self.assertEquals(result.id, "myid")
+        self.assertEquals(result.reason, None)
+
+    def test_verify_accepts_environ_dicts(self):
+        environ = Request.blank("/resource?a=b").environ
+        sign_request(environ, "myid", "mykey")
+        self.assertTrue(self.verifier.verify(environ))
+
+    def test_verify_reports_reject_reasons(self):
+        req = Request.blank("/")
+        self.assertRejected(self.verifier.verify(req), REASON_MISSING, None)
+        req.environ["HTTP_AUTHORIZATION"] = 'MAC id="unclosed'
+        self.assertRejected(self.verifier.verify(req), REASON_MALFORMED, None)
+        req.authorization = ("MAC", {"id": "myid", "ts": "1", "nonce": "2"})
+        self.assertRejected(self.verifier.verify(req), REASON_MALFORMED)
+        sign_request(req, "myid", "mykey")
+        req.authorization = ("OAuth", req.authorization[1])
+        self.assertRejected(self.verifier.verify(req), REASON_SCHEME, None)
+        sign_request(req, "otherid", "mykey")
+        self.assertRejected(self.verifier.verify(req), REASON_UNKNOWN_ID,
+                            "otherid")
+        sign_request(req, "myid", "wrongkey")
+        self.assertRejected(self.verifier.verify(req), REASON_BAD_SIGNATURE)
+
+    def test_verify_rejects_reused_nonce(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(self.verifier.verify(req))
+        self.assertRejected(self.verifier.verify(req), REASON_NONCE)
+        # The nonce is only recorded for correctly-signed requests.
+        sign_request(req, "myid", "wrongkey", params={"nonce": "PEPPER"})
+        self.assertRejected(self.verifier.verify(req), REASON_BAD_SIGNATURE)
+        sign_request(req, "myid", "mykey", params={"nonce": "PEPPER"})
+        self.assertTrue(self.verifier.verify(req))
+
+    def test_verify_can_disable_nonce_checks(self):
+        verifier = Verifier(KEYS.get, nonces=False)
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        self.assertTrue(verifier.verify(req))
+        self.assertTrue(verifier.verify(req))
+
+    def test_verify_uses_the_given_clock(self):
+        now = [time.time()]
+        verifier = Verifier(KEYS.get, clock=lambda: now[0])
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey", params={"ts": str(int(now[0]))})
+        self.assertTrue(verifier.verify(req))
+        now[0] += 1000
+        sign_request(req, "myid", "mykey", params={"ts": str(int(now[0]))})
+        self.assertTrue(verifier.verify(req))
+        sign_request(req, "myid", "mykey", params={"ts": "1"})
+        self.assertRejected(verifier.verify(req), REASON_NONCE)
+
+    def test_cheap_checks_reject_before_any_hmac_work(self):
+        lookups = []
+
+        def key_lookup(id):
+            lookups.append(id)
+            return KEYS.get(id)
+
+        now = time.time()
+        verifier = Verifier(key_lookup, max_skew=60, clock=lambda: now)
+        req = Request.blank("/")
+        self.assertRejected(verifier.verify(req), REASON_MISSING, None)
+        req.environ["HTTP_AUTHORIZATION"] = "MAC " + "x" * 5000
+        self.assertRejected(verifier.verify(req), REASON_MALFORMED, None)
+        sign_request(req, "myid", "mykey")
+        req.authorization = ("Basic", req.authorization[1])
+        self.assertRejected(verifier.verify(req), REASON_SCHEME, None)
+        req.authorization = ("MAC", {"id": "myid", "ts": "1", "nonce": "2"})
+        self.assertRejected(verifier.verify(req), REASON_MALFORMED)
+        sign_request(req, "myid", "mykey", params={"ts": str(int(now - 61))})
+        self.assertRejected(verifier.verify(req), REASON_NONCE)
+        sign_request(req, "myid", "mykey", hashmod=sha256,
+                     params={"ts": str(int(now))})
+        self.assertRejected(verifier.verify(req), REASON_BAD_SIGNATURE)
+        self.assertEquals(lookups, [])
+        self.assertEquals(dict(verifier.rejections), {
+            STAGE_HEADER: 2,
+            STAGE_SCHEME: 1,
+            STAGE_PARAMS: 1,
+            STAGE_TIMESTAMP: 1,
+            STAGE_MAC: 1,
+        })
+        # A request passing all the stages is looked up and recorded.
+        sign_request(req, "myid", "mykey", params={"ts": str(int(now))})
+        self.assertTrue(verifier.verify(req))
+        self.assertEquals(lookups, ["myid"])
+        self.assertEquals(sum(verifier.rejections.values()), 6)
+
+    def test_max_skew_is_disabled_by_default(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey", params={"ts": "1"})
+        self.assertTrue(self.verifier.verify(req))
+        self.assertEquals(sum(self.verifier.rejections.values()), 0)
+
+    def test_verify_treats_key_lookup_errors_as_unknown_ids(self):
+        verifier = Verifier(KEYS.__getitem__)
+        req = Request.blank("/")
+        sign_request(req, "otherid", "mykey")
+        self.assertRejected(verifier.verify(req), REASON_UNKNOWN_ID,
+                            "otherid")
+
+    def _make_batch(self):
+        reqs = []
+        for i in range(10):
+            req = Request.blank("/resource/%d" % (i,))
+            sign_request(req, "myid", "mykey", params={"nonce": str(i)})
+            reqs.append(req)
+        # A replay of an earlier request, within the same batch.
+        reqs.append(reqs[3].copy())
+        # A request with a bad signature.
+        req = Request.blank("/")
+        sign_request(req, "myid", "wrongkey", params={"nonce": "bad"})
+        reqs.append(req)
+        # An unsigned request.
+        reqs.append(Request.blank("/"))
+        return reqs
+
+    def _check_batch_results(self, results):
+        results = list(results)
+        self.assertEquals(len(results), 13)
+        self.assertTrue(all(results[:10]))
+        self.assertEquals(results[10].reason, REASON_NONCE)
+        self.assertEquals(results[11].reason, REASON_BAD_SIGNATURE)
+        self.assertEquals(results[12].reason, REASON_MISSING)
+
+    def test_verify_many_matches_individual_verification(self):
+        results = self.verifier.verify_many(self._make_batch())
+        self._check_batch_results(results)
+
+    def test_verify_many_with_an_executor(self):
+        if ThreadPoolExecutor is None:  # pragma: nocover
+            return
+        reqs = self._make_batch()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = self.verifier.verify_many(reqs, executor, chunk_size=3)
+            self._check_batch_results(results)
+
+    def test_unparseable_raw_requests_are_rejected(self):
+        req = Request.blank("/")
+        sign_request(req, "myid", "mykey")
+        data = req.as_bytes()
+        for bad in (b"garbage\r\n\r\n", b"GET / HTTP/1.1\r\n" + b"x" * 70000):
+            self.assertRejected(self.verifier.verify(bad), REASON_MALFORMED,
+                                None)
+        self.assertEquals(dict(self.verifier.rejections), {STAGE_HEADER: 2})
+        results = list(check_signatures([data, b"garbage\r\n\r\n", data],
+                                        KEYS.get, nonces=False))
+        self.assertEquals(len(results), 3)
+        self.assertTrue(results[0])
+        self.assertRejected(results[1], REASON_MALFORMED, None)
+        self.assertTrue(results[2])
+
+    def test_check_signatures(self):
+        nonces = NonceCache()
+        results = check_signatures(self._make_batch(), KEYS.get, nonces=nonces)
+        self._check_batch_results(results)
+        self.assertEquals(len(nonces), 10)
@@ -7,13 +7,19 @@ Low-level utility functions for macauthlib.
 
 """
 
+import os
 import sys
 import re
+import weakref
 import functools
 import base64
+import threading
+import collections
 
 import webob
 
+from macauthlib import instrument
+
 requests = None
 try:
     import requests
@@ -23,6 +29,10 @@ except ImportError:   # pragma nocover
 
 if sys.version_info > (3,):  # pragma: nocover
 
+    from urllib.parse import quote as url_quote
+    from urllib.parse import unquote_to_bytes as url_unquote_to_bytes
+    from urllib.parse import urlsplit
+
     def iteritems(d):
         """Efficiently iterate over dict items."""
         return d.items()
@@ -31,8 +41,16 @@ if sys.version_info > (3,):  # pragma: nocover
         """Base64-encode bytes data into a native string."""
         return base64.b64encode(data).decode("ascii")
 
+    def environ_to_bytes(value):
+        """Convert a WSGI environ string value back into raw bytes."""
+        return value.encode("latin-1")
+
 else:  # pragma: nocover
 
+    from urllib import quote as url_quote  # NOQA
+    from urllib import unquote as url_unquote_to_bytes  # NOQA
+    from urlparse import urlsplit  # NOQA
+
     def iteritems(d):  # NOQA
         """Efficiently iterate over dict items."""
         return d.iteritems()
@@ -41,20 +59,41 @@ else:  # pragma: nocover
         """Base64-encode bytes data into a native string."""
         return base64.b64encode(data)
 
+    def environ_to_bytes(value):  # NOQA
+        """Convert a WSGI environ string value back into raw bytes."""
+        return value
+
+
+# Characters that WebOb leaves unquoted when generating request.path_qs.
+_PATH_SAFE = "/~!$&'()*+,;=:@"
+
+# Regex matching paths made entirely of characters that are never quoted.
+_UNQUOTED_PATH_RE = re.compile(r"[A-Za-z0-9_.\-/~!$&'()*+,;=:@]*\Z")
+
+# Limits applied when parsing an Authorization header, to bound the amount
+# of work done on untrusted input.  Set either to None to disable the check.
+MAX_AUTHZ_HEADER_LENGTH = 4096
+MAX_AUTHZ_PARAMS = 32
 
-# Regular expression matching a single param in the HTTP_AUTHORIZATION header.
-# This is basically <name>=<value> where <value> can be an unquoted token,
-# an empty quoted string, or a quoted string where the ending quote is *not*
-# preceded by a backslash.
-_AUTH_PARAM_RE = r'([a-zA-Z0-9_\-]+)=(([a-zA-Z0-9_\-]+)|("")|(".*[^\\]"))'
-_AUTH_PARAM_RE = re.compile(r"^\s*" + _AUTH_PARAM_RE + r"\s*$")
+# Maximum size of the request line and headers accepted when parsing raw
+# request data, to bound the amount buffered from untrusted input.
+MAX_REQUEST_HEAD_SIZE = 65536
 
-# Regular expression matching an unescaped quote character.
-_UNESC_QUOTE_RE = r'(^")|([^\\]")'
-_UNESC_QUOTE_RE = re.compile(_UNESC_QUOTE_RE)
+# The blank line ending the head of a raw request, and the scheme prefix of
+# an absolute request target.
+_HEAD_END_RE = re.compile(b"\n\r?\n")
+_SCHEME_RE = re.compile(r"^[a-z]+:", re.I)
 
-# Regular expression matching a backslash-escaped characer.
-_ESCAPED_CHAR = re.compile(r"\\.")
+# Regular expressions for the pieces of an auth param.  Each of these is
+# matched at a specific position in the header and never backtracks, so
+# tokenizing the header takes time linear in its length.
+_WHITESPACE_RE = re.compile(r"\s*")
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9_\-]+")
+_QUOTED_CHARS_RE = re.compile(r'[^"\\]*')
+
+# Optional AuthzHeaderCache used by parse_authz_header.  It's None by
+# default, meaning that every call will parse the header afresh.
+AUTHZ_HEADER_CACHE = None
 
 
 def parse_authz_header(request, *default):
@@ -74,51 +113,186 @@ def parse_authz_header(request, *default):
         {"scheme": "Digest", realm: "Sync",
          "username": "user1", "response": "123456"}
 
+    If AUTHZ_HEADER_CACHE has been set to an AuthzHeaderCache object then
+    parse results will be cached there, and the returned dict will be an
+    immutable copy shared with other callers.
     """
     # This outer try-except catches ValueError and
     # turns it into return-default if necessary.
     try:
         # Grab the auth header from the request, if any.
-        authz = request.environ.get("HTTP_AUTHORIZATION")
+        if isinstance(request, RequestView):
+            authz = request.authorization
+        else:
+            authz = request.environ.get("HTTP_AUTHORIZATION")
         if authz is None:
             raise ValueError("Missing auth parameters")
-        scheme, kvpairs_str = authz.split(None, 1)
-        # Split the parameters string into individual key=value pairs.
-        # In the simple case we can just split by commas to get each pair.
-        # Unfortunately this will break if one of the values contains a comma.
-        # So if we find a component that isn't a well-formed key=value pair,
-        # then we stitch bits back onto the end of it until it is.
-        kvpairs = []
-        if kvpairs_str:
-            for kvpair in kvpairs_str.split(","):
-                if not kvpairs or _AUTH_PARAM_RE.match(kvpairs[-1]):
-                    kvpairs.append(kvpair)
-                else:
-                    kvpairs[-1] = kvpairs[-1] + "," + kvpair
-            if not _AUTH_PARAM_RE.match(kvpairs[-1]):
-                raise ValueError('Malformed auth parameters')
-        # Now we can just split by the equal-sign to get each key and value.
-        params = {"scheme": scheme}
-        for kvpair in kvpairs:
-            (key, value) = kvpair.strip().split("=", 1)
-            # For quoted strings, remove quotes and backslash-escapes.
-            if value.startswith('"'):
-                value = value[1:-1]
-                if _UNESC_QUOTE_RE.search(value):
-                    raise ValueError("Unescaped quote in quoted-string")
-                value = _ESCAPED_CHAR.sub(lambda m: m.group(0)[1], value)
-            params[key] = value
-        return params
+        cache = AUTHZ_HEADER_CACHE
+        if cache is not None:
+            return cache.parse(authz)
+        return parse_authz_value(authz)
     except ValueError:
         if default:
             return default[0]
         raise
 
 
+def parse_authz_value(authz, max_length=None, max_params=None):
+    """Parse an authorization header value into an identity dict.
+
+    This function does the work of parse_authz_header(), taking the raw
+    header value rather than a request object.  It makes a single pass
+    over the header, unescaping quoted-string values as it goes, and raises
+    ValueError if the header is malformed.
+
+    The header length and number of parameters are checked against the
+    given limits, defaulting to MAX_AUTHZ_HEADER_LENGTH and MAX_AUTHZ_PARAMS
+    respectively.  Overlong headers are rejected without being examined.
+    """
+    if max_length is None:
+        max_length = MAX_AUTHZ_HEADER_LENGTH
+    if max_params is None:
+        max_params = MAX_AUTHZ_PARAMS
+    if max_length and len(authz) > max_length:
+        raise ValueError("Auth header too long")
+    scheme, kvpairs_str = authz.split(None, 1)
+    params = {"scheme": scheme}
+    num_params = 0
+    end = len(kvpairs_str)
+    pos = 0
+    while True:
+        # Each parameter is a token, an equals sign, and a value
+        # which may be either another token or a quoted-string.
+        pos = _WHITESPACE_RE.match(kvpairs_str, pos).end()
+        match = _TOKEN_RE.match(kvpairs_str, pos)
+        if match is None or kvpairs_str[match.end():match.end() + 1] != "=":
+            raise ValueError("Malformed auth parameters")
+        key = match.group(0)
+        pos = match.end() + 1
+        match = _TOKEN_RE.match(kvpairs_str, pos)
+        if match is not None:
+            value = match.group(0)
+            pos = match.end()
+        elif kvpairs_str[pos:pos + 1] == '"':
+            pos += 1
+            chunks = []
+            while True:
+                match = _QUOTED_CHARS_RE.match(kvpairs_str, pos)
+                chunks.append(match.group(0))
+                pos = match.end()
+                if pos >= end:
+                    raise ValueError("Unterminated quoted-string")
+                if kvpairs_str[pos] == '"':
+                    pos += 1
+                    break
+                # It's a backslash-escaped character.
+                if pos + 1 >= end:
+                    raise ValueError("Unterminated quoted-string")
+                chunks.append(kvpairs_str[pos + 1])
+                pos += 2
+            value = "".join(chunks)
+        else:
+            raise ValueError("Malformed auth parameters")
+        num_params += 1
+        if max_params and num_params > max_params:
+            raise ValueError("Too many auth parameters")
+        params[key] = value
+        # Parameters are separated by a comma and optional whitespace.
+        pos = _WHITESPACE_RE.match(kvpairs_str, pos).end()
+        if pos == end:
+            break
+        if kvpairs_str[pos] != ",":
+            raise ValueError("Malformed auth parameters")
+        pos += 1
+    return params
+
+
+def quote_auth_param(value):
+    """Escape a parameter value for use in a quoted-string."""
+    if "\\" in value or '"' in value:
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return value
+
+
+def format_authz_header(scheme, params):
+    """Serialize an auth scheme and dict of params into a header value.
+
+    This is the inverse of parse_authz_value(), with every value written as
+    a quoted-string.
+    """
+    return scheme + " " + ", ".join('%s="%s"' % (key, quote_auth_param(value))
+                                    for (key, value) in iteritems(params))
+
+
+class ImmutableParams(dict):
+    """A dict of parsed auth parameters that cannot be modified."""
+
+    def _immutable(self, *args, **kwds):
+        raise TypeError("auth params cannot be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    pop = popitem = clear = update = setdefault = _immutable
+
+
+class AuthzHeaderCache(object):
+    """A size-bounded LRU cache of parsed Authorization headers.
+
+    This class maps raw Authorization header values to the ImmutableParams
+    produced by parsing them, so that a server which calls get_id() and then
+    check_signature() on a request only needs to parse its header once.
+    When the cache is full, the least-recently-used header is discarded.
+
+    The "hits" and "misses" attributes count the number of lookups that were
+    and were not satisfied from the cache.  Malformed headers are never
+    cached.
+    """
+
+    def __init__(self, max_size=1000):
+        assert max_size > 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def parse(self, authz):
+        """Get the parsed params for the given header value.
+
+        This method returns the cached params for the given header if it
+        has previously been seen, and parses and caches it otherwise.
+        Parse errors are propagated as ValueError.
+        """
+        with self._lock:
+            try:
+                params = self._items.pop(authz)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items[authz] = params
+                return params
+        params = ImmutableParams(parse_authz_value(authz))
+        with self._lock:
+            self._items[authz] = params
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return params
+
+    def clear(self):
+        """Remove all cached items and reset the hit/miss counters."""
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 def get_normalized_request_string(request, params=None):
     """Get the string to be signed for MAC access authentication.
 
-    This method takes a WebOb Request object and returns the data that
+    This method takes a request object and returns the data that
     should be signed for MAC access authentication of that request, a.k.a
     the "normalized request string" as defined in section 3.2.1 of RFC-TODO.
 
@@ -127,6 +301,8 @@ def get_normalized_request_string(request, params=None):
     it is missing or None then the Authorization header from the request will
     be parsed to determine the necessary parameters.
     """
+    if not isinstance(request, RequestView):
+        request = normalize_request(request)
     if params is None:
         params = parse_authz_header(request, {})
     bits = []
@@ -134,24 +310,70 @@ def get_normalized_request_string(request, params=None):
     bits.append(params["nonce"])
     bits.append(request.method.upper())
     bits.append(request.path_qs)
-    try:
-        host, port = request.host.rsplit(":", 1)
-    except ValueError:
-        host = request.host
-        if request.scheme == "http":
-            port = "80"
-        elif request.scheme == "https":
-            port = "443"
-        else:
-            msg = "Unknown scheme %r has no default port" % (request.scheme,)
-            raise ValueError(msg)
-    bits.append(host.lower())
-    bits.append(port)
+    bits.append(request.host.lower())
+    bits.append(request.port)
     bits.append(params.get("ext", ""))
     bits.append("")     # to get the trailing newline
     return "\n".join(bits)
 
 
+def update_normalized_request(hasher, ts, nonce, method, path_qs, host,
+                              scheme=b"http", ext=b""):
+    """Feed the normalized request string into a hash object, as bytes.
+
+    This function is the bytes-native equivalent of hashing the result of
+    get_normalized_request_string().  The components are given as bytes
+    and fed straight into the hasher, so no str is ever built or encoded.
+    This lets callers use pre-initialised HMAC state, such as from an
+    HMACKeyCache.  The "host" may include a port, which otherwise
+    defaults to the standard port for the scheme, and "path_qs" must be
+    quoted in the same way as webob.Request.path_qs.
+    """
+    host, sep, port = host.rpartition(b":")
+    if not sep:
+        host = port
+        if scheme == b"http":
+            port = b"80"
+        elif scheme == b"https":
+            port = b"443"
+        else:
+            msg = "Unknown scheme %r has no default port" % (scheme,)
+            raise ValueError(msg)
+    # The components are short, so joining them is cheaper than making a
+    # separate call to hasher.update() for each.
+    hasher.update(b"\n".join((ts, nonce, method.upper(), path_qs,
+                              host.lower(), port, ext, b"")))
+
+
+def register_fork_hooks(obj, before=None, after_in_parent=None,
+                        after_in_child=None):
+    """Call methods of the given object around each os.fork().
+
+    The hooks are given as method names, and are called with the object
+    for as long as it is alive.  This does nothing on platforms without
+    os.register_at_fork(), i.e. before Python 3.7.
+    """
+    if not hasattr(os, "register_at_fork"):   # pragma: nocover
+        return
+    ref = weakref.ref(obj)
+
+    def hook(name):
+        def callback():
+            obj = ref()
+            if obj is not None:
+                getattr(obj, name)()
+        return callback
+
+    hooks = {}
+    if before is not None:
+        hooks["before"] = hook(before)
+    if after_in_parent is not None:
+        hooks["after_in_parent"] = hook(after_in_parent)
+    if after_in_child is not None:
+        hooks["after_in_child"] = hook(after_in_child)
+    os.register_at_fork(**hooks)
+
+
 def strings_differ(string1, string2):
     """Check whether two strings differ while avoiding timing attacks.
 
@@ -171,56 +393,460 @@ def strings_differ(string1, string2):
     return invalid_bits != 0
 
 
+def default_port(scheme):
+    """Get the default port for the given URL scheme, as a string."""
+    if scheme == "http":
+        return "80"
+    if scheme == "https":
+        return "443"
+    raise ValueError("Unknown scheme %r has no default port" % (scheme,))
+
+
+def _split_host(host, scheme):
+    """Split a Host header value into (host, port), defaulting the port."""
+    host, sep, port = host.rpartition(":")
+    if not sep:
+        return (port, default_port(scheme))
+    return (host, port)
+
+
+class RequestView(object):
+    """Lightweight immutable view of the parts of a request that are signed.
+
+    This class holds just the attributes needed to sign or verify a request:
+
+        * method:         the HTTP request method, e.g. "GET"
+        * path_qs:        the path and query string, quoted as by WebOb
+        * host:           the host name, without any port
+        * port:           the port number, as a string
+        * scheme:         the URL scheme, e.g. "http"
+        * authorization:  the raw Authorization header, or None
+
+    If no port is given it defaults to the standard port for the scheme.
+
+    All the public functions of macauthlib accept a RequestView directly,
+    and normalize_request() converts other types of request object into
+    one.  The subclasses used to adapt those objects read each attribute
+    from the underlying object only when it is needed.
+    """
+
+    __slots__ = ("_method", "_path_qs", "_host", "_port", "_scheme",
+                 "_authorization")
+
+    def __init__(self, method, path_qs, host, port=None, scheme="http",
+                 authorization=None):
+        self._method = method
+        self._path_qs = path_qs
+        self._host = host
+        self._port = port
+        self._scheme = scheme
+        self._authorization = authorization
+
+    def __repr__(self):
+        return "<%s %s %s://%s:%s%s>" % (
+            self.__class__.__name__, self.method, self.scheme, self.host,
+            self.port, self.path_qs)
+
+    @property
+    def method(self):
+        return self._method
+
+    @property
+    def path_qs(self):
+        return self._path_qs
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def port(self):
+        if self._port is None:
+            return default_port(self.scheme)
+        return self._port
+
+    @property
+    def scheme(self):
+        return self._scheme
+
+    @property
+    def authorization(self):
+        return self._authorization
+
+    def store_authorization(self, value):
+        """Write an Authorization header into the underlying request.
+
+        A plain RequestView has no underlying request, so this does nothing;
+        the subclasses adapting other request objects store the header into
+        the object that they wrap.
+        """
+        pass
+
+
+class _AdapterView(RequestView):
+    """Base class for RequestViews reading from another request object.
+
+    Subclasses provide a _host_header() method giving the host and optional
+    port in the form of a Host header, which is split on first use.
+    """
+
+    __slots__ = ("_host_and_port",)
+
+    def _split_host_header(self):
+        host_and_port = _split_host(self._host_header(), self.scheme)
+        self._host_and_port = host_and_port
+        return host_and_port
+
+    @property
+    def host(self):
+        return (self._host_and_port or self._split_host_header())[0]
+
+    @property
+    def port(self):
+        return (self._host_and_port or self._split_host_header())[1]
+
+
+class WebObRequestView(_AdapterView):
+    """RequestView of a webob.Request, or any object with the same interface.
+    """
+
+    __slots__ = ("request",)
+
+    def __init__(self, request):
+        self.request = request
+        self._host_and_port = None
+
+    def _host_header(self):
+        return self.request.host
+
+    @property
+    def method(self):
+        return self.request.method
+
+    @property
+    def path_qs(self):
+        return self.request.path_qs
+
+    @property
+    def scheme(self):
+        return self.request.scheme
+
+    @property
+    def authorization(self):
+        return self.request.environ.get("HTTP_AUTHORIZATION")
+
+    def store_authorization(self, value):
+        self.request.environ["HTTP_AUTHORIZATION"] = value
+
+
+class EnvironRequest(_AdapterView):
+    """RequestView reading directly from a WSGI environ dict.
+
+    This class reads each attribute straight out of the environ, avoiding
+    the overhead of constructing a full webob.Request for every request
+    that is verified.  The values produced are identical to those of the
+    corresponding webob.Request properties.
+
+    For compatibility, any other attribute access is delegated to a
+    webob.Request sharing the same environ dict, which is either given as
+    "webob_request" or created on first use, and assigning a (scheme, params)
+    tuple to the "authorization" attribute sets the header as WebOb would.
+    """
+
+    __slots__ = ("environ", "_webob_request")
+
+    def __init__(self, environ, webob_request=None):
+        self.environ = environ
+        self._webob_request = webob_request
+        self._host_and_port = None
+
+    @property
+    def webob_request(self):
+        if self._webob_request is None:
+            self._webob_request = webob.Request(self.environ)
+        return self._webob_request
+
+    def __getattr__(self, name):
+        return getattr(self.webob_request, name)
+
+    @property
+    def method(self):
+        return self.environ.get("REQUEST_METHOD", "GET")
+
+    @property
+    def scheme(self):
+        return self.environ["wsgi.url_scheme"]
+
+    def _host_header(self):
+        environ = self.environ
+        try:
+            return environ["HTTP_HOST"]
+        except KeyError:
+            return "%(SERVER_NAME)s:%(SERVER_PORT)s" % environ
+
+    @property
+    def path_qs(self):
+        environ = self.environ
+        script_name = environ.get("SCRIPT_NAME")
+        path = _quote_environ_path(environ.get("PATH_INFO", ""))
+        if script_name:
+            path = _quote_environ_path(script_name) + path
+        qs = environ.get("QUERY_STRING")
+        if qs:
+            path += "?" + qs
+        return path
+
+    @property
+    def authorization(self):
+        return self.environ.get("HTTP_AUTHORIZATION")
+
+    @authorization.setter
+    def authorization(self, value):
+        self.webob_request.authorization = value
+
+    def store_authorization(self, value):
+        self.environ["HTTP_AUTHORIZATION"] = value
+
+
+def _quote_environ_path(value):
+    """Quote a path from a WSGI environ as WebOb does for request.path_qs."""
+    # Most paths need no quoting, and checking for that is much quicker.
+    if _UNQUOTED_PATH_RE.match(value):
+        return value
+    return url_quote(environ_to_bytes(value), _PATH_SAFE)
+
+
+class PreparedRequestView(_AdapterView):
+    """RequestView of a requests.PreparedRequest.
+
+    This class reads the attributes by parsing the prepared URL, giving the
+    same values that a server will see for the request, without building a
+    webob.Request or copying any of the request headers.
+    """
+
+    __slots__ = ("request", "_url")
+
+    def __init__(self, request):
+        self.request = request
+        self._url = None
+        self._host_and_port = None
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = urlsplit(self.request.url)
+        return self._url
+
+    def _host_header(self):
+        host = self.request.headers.get("Host")
+        if host is None:
+            return self.url.netloc.rpartition("@")[2]
+        if not isinstance(host, str):
+            host = host.decode("ascii")
+        return host
+
+    @property
+    def method(self):
+        return self.request.method
+
+    @property
+    def path_qs(self):
+        url = self.url
+        path = url_quote(url_unquote_to_bytes(url.path or "/"), _PATH_SAFE)
+        if url.query:
+            path += "?" + url.query
+        return path
+
+    @property
+    def scheme(self):
+        return self.url.scheme
+
+    @property
+    def authorization(self):
+        return self.request.headers.get("Authorization")
+
+    def store_authorization(self, value):
+        self.request.headers["Authorization"] = value
+
+
+def parse_request_head(data, max_size=None):
+    """Parse the head of raw HTTP request data into an EnvironRequest.
+
+    The data may be given as bytes, a bytearray, a memoryview or a file-like
+    object.  Only the request line and headers are examined: the body is
+    never read or copied, and a file-like object is left positioned at the
+    start of the body, which is available as the "wsgi.input" of the result.
+
+    The head is interpreted in the same way as by webob.Request.from_file(),
+    and ValueError is raised if it is malformed or larger than the given
+    size, which defaults to MAX_REQUEST_HEAD_SIZE.
+    """
+    if max_size is None:
+        max_size = MAX_REQUEST_HEAD_SIZE
+    if hasattr(data, "readline"):
+        lines = _read_head_lines(data, max_size)
+    else:
+        lines = _split_head_lines(data, max_size)
+    try:
+        method, target, version = lines[0].decode("utf-8").split(None, 2)
+    except (IndexError, ValueError):
+        raise ValueError("Bad HTTP request line")
+    if _SCHEME_RE.match(target):
+        (scheme, netloc, path, query, fragment) = urlsplit(target)
+        if fragment:
+            raise ValueError("Request target cannot contain a fragment")
+        if ":" not in netloc:
+            if scheme == "http":
+                netloc += ":80"
+            elif scheme == "https":
+                netloc += ":443"
+            else:
+                raise ValueError("Unknown scheme %r" % (scheme,))
+    else:
+        scheme = "http"
+        netloc = "localhost:80"
+        (path, _, query) = target.partition("?")
+    (server_name, _, server_port) = netloc.partition(":")
+    environ = {
+        "REQUEST_METHOD": method.upper(),
+        "SCRIPT_NAME": "",
+        "PATH_INFO": url_unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": server_port,
+        "SERVER_PROTOCOL": version,
+        "wsgi.url_scheme": scheme,
+    }
+    if hasattr(data, "readline"):
+        environ["wsgi.input"] = data
+    for line in lines[1:]:
+        try:
+            name, value = line.decode("utf-8").split(":", 1)
+        except ValueError:
+            raise ValueError("Bad HTTP header line")
+        key = name.strip().upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.strip()
+        if key in environ:
+            value = environ[key] + ", " + value
+        environ[key] = value
+    return EnvironRequest(environ)
+
+
+def _split_head_lines(data, max_size):
+    """Get the lines in the head of a buffer of raw request data.
+
+    The buffer is searched in growing windows from its start, so that only
+    the head is ever copied out of it.
+    """
+    view = memoryview(data)
+    length = len(view)
+    size = min(1024, length, max_size)
+    while True:
+        chunk = view[:size].tobytes()
+        match = _HEAD_END_RE.search(chunk)
+        if match is not None:
+            chunk = chunk[:match.start()]
+            break
+        if size == length:
+            break
+        if size >= max_size:
+            raise ValueError("Request head too long")
+        size = min(size * 4, length, max_size)
+    return [line.rstrip(b"\r") for line in chunk.split(b"\n")]
+
+
+def _read_head_lines(fileobj, max_size):
+    """Get the lines in the head of raw request data from a file."""
+    lines = []
+    remaining = max_size
+    while True:
+        line = fileobj.readline(remaining + 1)
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        remaining -= len(line)
+        if remaining < 0:
+            raise ValueError("Request head too long")
+        line = line.rstrip(b"\r\n")
+        if not line.strip():
+            break
+        lines.append(line)
+    return lines
+
+
+def normalize_request(request):
+    """Convert the given request object into a RequestView.
+
+    This function transparently converts various types of request object
+    into a RequestView instance.  Currently supported types for the request
+    object are:
+
+        * RequestView objects, which are returned unchanged
+        * webob.Request objects, read through an EnvironRequest of their
+          environ
+        * requests.PreparedRequest objects, wrapped in a PreparedRequestView
+        * WSGI environ dicts, wrapped in an EnvironRequest
+        * bytes, bytearrays or memoryviews containing request data
+        * file-like objects containing request data
+
+    Raw request data is parsed by parse_request_head(), which reads only the
+    request line and headers and returns an EnvironRequest.
+
+    Objects of unrecognised type are assumed to provide the same interface
+    as webob.Request, and are wrapped in a WebObRequestView.
+    """
+    if isinstance(request, RequestView):
+        return request
+    # A webob.Request?  Its properties are slower than reading the environ.
+    if isinstance(request, webob.BaseRequest):
+        return EnvironRequest(request.environ, request)
+    # A requests.PreparedRequest object?
+    if requests and isinstance(request, requests.PreparedRequest):
+        return PreparedRequestView(request)
+    # A WSGI environ dict?
+    if isinstance(request, dict):
+        return EnvironRequest(request)
+    # A buffer of request data?
+    if isinstance(request, (bytes, bytearray, memoryview)):
+        return parse_request_head(request)
+    # A file-like object?
+    if all(hasattr(request, attr) for attr in ("read", "readline")):
+        return parse_request_head(request)
+    return WebObRequestView(request)
+
+
 def normalize_request_object(func):
-    """Decorator to normalize request into a WebOb request object.
+    """Decorator to normalize request into a RequestView object.
 
     This decorator can be applied to any function taking a request object
     as its first argument, and will transparently convert other types of
-    request object into a webob.Request instance.  Currently supported
-    types for the request object are:
-
-        * webob.Request objects
-        * requests.Request objects
-        * WSGI environ dicts
-        * bytestrings containing request data
-        * file-like objects containing request data
+    request object into a RequestView instance using normalize_request().
 
-    If the input request object is mutable, then any changes that the wrapped
-    function makes to the request headers will be written back to it at exit.
+    If any macauthlib.instrument hooks are registered, calls are timed as an
+    operation named after the wrapped function, with the conversion of the
+    request reported as its first stage.
     """
+    operation = func.__name__
+
     @functools.wraps(func)
     def wrapped_func(request, *args, **kwds):
-        orig_request = request
-        # Convert the incoming request object into a webob.Request.
-        if isinstance(orig_request, webob.Request):
-            pass
-        # A requests.PreparedRequest object?
-        elif requests and isinstance(orig_request, requests.PreparedRequest):
-            # Copy over only the details needed for the signature.
-            # WebOb doesn't code well with bytes header names,
-            # so we have to be a little careful.
-            request = webob.Request.blank(orig_request.url)
-            request.method = orig_request.method
-            for k, v in iteritems(orig_request.headers):
-                if not isinstance(k, str):
-                    k = k.decode('ascii')
-                request.headers[k] = v
-        # A WSGI environ dict?
-        elif isinstance(orig_request, dict):
-            request = webob.Request(orig_request)
-        # A bytestring?
-        elif isinstance(orig_request, bytes):
-            request = webob.Request.from_bytes(orig_request)
-        # A file-like object?
-        elif all(hasattr(orig_request, attr) for attr in ("read", "readline")):
-            request = webob.Request.from_file(orig_request)
-
-        # The wrapped function might modify headers.
-        # Write them back if the original request object is mutable.
-        try:
+        timer = instrument.start(operation)
+        if timer is None:
+            # Nested calls are passed a RequestView, which needs no work.
+            if not isinstance(request, RequestView):
+                request = normalize_request(request)
             return func(request, *args, **kwds)
+        outcome = "error"
+        try:
+            request = normalize_request(request)
+            if timer is not None:
+                timer.stage(instrument.STAGE_NORMALIZE)
+            result = func(request, *args, **kwds)
+            outcome = result if isinstance(result, bool) else True
+            return result
         finally:
-            if requests and isinstance(orig_request, requests.PreparedRequest):
-                orig_request.headers.update(request.headers)
+            if timer is not None:
+                timer.finish(outcome)
 
     return wrapped_func
@@ -0,0 +1,313 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Reusable object for verifying signed requests.
+
+"""
+
+import hmac
+import collections
+from hashlib import sha1
+
+from macauthlib import utils
+from macauthlib.clock import DEFAULT_CLOCK
+from macauthlib.noncecache import NonceCache
+
+
+# Values for the "status" attribute of a VerifyResult.
+STATUS_OK = "ok"
+STATUS_REJECTED = "rejected"
+
+# Values for the "reason" attribute of a rejected VerifyResult.
+REASON_MISSING = "missing"              # no Authorization header
+REASON_MALFORMED = "malformed"          # unparseable header or bad params
+REASON_SCHEME = "scheme"                # auth scheme was not "MAC"
+REASON_UNKNOWN_ID = "unknown-id"        # key_lookup found no key for the id
+REASON_BAD_SIGNATURE = "bad-signature"  # the mac did not match
+REASON_NONCE = "nonce"                  # stale timestamp or reused nonce
+
+# Names of the stages that can reject a request before any HMAC is
+# calculated, in the order they are applied.  Verifier.rejections counts
+# the requests rejected by each stage.
+STAGE_HEADER = "header"        # missing, overlong or unparseable header
+STAGE_SCHEME = "scheme"        # auth scheme was not "MAC"
+STAGE_PARAMS = "params"        # missing or invalid parameters
+STAGE_TIMESTAMP = "timestamp"  # ts outside the max_skew window
+STAGE_MAC = "mac"              # mac is the wrong length for the hashmod
+
+# Number of requests to hand to each executor task in Verifier.verify_many.
+DEFAULT_CHUNK_SIZE = 64
+
+
+class VerifyResult(object):
+    """The outcome of verifying a request with a Verifier.
+
+    This object has the following attributes:
+
+        * id:      the MAC id claimed by the request, or None if unknown
+        * status:  STATUS_OK if the request is valid, else STATUS_REJECTED
+        * reason:  one of the REASON_* constants if rejected, else None
+
+    It is true in a boolean context if and only if the request is valid.
+    """
+
+    __slots__ = ("id", "status", "reason")
+
+    def __init__(self, id, status, reason=None):
+        self.id = id
+        self.status = status
+        self.reason = reason
+
+    def __repr__(self):
+        return "<VerifyResult id=%r status=%r reason=%r>" % (
+            self.id, self.status, self.reason)
+
+    def __bool__(self):
+        return self.status == STATUS_OK
+
+    __nonzero__ = __bool__
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+
+class Verifier(object):
+    """Object for verifying signed requests against a fixed configuration.
+
+    This class does the same checks as macauthlib.check_signature(), but
+    resolves all of its configuration once at construction time rather than
+    on every call.  It is intended for servers that verify many requests.
+
+    The "key_lookup" argument must be a callable taking a MAC id and
+    returning the corresponding secret key, or None if the id is unknown;
+    it may also raise KeyError for unknown ids.  The "hashmod" argument
+    defaults to sha1.  The "nonces" argument may be a NonceCache object, or
+    False to disable nonce checking; if not specified then the verifier will
+    use a NonceCache of its own.  The "clock" argument is a callable giving
+    the current time, as described in macauthlib.clock; it defaults to the
+    clock of the nonce cache, so that the time is read once per request and
+    passed through to the cache.  The optional "keycache"
+    argument is an HMACKeyCache object used to avoid re-deriving HMAC key
+    state for each request.
+
+    Before doing any HMAC work, requests pass through a series of cheap
+    checks that reject obviously bad requests: the header must be present,
+    within utils.MAX_AUTHZ_HEADER_LENGTH and parseable; the scheme must be
+    "MAC"; all required parameters must be present; and the mac must have
+    the right length for the hash.  If the "max_skew" argument is given,
+    requests whose ts differs from the current time by more than that many
+    seconds are also rejected up front, whatever the clock skew cached for
+    the id.  The "rejections" attribute counts the requests rejected at
+    each of these STAGE_* stages; the counts are not exact when the
+    verifier is used from several threads at once.
+    """
+
+    def __init__(self, key_lookup, hashmod=None, nonces=None, clock=None,
+                 keycache=None, max_skew=None):
+        if hashmod is None:
+            hashmod = sha1
+        if clock is None:
+            clock = getattr(nonces, "clock", None) or DEFAULT_CLOCK
+        if nonces is None:
+            nonces = NonceCache(clock=clock)
+        self.key_lookup = key_lookup
+        self.hashmod = hashmod
+        self.nonces = nonces
+        self.clock = clock
+        self.keycache = keycache
+        self.max_skew = max_skew
+        self.rejections = collections.Counter()
+        self._mac_length = len(utils.b64encode(b"\0" * hashmod().digest_size))
+
+    def verify(self, request):
+        """Verify the signature on the given request.
+
+        This method returns a VerifyResult giving the claimed id and whether
+        the request was correctly signed.  As with check_signature(), the
+        nonce is only recorded once the signature has been found valid.
+        """
+        now = self.clock()
+        prepared = self._prepare(request, now)
+        if prepared.__class__ is VerifyResult:
+            return prepared
+        (id, timestamp, nonce, mac, key, sigstr) = prepared
+        sig = self._compute_signature(id, key, sigstr)
+        if sig is None:
+            return VerifyResult(id, STATUS_REJECTED, REASON_MALFORMED)
+        if utils.strings_differ(mac, sig):
+            return VerifyResult(id, STATUS_REJECTED, REASON_BAD_SIGNATURE)
+        # Check freshness of the nonce.
+        # We do this *after* successul sig check to avoid DOS attacks.
+        nonces = self.nonces
+        if nonces is not False:
+            if not nonces.check_nonce(id, timestamp, nonce, now):
+                return VerifyResult(id, STATUS_REJECTED, REASON_NONCE)
+        return VerifyResult(id, STATUS_OK)
+
+    def verify_many(self, requests, executor=None, chunk_size=None):
+        """Verify the signatures on each of the given requests.
+
+        This method is a generator yielding a VerifyResult for each request,
+        in order.  All the requests are parsed and normalized in a first
+        pass, then their signatures are calculated, and finally the nonces
+        of all correctly-signed requests are checked in a single pass
+        holding the NonceCache lock.
+
+        If the "executor" argument is given, it must be a concurrent.futures
+        Executor to which the HMAC calculations will be submitted in chunks
+        of "chunk_size" requests.  Note that hashlib only releases the GIL
+        when hashing large strings, so a thread pool pays off only when the
+        requests have long normalized strings (e.g. large query strings).
+        """
+        if chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        now = self.clock()
+        results = []
+        pending = []
+        for request in requests:
+            prepared = self._prepare(request, now)
+            if prepared.__class__ is VerifyResult:
+                results.append(prepared)
+            else:
+                pending.append((len(results),) + prepared)
+                results.append(None)
+        # Calculate all the signatures, possibly in parallel.
+        if executor is not None and len(pending) > chunk_size:
+            chunks = [pending[i:i + chunk_size]
+                      for i in range(0, len(pending), chunk_size)]
+            sigs = []
+            for chunk_sigs in executor.map(self._compute_signatures, chunks):
+                sigs.extend(chunk_sigs)
+        else:
+            sigs = self._compute_signatures(pending)
+        # Check the signatures, and gather the nonces that need checking.
+        # We do this *after* successul sig check to avoid DOS attacks.
+        fresh = []
+        for (item, sig) in zip(pending, sigs):
+            (index, id, timestamp, nonce, mac, key, sigstr) = item
+            if sig is None:
+                results[index] = VerifyResult(id, STATUS_REJECTED,
+                                              REASON_MALFORMED)
+            elif utils.strings_differ(mac, sig):
+                results[index] = VerifyResult(id, STATUS_REJECTED,
+                                              REASON_BAD_SIGNATURE)
+            else:
+                fresh.append((index, id, timestamp, nonce))
+        nonces = self.nonces
+        if nonces is not False and fresh:
+            checks = [(id, ts, nonce) for (_, id, ts, nonce) in fresh]
+            valid = nonces.check_nonces(checks, now)
+        else:
+            valid = [True] * len(fresh)
+        for ((index, id, _, _), is_valid) in zip(fresh, valid):
+            if is_valid:
+                results[index] = VerifyResult(id, STATUS_OK)
+            else:
+                results[index] = VerifyResult(id, STATUS_REJECTED,
+                                              REASON_NONCE)
+        for result in results:
+            yield result
+
+    def _prepare(self, request, now):
+        """Do all the work needed to verify a request, short of the HMAC.
+
+        This method returns a VerifyResult if the request can be rejected
+        without calculating its signature, and otherwise a tuple giving
+        (id, timestamp, nonce, mac, key, sigstr) for the request.
+        """
+        parsed = self._parse(request, now)
+        if parsed.__class__ is VerifyResult:
+            return parsed
+        (id, timestamp, nonce, mac, sigstr) = parsed
+        try:
+            key = self.key_lookup(id)
+        except KeyError:
+            key = None
+        if key is None:
+            return VerifyResult(id, STATUS_REJECTED, REASON_UNKNOWN_ID)
+        return (id, timestamp, nonce, mac, key, sigstr)
+
+    def _parse(self, request, now):
+        """Extract the details needed to verify a request.
+
+        This method applies each of the rejection stages in turn, and
+        returns a VerifyResult if the request can be rejected without
+        knowing its key.  Otherwise it returns a tuple giving
+        (id, timestamp, nonce, mac, sigstr) for the request.
+        """
+        # Raw request data that can't be parsed is treated like a bad header.
+        try:
+            request = utils.normalize_request(request)
+        except ValueError:
+            return self._reject(STAGE_HEADER, None, REASON_MALFORMED)
+        # Check the header size and shape.
+        authz = request.authorization
+        if authz is None:
+            self.rejections[STAGE_HEADER] += 1
+            return VerifyResult(None, STATUS_REJECTED, REASON_MISSING)
+        cache = utils.AUTHZ_HEADER_CACHE
+        try:
+            if cache is not None:
+                params = cache.parse(authz)
+            else:
+                params = utils.parse_authz_value(authz)
+        except ValueError:
+            return self._reject(STAGE_HEADER, None, REASON_MALFORMED)
+        # Check the scheme.
+        if params["scheme"] != "MAC":
+            return self._reject(STAGE_SCHEME, None, REASON_SCHEME)
+        # Check the required parameters.
+        # Any KeyError here indicates a missing parameter.
+        # Any ValueError here indicates an invalid parameter.
+        try:
+            id = params["id"]
+            timestamp = int(params["ts"])
+            nonce = params["nonce"]
+            mac = params["mac"]
+        except (KeyError, ValueError):
+            return self._reject(STAGE_PARAMS, params.get("id"),
+                                REASON_MALFORMED)
+        # Check the timestamp against the hard window, if any.
+        max_skew = self.max_skew
+        if max_skew is not None and abs(timestamp - now) > max_skew:
+            return self._reject(STAGE_TIMESTAMP, id, REASON_NONCE)
+        # Check that the mac could possibly be valid.
+        if len(mac) != self._mac_length:
+            return self._reject(STAGE_MAC, id, REASON_BAD_SIGNATURE)
+        try:
+            sigstr = utils.get_normalized_request_string(request, params)
+            # The spec mandates that the request string must be ascii.
+            sigstr = sigstr.encode("ascii")
+        except (KeyError, ValueError):
+            return self._reject(STAGE_PARAMS, id, REASON_MALFORMED)
+        return (id, timestamp, nonce, mac, sigstr)
+
+    def _reject(self, stage, id, reason):
+        """Count a rejection at the given stage, and return its result."""
+        self.rejections[stage] += 1
+        return VerifyResult(id, STATUS_REJECTED, reason)
+
+    def _compute_signature(self, id, key, sigstr):
+        """Calculate the base64-encoded signature for a request string.
+
+        This method returns None if the key is not valid ascii.
+        """
+        try:
+            keycache = self.keycache
+            if keycache is not None:
+                hasher = keycache.get_hmac(id, key, self.hashmod)
+                hasher.update(sigstr)
+            else:
+                hasher = hmac.new(key.encode("ascii"), sigstr, self.hashmod)
+        except ValueError:
+            return None
+        return utils.b64encode(hasher.digest())
+
+    def _compute_signatures(self, items):
+        """Calculate the signatures for a list of pending verifications."""
+        compute_signature = self._compute_signature
+        return [compute_signature(id, key, sigstr)
+                for (_, id, _, _, _, key, sigstr) in items]